@@ -1,22 +1,38 @@
+import asyncio
+import functools
 import os
 import shutil
-import threading
-import time
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
 
+from filetransfer.aio import BackgroundCore
+from filetransfer.estimate import MB, format_duration
+from filetransfer.api import Transfer, TransferOptions
+from filetransfer.jobqueue import QUEUED, RUNNING, JobQueue, QueueRunner
+from filetransfer.progress import FRAME_MS, ProgressChannel
+from filetransfer.scanner import read_path_list
+from filetransfer.scheduler import TransferSummary
+
 class FileTransferApp:
     def __init__(self, root):
         self.root = root
         self.root.title("File Transfer Application")
-        self.root.geometry("600x500")
+        self.root.geometry("600x600")
         self.root.configure(bg="#F0F0F0")
 
         self.source_path = tk.StringVar()
+        self.source_list = None    # several selected paths; the entry only shows how many
         self.dest_path = tk.StringVar()
         self.select_all = tk.BooleanVar()
-        self.cancel_transfer = False
+        self.split_large = tk.BooleanVar()
+        self.sync_mode = tk.BooleanVar()
+        self.verify_copies = tk.BooleanVar()
+        self.core = BackgroundCore()
+        self.job_queue = None      # opened on first use
+        self.queue_runner = None
+        self.transfer = None
+        self.channel = None
 
         # Title Label
         title_label = tk.Label(root, text="File Transfer Application", font=("Helvetica", 16, "bold"), bg="#F0F0F0")
@@ -35,6 +51,9 @@ class FileTransferApp:
         source_browse_button = ttk.Button(source_frame, text="Browse", command=self.browse_source)
         source_browse_button.grid(row=0, column=2, padx=5)
 
+        source_list_button = ttk.Button(source_frame, text="List...", command=self.load_source_list)
+        source_list_button.grid(row=0, column=3, padx=5)
+
         # Destination Frame
         dest_frame = ttk.Frame(root, padding=10)
         dest_frame.pack(fill=tk.X, padx=20, pady=5)
@@ -52,6 +71,15 @@ class FileTransferApp:
         select_all_check = ttk.Checkbutton(root, text="Select All Files", variable=self.select_all)
         select_all_check.pack(pady=5)
 
+        split_large_check = ttk.Checkbutton(root, text="Split Large Files Into Parallel Ranges", variable=self.split_large)
+        split_large_check.pack(pady=5)
+
+        sync_mode_check = ttk.Checkbutton(root, text="Only Copy New Or Changed Files", variable=self.sync_mode)
+        sync_mode_check.pack(pady=5)
+
+        verify_check = ttk.Checkbutton(root, text="Verify Copies", variable=self.verify_copies)
+        verify_check.pack(pady=5)
+
         # Progress Bar
         self.progress_bar = ttk.Progressbar(root, orient="horizontal", length=400, mode="determinate")
         self.progress_bar.pack(pady=10)
@@ -63,7 +91,7 @@ class FileTransferApp:
         self.current_file_label = ttk.Label(status_frame, text="Currently Transferring: N/A", width=50)
         self.current_file_label.grid(row=0, column=0, padx=5)
 
-        self.speed_label = ttk.Label(status_frame, text="Speed: 0 MB/s", width=20)
+        self.speed_label = ttk.Label(status_frame, text="Speed: 0 MB/s", width=30)
         self.speed_label.grid(row=0, column=1, padx=5)
 
         self.time_remaining_label = ttk.Label(status_frame, text="ETR: N/A")
@@ -79,12 +107,52 @@ class FileTransferApp:
         self.cancel_button = ttk.Button(button_frame, text="Cancel", command=self.cancel_transfer_action, state="disabled")
         self.cancel_button.grid(row=0, column=1, padx=5)
 
+        self.queue_button = ttk.Button(button_frame, text="Add To Queue", command=self.queue_transfer)
+        self.queue_button.grid(row=0, column=2, padx=5)
+
+        self.queue_label = ttk.Label(root, text="Queue: empty")
+        self.queue_label.pack(pady=5)
+
     def browse_source(self):
         """Browse and select multiple files"""
         files_selected = filedialog.askopenfilenames(title="Select Files")
         if files_selected:
-            self.source_path.set(";".join(files_selected))  # Join file paths with semicolon for display
+            self.set_sources(list(files_selected))
+
+    def load_source_list(self):
+        """Take the sources from a list file (one path per line, or find -print0 output)"""
+        list_file = filedialog.askopenfilename(title="Select A List Of Paths")
+        if not list_file:
+            return
+        try:
+            with open(list_file, "rb") as f:
+                paths = read_path_list(f)
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not read {list_file}: {e}")
+            return
+        if not paths:
+            messagebox.showerror("Error", f"{list_file} lists no paths.")
+            return
+        self.set_sources(paths)
 
+    def set_sources(self, paths):
+        if len(paths) == 1:
+            self.source_list = None
+            self.source_path.set(paths[0])
+        else:
+            # Keep the list itself out of the Tk variable, it can hold 100k paths
+            self.source_list = paths
+            self.source_path.set(self.source_list_text())
+
+    def source_list_text(self):
+        return f"{len(self.source_list)} items selected"
+
+    def selected_source(self):
+        """The typed or browsed path, or the list of selected paths"""
+        src = self.source_path.get()
+        if self.source_list is not None and src == self.source_list_text():
+            return self.source_list
+        return src
 
     def browse_dest(self):
         """Browse the destination folder"""
@@ -93,49 +161,41 @@ class FileTransferApp:
             self.dest_path.set(folder_selected)
 
     def cancel_transfer_action(self):
-        """Cancel the ongoing transfer"""
-        self.cancel_transfer = True
+        """Cancel the ongoing transfer; Start stays disabled until it has actually stopped"""
+        if self.transfer is not None:
+            self.core.cancel(self.transfer)
         self.cancel_button.config(state="disabled")
-        self.transfer_button.config(state="normal")
-        messagebox.showinfo("Cancelled", "Transfer has been cancelled.")
+        self.current_file_label.config(text="Cancelling...")
 
-    def copy_file(self, src, dst):
-        """Helper function to copy files with progress, transfer speed, and time estimation"""
-        try:
-            total_size = os.path.getsize(src)
-            bytes_copied = 0
-            start_time = time.time()
-
-            with open(src, 'rb') as source_file:
-                with open(dst, 'wb') as dest_file:
-                    while chunk := source_file.read(1024 * 1024):  # 1 MB chunks
-                        if self.cancel_transfer:
-                            return False  # Exit if transfer is cancelled
-
-                        dest_file.write(chunk)
-                        bytes_copied += len(chunk)
-                        elapsed_time = time.time() - start_time
-                        speed = bytes_copied / elapsed_time / (1024 * 1024)  # MB/s
-                        progress = (bytes_copied / total_size) * 100
-                        self.progress_bar['value'] = progress
-
-                        # Update labels
-                        self.speed_label.config(text=f"Speed: {speed:.2f} MB/s")
-                        time_remaining = (total_size - bytes_copied) / (bytes_copied / elapsed_time) if bytes_copied > 0 else 0
-                        self.time_remaining_label.config(
-                            text=f"ETR: {int(time_remaining)} sec ({time_remaining // 60:.0f} min)"
-                        )
-
-                        self.root.update_idletasks()
-
-            return True
-        except Exception as e:
-            print(f"Error copying {src} to {dst}: {e}")
-            return False
+    def update_progress(self, transfer):
+        """Update the progress bar, speed and time estimation for the whole transfer"""
+        estimate = transfer.estimate()
+        if estimate is None:
+            return
+        # The scan may still be running, in which case the totals are still growing
+        self.progress_bar['value'] = estimate.fraction * 100
+        self.speed_label.config(text=f"Speed: {estimate.bytes_per_second / MB:.2f} MB/s "
+                                     f"(avg {estimate.average_bytes_per_second / MB:.2f})")
+        self.time_remaining_label.config(
+            text=f"ETR: {format_duration(estimate.eta)}  -  {estimate.files_done}/{estimate.total_files} files, "
+                 f"{estimate.files_per_second:.0f} files/s"
+        )
+
+    def poll_progress(self, transfer, channel):
+        """Apply everything the workers of ``transfer`` reported since the last frame, on the Tk thread"""
+        update = channel.drain()
+        if update.current_file is not None and not transfer.cancelled():
+            self.current_file_label.config(text=f"Currently Transferring: {os.path.basename(update.current_file)}")
+        if update.bytes_done is not None:
+            self.update_progress(transfer)
+        if update.finished:
+            self.transfer_finished(transfer, update.summary)
+        else:
+            self.root.after(FRAME_MS, self.poll_progress, transfer, channel)
 
     def start_transfer(self):
-        """Start file transfer in a separate thread"""
-        src = self.source_path.get()
+        """Start the file transfer on the background core"""
+        src = self.selected_source()
         dest = self.dest_path.get()
 
         if not src:
@@ -145,57 +205,84 @@ class FileTransferApp:
             messagebox.showerror("Error", "Please select a destination path.")
             return
 
-        self.cancel_transfer = False
         self.transfer_button.config(state="disabled")
         self.cancel_button.config(state="normal")
-        threading.Thread(target=self.transfer_files, args=(src, dest)).start()
-
-    def transfer_files(self, src, dest):
-        """Transfer files and folders"""
-        if os.path.isdir(src):
-            files_to_transfer = os.listdir(src)
-            total_files = len(files_to_transfer)
-
-            total_bytes = sum(os.path.getsize(os.path.join(src, f)) for f in files_to_transfer)
-            bytes_transferred = 0
-            start_time = time.time()
-
-            for index, file in enumerate(files_to_transfer, 1):
-                if self.cancel_transfer:
-                    break
-
-                src_file = os.path.join(src, file)
-                dest_file = os.path.join(dest, file)
-                self.current_file_label.config(text=f"Currently Transferring: {file}")
-
-                if os.path.isdir(src_file):
-                    os.makedirs(dest_file, exist_ok=True)
-                    self.transfer_files(src_file, dest_file)
-                else:
-                    success = self.copy_file(src_file, dest_file)
-                    if success:
-                        bytes_transferred += os.path.getsize(src_file)
-                        overall_progress = (bytes_transferred / total_bytes) * 100
-                        self.progress_bar['value'] = overall_progress
-
-            self.transfer_button.config(state="normal")
-            self.cancel_button.config(state="disabled")
-            if not self.cancel_transfer:
-                messagebox.showinfo("Success", "Transfer completed successfully.")
+        # Each run keeps its own transfer and channel, whatever self.transfer is by the time it ends
+        transfer = self.transfer = Transfer(src, dest, self.transfer_options())
+        channel = self.channel = ProgressChannel()
+        self.core.submit(transfer, on_progress=channel.progress, on_file_start=channel.file_started,
+                         on_done=functools.partial(self.transfer_done, transfer, channel))
+        self.root.after(FRAME_MS, self.poll_progress, transfer, channel)
+
+    def transfer_options(self):
+        """Options from the checkboxes; read them here, the worker threads must not touch Tk at all"""
+        return TransferOptions(split_large=self.split_large.get(), sync=self.sync_mode.get(),
+                               verify=self.verify_copies.get())
+
+    def queue_transfer(self):
+        """Add the selected paths to the persistent job queue, which runs in the background"""
+        src = self.selected_source()
+        dest = self.dest_path.get()
+        if not src or not dest:
+            messagebox.showerror("Error", "Please select a source and a destination path.")
+            return
+        if self.job_queue is None:
+            self.job_queue = JobQueue()
+            self.queue_runner = QueueRunner(self.job_queue, self.core.core)
+            asyncio.run_coroutine_threadsafe(self.queue_runner.run(), self.core.loop)
+            self.poll_queue()
+        self.job_queue.submit(src, dest, self.transfer_options())
+        self.core.loop.call_soon_threadsafe(self.queue_runner.wake)
+        self.poll_queue(reschedule=False)
+
+    def poll_queue(self, reschedule=True):
+        """Refresh the queue line; two indexed counts, however long the queue is"""
+        counts = self.job_queue.counts()
+        waiting, running = counts.get(QUEUED, 0), counts.get(RUNNING, 0)
+        self.queue_label.config(text=f"Queue: {waiting} waiting, {running} running" if waiting or running
+                                else "Queue: empty")
+        if reschedule:
+            self.root.after(1000, self.poll_queue)
+
+    def transfer_done(self, transfer, channel, summary, error):
+        """Called on the core's thread once ``transfer`` has stopped, hands the outcome to Tk"""
+        if summary is None:
+            # Failed or cancelled before the copy even started
+            summary = TransferSummary()
+            summary.cancelled = error is None
+        if error is not None:
+            print(f"Transfer from {transfer.source} to {transfer.dest} failed: {error}")
+            summary.failures.append((transfer.source, str(error)))
         else:
-            success = self.copy_file(src, dest)
-            self.transfer_button.config(state="normal")
-            self.cancel_button.config(state="disabled")
-            if success and not self.cancel_transfer:
-                messagebox.showinfo("Success", "Transfer completed successfully.")
-            elif self.cancel_transfer:
-                messagebox.showinfo("Cancelled", "Transfer was cancelled.")
-
-# Create the Tkinter root window
-root = tk.Tk()
-
-# Instantiate the application
-app = FileTransferApp(root)
-
-# Start the Tkinter event loop
-root.mainloop()
+            print(summary.describe())
+        channel.finish(summary)
+
+    def transfer_finished(self, transfer, summary):
+        """Reset the buttons and report the outcome once the worker is done"""
+        self.transfer_button.config(state="normal")
+        self.cancel_button.config(state="disabled")
+        if summary.cancelled:
+            self.current_file_label.config(text="Currently Transferring: N/A")
+            messagebox.showinfo("Cancelled", "Transfer has been cancelled.")
+            return
+        if summary.failures:
+            messagebox.showerror("Error", f"{summary.files_failed} of {transfer.total_files} files failed to copy.")
+        elif summary.files_skipped:
+            messagebox.showinfo(
+                "Success",
+                f"Transfer completed successfully.\n"
+                f"Copied {summary.files_copied} files, skipped {summary.files_skipped} unchanged files "
+                f"({summary.bytes_skipped / (1024 * 1024):.1f} MB).",
+            )
+        else:
+            messagebox.showinfo("Success", "Transfer completed successfully.")
+
+if __name__ == "__main__":
+    # Create the Tkinter root window
+    root = tk.Tk()
+
+    # Instantiate the application
+    app = FileTransferApp(root)
+
+    # Start the Tkinter event loop
+    root.mainloop()
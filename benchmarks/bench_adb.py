@@ -0,0 +1,86 @@
+"""adb push of many small files: one adb call per file against batched sessions.
+
+Runs against benchmarks/fake_adb.py, which sleeps --delay seconds per
+launch to stand in for adb's start-up and USB handshake, so the numbers
+show what batching saves in launches rather than USB speed. Pass --adb adb
+(and --remote) to measure a real device instead.
+
+Usage: python benchmarks/bench_adb.py [--files 2000] [--size 16384] [--delay 0.05] [--sessions 1,2,4]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filetransfer.adb import DIRECTORY, TAR, AdbDevice, push  # noqa: E402
+
+FAKE_ADB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_adb.py")
+
+
+def make_tree(root, count, size):
+    os.makedirs(root)
+    data = os.urandom(size)
+    for i in range(count):
+        with open(os.path.join(root, f"img{i:06d}.jpg"), "wb") as f:
+            f.write(data)
+    return root
+
+
+def push_per_file(device, source, remote):
+    """What the old mobile mode did: one adb push per file"""
+    device.shell(f"mkdir -p {remote}")
+    for name in sorted(os.listdir(source)):
+        subprocess.run(device.argv("push", os.path.join(source, name), f"{remote}/{name}"),
+                       stdout=subprocess.DEVNULL, check=True)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run(workdir, device, remote, files, size, sessions_list):
+    source = make_tree(os.path.join(workdir, "photos"), files, size)
+    print(f"{'method':<16} {'sessions':>8} {'files/s':>9} {'sec':>8}")
+    elapsed = timed(lambda: push_per_file(device, source, f"{remote}/per-file"))
+    print(f"{'per-file push':<16} {1:>8} {files / elapsed:>9.0f} {elapsed:>8.2f}")
+    for mode in (DIRECTORY, TAR):
+        for sessions in sessions_list:
+            target = f"{remote}/{mode}-{sessions}"
+            summary = None
+
+            def batched():
+                nonlocal summary
+                summary = push([source], target, device, sessions, mode)
+
+            elapsed = timed(batched)
+            if not summary.ok:
+                raise SystemExit(f"{mode} push failed: {summary.failures[:3]}")
+            print(f"{'batched ' + mode:<16} {sessions:>8} {files / elapsed:>9.0f} {elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="directory for the test tree and the fake device (default: a temp dir)")
+    parser.add_argument("--adb", default=FAKE_ADB, help="adb executable (default: the fake)")
+    parser.add_argument("--remote", default="/sdcard/bench_adb", help="device directory to push into")
+    parser.add_argument("--files", type=int, default=2000, help="number of files")
+    parser.add_argument("--size", type=int, default=16384, help="size of each file in bytes")
+    parser.add_argument("--delay", type=float, default=0.05, help="fake adb launch latency in seconds")
+    parser.add_argument("--sessions", default="1,2,4", help="session counts, comma separated")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_adb_", dir=args.dir)
+    os.environ.setdefault("FAKE_ADB_ROOT", os.path.join(workdir, "device"))
+    os.environ.setdefault("FAKE_ADB_DELAY", str(args.delay))
+    try:
+        run(workdir, AdbDevice(adb=args.adb), args.remote, args.files, args.size,
+            [int(s) for s in args.sessions.split(",")])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,117 @@
+"""Effective throughput of compressed transfers against a raw copy, per destination speed.
+
+The compressor is timed for real on a local scratch file; the destination
+is modelled as a link of fixed speed. Compression and writing overlap, so a
+compressed copy takes max(compress time, compressed bytes / link speed)
+while a raw copy takes raw bytes / link speed.
+
+It first checks that a second compressed sync with checksums copies
+nothing, i.e. the manifest recognises files it stored as containers.
+
+Usage: python benchmarks/bench_compress.py [--dir DIR] [--size 128] [--data csv|random|both]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filetransfer import Transfer, TransferOptions  # noqa: E402
+from filetransfer.compress import CODECS, DEFAULT_CODEC, Compressor  # noqa: E402
+
+MB = 1024 * 1024
+
+# MB/s the destination sustains for large sequential writes
+SPEED_CLASSES = {
+    "SMB 100 Mbit": 11,
+    "USB 2.0": 30,
+    "SMB 1 Gbit": 110,
+    "USB 3.0": 200,
+    "SATA SSD": 500,
+}
+
+
+def make_csv(path, size_mb, seed=0):
+    rng = random.Random(seed)
+    names = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot"]
+    with open(path, "w") as f:
+        written = 0
+        row = 0
+        while written < size_mb * MB:
+            line = (f"{row},2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d},"
+                    f"{rng.choice(names)},{rng.random() * 1000:.3f},{rng.randint(0, 99999)}\n")
+            f.write(line)
+            written += len(line)
+            row += 1
+
+
+def make_random(path, size_mb):
+    block = os.urandom(MB)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+
+def time_compress(src, dst, codec, level):
+    compressor = Compressor(codec, level)
+    try:
+        start = time.perf_counter()
+        result = compressor.compress_file(src, dst)
+        return time.perf_counter() - start, result.bytes_written
+    finally:
+        compressor.close()
+
+
+def check_checksum_sync(workdir):
+    """Run a compressed checksum sync twice; exit if the second run copies anything"""
+    source = os.path.join(workdir, "sync_src")
+    dest = os.path.join(workdir, "sync_dst")
+    os.makedirs(source)
+    make_csv(os.path.join(source, "table.csv"), 1)
+    options = TransferOptions(sync=True, checksum=True, compress=DEFAULT_CODEC)
+    Transfer(source, dest, options).run()
+    summary = Transfer(source, dest, options).run()
+    print(f"compressed checksum sync, second run: {summary.files_copied} copied, {summary.files_skipped} skipped")
+    if not summary.ok or summary.files_copied:
+        raise SystemExit("the second run copied unchanged files again")
+    shutil.rmtree(source)
+    shutil.rmtree(dest)
+
+
+def run(workdir, size_mb, kinds):
+    for kind in kinds:
+        src = os.path.join(workdir, f"{kind}.dat")
+        (make_csv if kind == "csv" else make_random)(src, size_mb)
+        raw = os.path.getsize(src)
+        print(f"\n{kind} data, {raw / MB:.0f} MB")
+        print(f"{'codec':<10}{'ratio':>7}{'CPU MB/s':>10}" + "".join(f"{name:>14}" for name in SPEED_CLASSES))
+        print(f"{'raw copy':<10}{1:>7.2f}{'-':>10}" + "".join(f"{speed:>14.1f}" for speed in SPEED_CLASSES.values()))
+        for name, codec in CODECS.items():
+            for level in sorted({1, codec.default_level}):
+                elapsed, written = time_compress(src, os.path.join(workdir, "out.ftz"), name, level)
+                cells = ""
+                for speed in SPEED_CLASSES.values():
+                    effective = raw / MB / max(elapsed, written / MB / speed)
+                    cells += f"{effective:>14.1f}"
+                label = f"{name}-{level}"
+                print(f"{label:<10}{raw / written:>7.2f}{raw / MB / elapsed:>10.1f}{cells}")
+        os.remove(src)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="scratch directory (default: system temp)")
+    parser.add_argument("--size", type=int, default=128, help="test file size in MB")
+    parser.add_argument("--data", choices=("csv", "random", "both"), default="both")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_compress_", dir=args.dir)
+    try:
+        check_checksum_sync(workdir)
+        run(workdir, args.size, ("csv", "random") if args.data == "both" else (args.data,))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,141 @@
+"""Compare the block delta engine against a full copy at several change ratios.
+
+The delta runs the way a sync does: the old copy is reflinked to a
+temporary file and that is patched. Where the old copy can't be reflinked
+(ext4, FAT) a sync copies the whole file instead, and only the full copy
+is measured. "io MB" is what the process had written out, from
+/proc/self/io where there is one.
+
+It first checks that a sparse image updated by a sync run stays sparse at
+the destination, which the delta path (block by block, holes included)
+must not be used for.
+
+Usage: python benchmarks/bench_delta.py [--dir DIR] [--size 256] [--ratios 0,0.01,0.1,0.5,1] [--block-size 65536]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filetransfer import Transfer, TransferOptions  # noqa: E402
+from filetransfer.delta import DEFAULT_BLOCK_SIZE, delta_copy  # noqa: E402
+from filetransfer.engine import clone_file, copy_file  # noqa: E402
+
+
+def make_file(path, size_mb):
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+
+def mutate(path, ratio, block_size, seed=0):
+    """Overwrite ``ratio`` of the blocks of ``path`` with fresh random data"""
+    blocks = os.path.getsize(path) // block_size
+    rng = random.Random(seed)
+    with open(path, "r+b") as f:
+        for index in rng.sample(range(blocks), int(blocks * ratio)):
+            f.seek(index * block_size)
+            f.write(os.urandom(block_size))
+
+
+def io_written():
+    """Bytes this process has sent to storage so far, None where the kernel doesn't say"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def timed(fn):
+    written = io_written()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    if written is not None:
+        os.sync()  # write_bytes is counted as the page cache is written back
+        written = io_written() - written
+    return elapsed, result, written
+
+
+def report(ratio, method, result_bytes, io_bytes, elapsed):
+    io = f"{io_bytes / 2 ** 20:>8.1f}" if io_bytes is not None else f"{'-':>8}"
+    print(f"{ratio:>8.0%} {method:<8} {result_bytes / 2 ** 20:>11.1f} {io} {elapsed:>8.3f}")
+
+
+def check_sparse_sync(workdir, size_mb):
+    """Sync a changed sparse image over its old copy; exit if the copy lost its holes"""
+    source = os.path.join(workdir, "sparse_src")
+    dest = os.path.join(workdir, "sparse_dst")
+    os.makedirs(source)
+    image = os.path.join(source, "disk.img")
+    with open(image, "wb") as f:
+        f.write(os.urandom(4096))
+        f.truncate(size_mb * 1024 * 1024)
+    Transfer(source, dest, TransferOptions(sync=True, reflink=False)).run()
+    with open(image, "r+b") as f:
+        f.seek(size_mb * 1024 * 1024 // 2)
+        f.write(os.urandom(4096))
+    st = os.stat(image)
+    os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    summary = Transfer(source, dest, TransferOptions(sync=True, reflink=False)).run()
+    allocated = os.stat(os.path.join(dest, "disk.img")).st_blocks * 512
+    print(f"sparse {size_mb} MB image after a sync: {allocated // 1024} KB allocated")
+    if not summary.ok or allocated > os.stat(image).st_blocks * 512:
+        raise SystemExit(f"sparse image was filled in by the sync ({summary.methods})")
+    shutil.rmtree(source)
+    shutil.rmtree(dest)
+
+
+def run(workdir, size_mb, ratios, block_size):
+    src = os.path.join(workdir, "src.bin")
+    dst = os.path.join(workdir, "dst.bin")
+    part = os.path.join(workdir, "dst.bin.part")
+    print(f"{'changed':>8} {'method':<8} {'written MB':>11} {'io MB':>8} {'sec':>8}")
+    for ratio in ratios:
+        make_file(src, size_mb)
+        shutil.copyfile(src, dst)
+        mutate(src, ratio, block_size, seed=int(ratio * 1000))
+        os.sync()
+
+        def patch():
+            if clone_file(dst, part) is None:
+                return None
+            return delta_copy(src, part, block_size)
+
+        elapsed, result, written = timed(patch)
+        if result is None:
+            print(f"{ratio:>8.0%} {'delta':<8} no reflinks here, a sync copies the whole file")
+        else:
+            report(ratio, "delta", result.bytes_written, written, elapsed)
+        os.remove(part)
+
+        elapsed, result, written = timed(lambda: copy_file(src, part, reflink=False))
+        report(ratio, "full", result.bytes_copied, written, elapsed)
+        os.remove(part)
+        os.remove(dst)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="directory on the device to test (default: a temp dir)")
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    parser.add_argument("--ratios", default="0,0.01,0.1,0.5,1", help="fraction of blocks changed, comma separated")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="delta block size in bytes")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_delta_", dir=args.dir)
+    try:
+        check_sparse_sync(workdir, args.size)
+        run(workdir, args.size, [float(r) for r in args.ratios.split(",")], args.block_size)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,88 @@
+"""Network send throughput over loopback as streams are added.
+
+Starts a Receiver on 127.0.0.1 and sends the same tree with 1, 2, 4, 8
+streams: a few large files (sendfile path) and many small ones (coalesced
+records). Point --host at a machine running ``python -m filetransfer serve``
+to measure a real link instead.
+
+Usage: python benchmarks/bench_net.py [--dir DIR] [--streams 1,2,4,8] [--large-mb 256] [--small 5000]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filetransfer.net import Receiver, parse_address, send  # noqa: E402
+
+
+def make_tree(root, large_mb, large_count, small_count, small_size):
+    block = os.urandom(1024 * 1024)
+    large = os.path.join(root, "large")
+    small = os.path.join(root, "small")
+    os.makedirs(large)
+    os.makedirs(small)
+    for i in range(large_count):
+        with open(os.path.join(large, f"file{i}.bin"), "wb") as f:
+            for _ in range(large_mb):
+                f.write(block)
+    for i in range(small_count):
+        with open(os.path.join(small, f"file{i:06d}.bin"), "wb") as f:
+            f.write(block[:small_size])
+    return large, small
+
+
+def timed_send(source, address, streams, token):
+    start = time.perf_counter()
+    summary = send([source], address, streams, token)
+    elapsed = time.perf_counter() - start
+    if not summary.ok:
+        raise SystemExit(f"send failed: {summary.failures[:3]}")
+    return summary, elapsed
+
+
+def run(workdir, address, stream_counts, large_mb, large_count, small_count, small_size, repeat, token):
+    large, small = make_tree(os.path.join(workdir, "src"), large_mb, large_count, small_count, small_size)
+    print(f"{'set':<8} {'streams':>7} {'MB/s':>9} {'files/s':>9} {'sec':>8}")
+    for label, source in (("large", large), ("small", small)):
+        for streams in stream_counts:
+            best = None
+            for _ in range(repeat):
+                summary, elapsed = timed_send(source, address, streams, token)
+                if best is None or elapsed < best[1]:
+                    best = (summary, elapsed)
+            summary, elapsed = best
+            print(f"{label:<8} {streams:>7} {summary.bytes_copied / elapsed / 2 ** 20:>9.1f} "
+                  f"{summary.files_copied / elapsed:>9.0f} {elapsed:>8.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="directory for the test tree (default: a temp dir)")
+    parser.add_argument("--host", metavar="HOST[:PORT]", help="send to this receiver instead of one on loopback")
+    parser.add_argument("--token", help="the remote receiver's token")
+    parser.add_argument("--streams", default="1,2,4,8", help="stream counts, comma separated")
+    parser.add_argument("--large-mb", type=int, default=256, help="size of each large file")
+    parser.add_argument("--large-count", type=int, default=4, help="number of large files")
+    parser.add_argument("--small", type=int, default=5000, help="number of small files")
+    parser.add_argument("--small-size", type=int, default=8192, help="size of each small file in bytes")
+    parser.add_argument("--repeat", type=int, default=2, help="runs per case, the best one is reported")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_net_", dir=args.dir)
+    receiver = None
+    try:
+        if args.host:
+            address = parse_address(args.host)
+        else:
+            receiver = Receiver(os.path.join(workdir, "received"), "127.0.0.1", 0, report=None).start()
+            address = receiver.address
+        run(workdir, address, [int(s) for s in args.streams.split(",")], args.large_mb, args.large_count,
+            args.small, args.small_size, args.repeat, args.token)
+    finally:
+        if receiver is not None:
+            receiver.close()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,100 @@
+"""Cost of the phase profiler: the same copies with profiling off, on, and with a timeline.
+
+Small files are where per-sample overhead shows, so the default tree is
+many small files plus one large one. Each case copies into a fresh
+destination, the old one deleted and synced out first so its cleanup
+doesn't land in the next run; the cases take turns and the best of
+--repeat runs is reported.
+
+Usage: python benchmarks/bench_profiler.py [--dir DIR] [--small 5000] [--small-size 4096] [--large-mb 256]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filetransfer import Transfer, TransferOptions  # noqa: E402
+from filetransfer.profiler import NULL_PROFILER, PhaseProfiler  # noqa: E402
+
+
+def make_tree(root, small_count, small_size, large_mb):
+    os.makedirs(os.path.join(root, "small"))
+    block = os.urandom(1024 * 1024)
+    for i in range(small_count):
+        with open(os.path.join(root, "small", f"file{i:06d}.bin"), "wb") as f:
+            f.write(block[:small_size])
+    with open(os.path.join(root, "large.bin"), "wb") as f:
+        for _ in range(large_mb):
+            f.write(block)
+
+
+def timed_copy(source, dest, options):
+    shutil.rmtree(dest, ignore_errors=True)
+    if hasattr(os, "sync"):
+        os.sync()
+    start = time.perf_counter()
+    summary = Transfer(source, dest, options).run()
+    elapsed = time.perf_counter() - start
+    if not summary.ok:
+        raise SystemExit(f"copy failed: {summary.failures[:3]}")
+    return elapsed
+
+
+def lap_cost(samples=1000000):
+    """ns per profiler.lap() call on one thread"""
+    profiler = PhaseProfiler()
+    profiler.begin_file(0)
+    start = time.perf_counter_ns()
+    t = profiler.clock()
+    for _ in range(samples):
+        t = profiler.lap("read", t)
+    return (time.perf_counter_ns() - start) / samples
+
+
+def phase_cost(profiler, samples=1000000):
+    """ns per empty ``with profiler.phase()`` block on one thread"""
+    profiler.begin_file(0)
+    start = time.perf_counter_ns()
+    for _ in range(samples):
+        with profiler.phase("read"):
+            pass
+    return (time.perf_counter_ns() - start) / samples
+
+
+def run(workdir, small_count, small_size, large_mb, repeat, workers):
+    source = os.path.join(workdir, "src")
+    make_tree(source, small_count, small_size, large_mb)
+    print(f"one lap: {lap_cost():.0f} ns, one phase: {phase_cost(PhaseProfiler()):.0f} ns, "
+          f"{phase_cost(NULL_PROFILER):.0f} ns with profiling off")
+    cases = (("off", {}), ("profile", {"profile": True}), ("trace", {"trace": True}))
+    best = {}
+    for _ in range(repeat):
+        for label, extra in cases:
+            options = TransferOptions(resume=False, adaptive_chunks=False, reflink=False, workers=workers, **extra)
+            elapsed = timed_copy(source, os.path.join(workdir, "dst"), options)
+            best[label] = min(best.get(label, elapsed), elapsed)
+    print(f"{'case':<10} {'sec':>8} {'files/s':>9} {'overhead':>9}")
+    for label, _ in cases:
+        elapsed = best[label]
+        print(f"{label:<10} {elapsed:>8.3f} {(small_count + 1) / elapsed:>9.0f} {elapsed / best['off'] - 1:>9.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="directory for the test trees (default: a temp dir)")
+    parser.add_argument("--small", type=int, default=5000, help="number of small files")
+    parser.add_argument("--small-size", type=int, default=4096, help="size of each small file in bytes")
+    parser.add_argument("--large-mb", type=int, default=256, help="size of the large file")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the best one is reported")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker threads (default: per device)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_profiler_", dir=args.dir)
+    try:
+        run(workdir, args.small, args.small_size, args.large_mb, args.repeat, args.workers)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
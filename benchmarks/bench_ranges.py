@@ -0,0 +1,91 @@
+"""Compare parallel range copies against the sequential copy_file path.
+
+Usage: python benchmarks/bench_ranges.py [--dir DIR] [--sizes 64,256,1024] [--ranges 1,2,4,8]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filetransfer.engine import copy_file, select_engines  # noqa: E402
+from filetransfer.ranges import copy_file_ranges  # noqa: E402
+
+
+def make_file(path, size_mb):
+    """Write ``size_mb`` MB of random data without holding it all in memory"""
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def drop_cache(path):
+    """Ask the kernel to forget cached pages of ``path`` so reads hit the device"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def timed(fn, src, dst):
+    drop_cache(src)
+    start = time.perf_counter()
+    fn(src, dst)
+    fd = os.open(dst, os.O_RDONLY)
+    try:
+        os.fsync(fd)  # count the time to get the data onto the device
+    finally:
+        os.close(fd)
+    elapsed = time.perf_counter() - start
+    os.remove(dst)
+    return elapsed
+
+
+def run(workdir, sizes, range_counts, repeat):
+    print(f"{'size MB':>8} {'method':<24} {'MB/s':>9} {'sec':>8}")
+    for size_mb in sizes:
+        src = os.path.join(workdir, f"src_{size_mb}.bin")
+        dst = os.path.join(workdir, "dst.bin")
+        make_file(src, size_mb)
+
+        candidates = [
+            ("sequential", lambda s, d: copy_file(s, d, reflink=False)),
+            ("sequential readinto", lambda s, d: copy_file(s, d, engines=select_engines("readinto"), reflink=False)),
+        ]
+        for count in range_counts:
+            # min_range_size=0 so small sizes still get split and the curve is visible
+            candidates.append((f"ranges x{count}",
+                               lambda s, d, c=count: copy_file_ranges(s, d, c, min_range_size=0)))
+
+        for label, fn in candidates:
+            best = min(timed(fn, src, dst) for _ in range(repeat))
+            print(f"{size_mb:>8} {label:<24} {size_mb / best:>9.1f} {best:>8.3f}")
+        os.remove(src)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="directory on the device to test (default: a temp dir)")
+    parser.add_argument("--sizes", default="64,256,1024", help="file sizes in MB, comma separated")
+    parser.add_argument("--ranges", default="1,2,4,8", help="range counts, comma separated")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the best one is reported")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_ranges_", dir=args.dir)
+    try:
+        run(workdir,
+            [int(s) for s in args.sizes.split(",")],
+            [int(r) for r in args.ranges.split(",")],
+            args.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,229 @@
+"""Disk/USB benchmark suite with machine-readable results.
+
+Grown from OLD_VERS/usb_speed_test.py and OLD_VERS/usbspeed.py. It measures:
+
+  * sequential write and read per chunk size, bypassing the page cache with
+    O_DIRECT where the filesystem allows it (fsync + fadvise(DONTNEED) otherwise)
+  * small-file create rate at several concurrency levels
+  * 4 KB random reads at several concurrency levels
+  * the app's copy engines against shutil.copyfile, so regressions in the
+    copy path show up as numbers
+
+Usage:
+  python benchmarks/disk_suite.py DIR [--size 256] [--output results.json]
+  python benchmarks/disk_suite.py DIR --baseline old.json [--tolerance 0.15]
+
+With --baseline the exit code is 1 when any result got slower than the
+tolerance allows.
+"""
+import argparse
+import json
+import mmap
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filetransfer.calibrate import _drop_cache as drop_cache  # noqa: E402
+from filetransfer.devices import _sysfs_block_dir, device_id, device_kind  # noqa: E402
+from filetransfer.engine import ENGINES, copy_file  # noqa: E402
+from filetransfer.ranges import copy_file_ranges  # noqa: E402
+
+MB = 1024 * 1024
+CHUNK_SIZES = (64 * 1024, MB, 4 * MB, 16 * MB)
+CONCURRENCY = (1, 4, 16)
+O_DIRECT = getattr(os, "O_DIRECT", 0)
+ALIGN = 4096
+
+
+def usb_link_speed(path):
+    """USB link speed in Mbit/s of the stick holding ``path``, from sysfs (None if not USB)"""
+    dev_dir = _sysfs_block_dir(path)
+    while dev_dir and dev_dir != "/":
+        speed_file = os.path.join(dev_dir, "speed")
+        if "/usb" in dev_dir and os.path.exists(speed_file):
+            with open(speed_file) as f:
+                return float(f.read().strip())
+        dev_dir = os.path.dirname(dev_dir)
+    return None
+
+
+def device_info(path):
+    return {
+        "path": os.path.abspath(path),
+        "device": device_id(path),
+        "kind": device_kind(path),
+        "usb_mbps": usb_link_speed(path),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+    }
+
+
+def open_direct(path, flags):
+    """Open with O_DIRECT when the filesystem supports it, return (fd, bypass method)"""
+    if O_DIRECT:
+        try:
+            return os.open(path, flags | O_DIRECT, 0o644), "o_direct"
+        except OSError:
+            pass
+    return os.open(path, flags, 0o644), "fsync+fadvise"
+
+
+def seq_write(path, size, chunk_size):
+    buf = mmap.mmap(-1, chunk_size)  # page aligned, as O_DIRECT wants
+    buf.write(os.urandom(chunk_size))
+    fd, bypass = open_direct(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    start = time.perf_counter()
+    try:
+        for _ in range(size // chunk_size):
+            os.write(fd, buf)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    elapsed = time.perf_counter() - start
+    buf.close()
+    return size / MB / elapsed, bypass
+
+
+def seq_read(path, chunk_size):
+    buf = mmap.mmap(-1, chunk_size)
+    drop_cache(path)
+    fd, bypass = open_direct(path, os.O_RDONLY)
+    total = 0
+    start = time.perf_counter()
+    try:
+        while n := os.readv(fd, [buf]):
+            total += n
+    finally:
+        os.close(fd)
+    elapsed = time.perf_counter() - start
+    buf.close()
+    return total / MB / elapsed, bypass
+
+
+def small_files(workdir, count, file_size, concurrency):
+    target = os.path.join(workdir, f"small_{concurrency}")
+    os.makedirs(target)
+    data = os.urandom(file_size)
+
+    def create(i):
+        with open(os.path.join(target, f"{i}.bin"), "wb") as f:
+            f.write(data)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(create, range(count)))
+    if hasattr(os, "sync"):
+        os.sync()  # the creates aren't done until the metadata is on the device
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(target)
+    return count / elapsed
+
+
+def random_reads(path, size, concurrency, reads=2000):
+    drop_cache(path)
+    fd, bypass = open_direct(path, os.O_RDONLY)
+    blocks = size // ALIGN
+    rng = random.Random(concurrency)
+    offsets = [rng.randrange(blocks) * ALIGN for _ in range(reads)]
+
+    def read_some(chunk):
+        buf = mmap.mmap(-1, ALIGN)
+        for offset in chunk:
+            os.preadv(fd, [buf], offset)
+        buf.close()
+
+    chunks = [offsets[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(read_some, chunks))
+    finally:
+        os.close(fd)
+    return reads / (time.perf_counter() - start), bypass
+
+
+def copy_engines(src, dst, size):
+    """MB/s of every copy path the app has, plus shutil.copyfile as the yardstick"""
+    candidates = {"shutil.copyfile": lambda: shutil.copyfile(src, dst)}
+    for cls in ENGINES:
+        engine = cls()
+        if engine.available():
+            candidates[f"engine:{engine.name}"] = lambda e=engine: copy_file(src, dst, engines=[e], reflink=False)
+    if hasattr(os, "pwrite"):
+        candidates["ranges x4"] = lambda: copy_file_ranges(src, dst, 4, min_range_size=0)
+    results = {}
+    for name, fn in candidates.items():
+        drop_cache(src)
+        start = time.perf_counter()
+        fn()
+        drop_cache(dst)  # includes the fsync, so the write has really happened
+        results[name] = size / MB / (time.perf_counter() - start)
+        os.remove(dst)
+    return results
+
+
+def run_suite(directory, size_mb, small_count):
+    workdir = tempfile.mkdtemp(prefix="disk_suite_", dir=directory)
+    size = size_mb * MB
+    results = {"device": device_info(directory), "size_mb": size_mb, "tests": {}}
+    tests = results["tests"]
+    try:
+        data_file = os.path.join(workdir, "seq.bin")
+        for chunk_size in CHUNK_SIZES:
+            label = f"{chunk_size // 1024}k"
+            tests[f"seq_write_mbps/{label}"], bypass = seq_write(data_file, size, chunk_size)
+            tests[f"seq_read_mbps/{label}"], _ = seq_read(data_file, chunk_size)
+            results["cache_bypass"] = bypass
+        for concurrency in CONCURRENCY:
+            tests[f"small_files_per_sec/4k/c{concurrency}"] = small_files(workdir, small_count, 4096, concurrency)
+            tests[f"random_read_iops/4k/c{concurrency}"], _ = random_reads(data_file, size, concurrency)
+        for name, speed in copy_engines(data_file, os.path.join(workdir, "copy.bin"), size).items():
+            tests[f"copy_mbps/{name}"] = speed
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the tests that got slower than ``baseline`` by more than ``tolerance``"""
+    regressions = []
+    for name, value in results["tests"].items():
+        old = baseline.get("tests", {}).get(name)
+        if old and value < old * (1 - tolerance):
+            regressions.append((name, old, value))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dir", help="directory on the device to test")
+    parser.add_argument("--size", type=int, default=256, help="test file size in MB")
+    parser.add_argument("--small-files", type=int, default=2000, help="files per small-file run")
+    parser.add_argument("--output", help="write the JSON results here (default: stdout)")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown before flagging, 0.15 = 15%%")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        parser.error(f"{args.dir} is not a directory")
+    results = run_suite(args.dir, args.size, args.small_files)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old:.1f} -> {new:.1f}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Stand-in for the ``adb`` executable, backed by a local directory.
+
+Understands exactly the commands filetransfer.adb issues: ``push``,
+``pull [-a]``, and the device commands it runs through ``exec-in`` and
+``exec-out`` (``command -v tar``, ``mkdir -p``, ``find ... -exec stat``,
+``tar -c``/``tar -x``). Device paths are mapped under $FAKE_ADB_ROOT.
+
+$FAKE_ADB_DELAY (seconds, default 0) is slept on every launch, to stand in
+for adb's process start and USB handshake, which is what batching saves.
+Set $FAKE_ADB_NO_TAR=1 to play a device without tar.
+
+Usage: ADB=benchmarks/fake_adb.py python -m filetransfer adb push ...
+   or: python -m filetransfer adb --adb benchmarks/fake_adb.py push ...
+"""
+import os
+import shlex
+import shutil
+import sys
+import tarfile
+import time
+
+ROOT = os.environ.get("FAKE_ADB_ROOT", os.path.join(os.getcwd(), "fake_device"))
+
+
+def local(path):
+    """Where device path ``path`` lives on this machine"""
+    return os.path.join(ROOT, os.path.normpath("/" + path).lstrip("/"))
+
+
+def fail(message):
+    sys.stderr.write(f"adb: error: {message}\n")
+    sys.exit(1)
+
+
+def copy_into(src, dst_dir, keep_times):
+    target = os.path.join(dst_dir, os.path.basename(src.rstrip("/")))
+    if os.path.isdir(src):
+        shutil.copytree(src, target, copy_function=shutil.copy2 if keep_times else shutil.copy, dirs_exist_ok=True)
+    else:
+        (shutil.copy2 if keep_times else shutil.copy)(src, target)
+
+
+def push(args):
+    if len(args) < 2:
+        fail("push requires an argument")
+    *sources, dest = args
+    dest = local(dest)
+    if len(sources) > 1 and not os.path.isdir(dest):
+        fail(f"target '{dest}' is not a directory")
+    for src in sources:
+        if not os.path.exists(src):
+            fail(f"cannot stat '{src}': No such file or directory")
+        if os.path.isdir(dest):
+            copy_into(src, dest, True)
+        else:
+            shutil.copy2(src, dest)
+    print(f"{len(sources)} files pushed.")
+
+
+def pull(args):
+    keep_times = args[:1] == ["-a"]
+    args = args[1:] if keep_times else args
+    if len(args) < 2:
+        fail("pull requires an argument")
+    *sources, dest = args
+    for src in sources:
+        path = local(src)
+        if not os.path.exists(path):
+            fail(f"remote object '{src}' does not exist")
+        copy_into(path, dest, keep_times)
+    print(f"{len(sources)} files pulled.")
+
+
+def device_command(command):
+    """Run one device command line, as ``adb exec-in/exec-out`` would"""
+    for part in command.split(" && "):
+        argv = shlex.split(part)
+        name = argv[0]
+        if name == "command" and argv[1:2] == ["-v"]:
+            if argv[2] == "tar" and os.environ.get("FAKE_ADB_NO_TAR"):
+                sys.exit(1)
+            print(f"/system/bin/{argv[2]}")
+        elif name == "mkdir":
+            os.makedirs(local(argv[-1]), exist_ok=True)
+        elif name == "find":
+            find(argv[1])
+        elif name == "tar" and "-x" in argv:
+            extract(local(argv[argv.index("-C") + 1]))
+        elif name == "tar" and "-c" in argv:
+            create(local(argv[argv.index("-C") + 1]), argv[argv.index("-C") + 2:])
+        else:
+            fail(f"fake adb doesn't know {part!r}")
+
+
+def find(top):
+    path = local(top)
+    if not os.path.exists(path):
+        sys.stderr.write(f"find: {top}: No such file or directory\n")
+        sys.exit(1)
+    walk = [(os.path.dirname(path), [], [os.path.basename(path)])] if os.path.isfile(path) else os.walk(path)
+    out = sys.stdout
+    for dirpath, _, filenames in walk:
+        for name in filenames:
+            st = os.stat(os.path.join(dirpath, name))
+            device_path = "/" + os.path.relpath(os.path.join(dirpath, name), ROOT).replace(os.sep, "/")
+            out.write(f"{st.st_size} {int(st.st_mtime)} {device_path}\n")
+
+
+def extract(dest):
+    with tarfile.open(fileobj=sys.stdin.buffer, mode="r|") as archive:
+        if hasattr(tarfile, "data_filter"):
+            archive.extractall(dest, filter="fully_trusted")  # a device's tar doesn't filter either
+        else:
+            archive.extractall(dest)
+
+
+def create(parent, names):
+    with tarfile.open(fileobj=sys.stdout.buffer, mode="w|") as archive:
+        for name in names:
+            archive.add(os.path.join(parent, name), arcname=name)
+
+
+def main(argv):
+    time.sleep(float(os.environ.get("FAKE_ADB_DELAY", "0")))
+    if argv[:1] == ["-s"]:
+        argv = argv[2:]
+    if not argv:
+        fail("no command")
+    verb, args = argv[0], argv[1:]
+    if verb == "push":
+        push(args)
+    elif verb == "pull":
+        pull(args)
+    elif verb in ("exec-in", "exec-out", "shell"):
+        device_command(" ".join(args))
+    else:
+        fail(f"unknown command {verb}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,26 @@
+"""Transfer engine used by the File Transfer Application.
+
+Importing this package never loads tkinter, so it works on servers and from
+cron; ``python -m filetransfer`` is the command line front end.
+"""
+
+from .api import Transfer, TransferOptions, transfer
+from .engine import CHUNK_SIZE, CopyResult, copy_file, select_engines
+from .scanner import TransferJob, TreeScanner, plan_sources, plan_tree
+from .scheduler import TransferScheduler, TransferSummary
+
+__all__ = [
+    "CHUNK_SIZE",
+    "CopyResult",
+    "Transfer",
+    "TransferJob",
+    "TransferOptions",
+    "TransferScheduler",
+    "TransferSummary",
+    "TreeScanner",
+    "copy_file",
+    "plan_sources",
+    "plan_tree",
+    "select_engines",
+    "transfer",
+]
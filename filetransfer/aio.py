@@ -0,0 +1,167 @@
+"""asyncio core that runs any number of transfers side by side.
+
+Each transfer's batches become tasks; the blocking copy work runs on a
+shared thread pool. Destinations on the same device share one semaphore
+sized for that device, and asyncio semaphores wake waiters in FIFO order,
+so two transfers to the same stick take turns instead of one starving the
+other. Cancelling a transfer's task (or the whole core) stops the workers
+at their next chunk, waits for them to checkpoint, and only then closes
+the journal, so a cancelled run can always be resumed.
+
+The GUI uses BackgroundCore, which keeps the event loop on its own thread;
+the CLI runs TransferCore under asyncio.run().
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .devices import default_workers, device_id
+from .scheduler import batch_jobs
+
+MAX_THREADS = 32
+
+
+async def _wait_out(future):
+    """Wait for ``future`` to finish even if we are cancelled meanwhile, then pass the cancel on"""
+    cancelled = False
+    while not future.done():
+        try:
+            await asyncio.wait([future])
+        except asyncio.CancelledError:
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError()
+    return future.result()
+
+
+class TransferCore:
+    """Runs transfers as asyncio tasks over one thread pool"""
+
+    def __init__(self, max_threads=MAX_THREADS):
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="transfer")
+        self._device_slots = {}  # device id -> asyncio.Semaphore, shared by every transfer
+
+    def _blocking(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _slots_for(self, path, workers):
+        key = device_id(path)
+        if key not in self._device_slots:
+            self._device_slots[key] = asyncio.Semaphore(workers or default_workers(path))
+        return self._device_slots[key]
+
+    async def run(self, transfer, on_progress=None, on_file_start=None, on_file_done=None):
+        """Copy everything ``transfer`` covers and return its TransferSummary.
+
+        Cancelling the task cancels the transfer: it returns once every
+        worker has stopped and the journal is saved, raising CancelledError.
+        """
+        scheduler = await self._blocking(transfer.open, on_progress, on_file_start, on_file_done)
+        try:
+            await self._drive(transfer, scheduler)
+        except asyncio.CancelledError:
+            transfer.cancel()
+            raise
+        finally:
+            scheduler.summary.cancelled = scheduler.cancelled()
+            # Closing waits for read-backs and writes the journal; don't let a
+            # second cancel cut that short
+            await _wait_out(self._blocking(transfer.close))
+        return transfer.summary
+
+    async def _drive(self, transfer, scheduler):
+        device = self._slots_for(transfer.dest, transfer.options.workers)
+        # Only a few batches queued per transfer, so waiters on a shared
+        # device interleave fairly and a huge tree never sits in memory
+        queued = asyncio.Semaphore(scheduler.workers * 2)
+        batches = batch_jobs(transfer.scanner, scheduler.small_file_size)
+        running = set()
+        try:
+            while not scheduler.cancelled():
+                batch = await self._blocking(next, batches, None)
+                if batch is None:
+                    break
+                await queued.acquire()
+                task = asyncio.ensure_future(self._run_batch(scheduler, batch, device, queued))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            if running:
+                await asyncio.gather(*running)
+        finally:
+            # On cancel (or an error in one batch) stop the rest, and don't
+            # return before every one of them has wound down
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    async def _run_batch(self, scheduler, batch, device, queued):
+        try:
+            async with device:
+                work = self._blocking(scheduler.run_batch, batch)
+                try:
+                    await asyncio.shield(work)
+                except asyncio.CancelledError:
+                    # The thread can't be interrupted mid-syscall; tell it to
+                    # stop at the next chunk and wait for that to happen
+                    scheduler.cancel()
+                    await _wait_out(work)
+                    raise
+        finally:
+            queued.release()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class BackgroundCore:
+    """A TransferCore with its event loop on a daemon thread, for callers that have their own loop (Tk)"""
+
+    def __init__(self, max_threads=MAX_THREADS):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="transfer-core", daemon=True)
+        self._thread.start()
+        self.core = TransferCore(max_threads)
+        self._tasks = {}  # Transfer -> its task, only touched on the loop's thread
+
+    def submit(self, transfer, on_progress=None, on_file_start=None, on_file_done=None, on_done=None):
+        """Start ``transfer`` on the core's loop.
+
+        ``on_done(summary, error)`` is called from the loop's thread once the
+        transfer is over, cancelled ones included, after everything is saved.
+        """
+        def start():
+            task = self.loop.create_task(self.core.run(transfer, on_progress, on_file_start, on_file_done))
+            self._tasks[transfer] = task
+            task.add_done_callback(functools.partial(self._finished, transfer, on_done))
+
+        self.loop.call_soon_threadsafe(start)
+
+    def cancel(self, transfer):
+        """Cancel ``transfer``; its ``on_done`` still follows once it has stopped"""
+        transfer.cancel()  # the workers see this at their next chunk, even before the task is cancelled
+
+        def cancel():
+            task = self._tasks.get(transfer)
+            if task is not None:
+                task.cancel()
+
+        self.loop.call_soon_threadsafe(cancel)
+
+    @property
+    def busy(self):
+        return bool(self._tasks)
+
+    def _finished(self, transfer, on_done, task):
+        del self._tasks[transfer]
+        error = None
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+        if on_done is not None:
+            on_done(transfer.summary, error)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.core.close()
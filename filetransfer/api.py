@@ -0,0 +1,195 @@
+"""Programmatic entry point to the transfer engine.
+
+    from filetransfer import Transfer, TransferOptions
+
+    summary = Transfer("photos", "/media/usb/photos", TransferOptions(sync=True)).run()
+
+A list of sources, files and directories mixed, is one transfer into the
+destination directory, with one byte total and all items copied side by side.
+
+Nothing here imports tkinter; the GUI and the CLI are both clients of this module.
+"""
+import os
+import threading
+
+from .cache import WRITEBACK_BYTES, FsyncBatcher
+from .compress import Compressor
+from .delta import DEFAULT_BLOCK_SIZE
+from .journal import TransferJournal
+from .pack import Packer
+from .profiler import PhaseProfiler
+from .ranges import DEFAULT_RANGES
+from .scanner import TreeScanner
+from .scheduler import TransferScheduler
+from .sync import SyncManifest
+from .throttle import TokenBucket
+from .tuning import ChunkTuner
+from .verify import DEFAULT_ALGORITHM, Verifier
+
+
+class TransferOptions:
+    """Knobs for one transfer, the defaults match the GUI's"""
+
+    def __init__(self, workers=None, split_large=False, range_count=DEFAULT_RANGES, sync=False,
+                 checksum=False, delta=None, delta_block_size=DEFAULT_BLOCK_SIZE, resume=True,
+                 adaptive_chunks=True, verify=False, hash_algorithm=DEFAULT_ALGORITHM, compress=None,
+                 compress_level=None, decompress=False, pack=False, write_behind=WRITEBACK_BYTES,
+                 fsync_files=None, fsync_bytes=None, bandwidth_limit=None, reflink=True, profile=False,
+                 trace=False):
+        self.workers = workers                  # None: pick from the destination device
+        self.split_large = split_large          # copy large files as parallel byte ranges
+        self.range_count = range_count
+        self.sync = sync                        # skip files unchanged since the last run
+        self.checksum = checksum                # sync compares content digests too
+        self.delta = sync if delta is None else delta  # patch changed large files block by block
+        self.delta_block_size = delta_block_size
+        self.resume = resume                    # keep a journal so an interrupted run can resume
+        self.adaptive_chunks = adaptive_chunks  # tune the chunk size per device pair and remember it
+        self.verify = verify                    # hash while copying, read back and compare
+        self.hash_algorithm = hash_algorithm    # "blake2b", "sha256", or "xxh64"/"xxh3_128" with xxhash
+        self.compress = compress                # codec name: store compressible files as .ftz containers
+        self.compress_level = compress_level    # None: the codec's default
+        self.decompress = decompress            # expand .ftz containers found in the source
+        self.pack = pack                        # append small files to a tar pack, see pack.unpack()
+        self.write_behind = write_behind        # write back and uncache every this many bytes (0 = off)
+        self.fsync_files = fsync_files          # fsync finished files in batches of this many...
+        self.fsync_bytes = fsync_bytes          # ...or this many bytes, whichever comes first
+        self.bandwidth_limit = bandwidth_limit  # bytes per second for the whole transfer (None = unlimited)
+        self.reflink = reflink                  # clone instead of copying on btrfs/XFS, when both ends share one
+        self.profile = profile                  # time every phase of the copy, see Transfer.profiler
+        self.trace = trace                      # ...and keep a timeline of it (implies profile)
+
+
+def destination_root(src, dest):
+    """The directory ``src`` is mirrored into, where the manifest and journal live"""
+    if not isinstance(src, str):
+        return dest  # a list of sources always goes into the directory ``dest``
+    return dest if os.path.isdir(src) or os.path.isdir(dest) else os.path.dirname(dest) or os.curdir
+
+
+class Transfer:
+    """One source -> destination transfer.
+
+    ``total_bytes`` and ``total_files`` grow while the source is scanned and
+    ``summary`` fills in while ``run()`` copies. ``cancel()`` may be called
+    from any thread.
+    """
+
+    def __init__(self, source, dest, options=None):
+        self.source = source  # a path, or a list of paths copied into the directory ``dest``
+        self.sources = [source] if isinstance(source, str) else list(source)
+        self.dest = dest
+        self.options = options or TransferOptions()
+        self.scanner = None
+        self.summary = None
+        self.estimator = None  # TransferEstimator, once open() has run
+        self.profiler = None   # PhaseProfiler, once open() has run with options.profile or options.trace
+        self._parts = None
+        self._cancel = threading.Event()
+
+    @property
+    def total_bytes(self):
+        return self.scanner.total_bytes if self.scanner is not None else 0
+
+    @property
+    def total_files(self):
+        return self.scanner.total_files if self.scanner is not None else 0
+
+    def estimate(self):
+        """Progress, speeds and ETA against the planned totals (an estimate.Estimate), or None before the start"""
+        if self.estimator is None:
+            return None
+        return self.estimator.estimate(self.total_bytes, self.total_files, self.scanner.total_holes)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def open(self, on_progress=None, on_file_start=None, on_file_done=None):
+        """Set up the journal, manifest and friends, start the scan and return the scheduler.
+
+        ``run()`` does this for you; the asyncio core (aio.TransferCore) calls
+        ``open()`` and ``close()`` itself and drives the scheduler's batches.
+        """
+        if not self.sources:
+            raise ValueError("No sources to copy")
+        if isinstance(self.source, str) and not os.path.exists(self.source):
+            raise FileNotFoundError(f"Source does not exist: {self.source}")
+        options = self.options
+        root = destination_root(self.source, self.dest)
+        parts = self._parts = {}
+        parts["journal"] = TransferJournal(root) if options.resume else None
+        parts["sync"] = SyncManifest(root, checksum=options.checksum) if options.sync else None
+        parts["tuner"] = ChunkTuner(self.sources[0], root) if options.adaptive_chunks else None
+        parts["verifier"] = Verifier(root, options.hash_algorithm) if options.verify else None
+        parts["compressor"] = Compressor(options.compress, options.compress_level) if options.compress else None
+        parts["packer"] = Packer(root) if options.pack else None
+        parts["fsync_batcher"] = None
+        if options.fsync_files or options.fsync_bytes:
+            parts["fsync_batcher"] = FsyncBatcher(options.fsync_files, options.fsync_bytes)
+        parts["throttle"] = TokenBucket(options.bandwidth_limit) if options.bandwidth_limit else None
+        parts["profiler"] = None
+        if options.profile or options.trace:
+            parts["profiler"] = PhaseProfiler(trace=options.trace)
+        self.profiler = parts["profiler"]
+        self.scanner = TreeScanner(self.source if isinstance(self.source, str) else self.sources, self.dest,
+                                   parts["profiler"]).start()
+        scheduler = TransferScheduler(
+            self.dest,
+            workers=options.workers,
+            on_progress=on_progress,
+            on_file_start=on_file_start,
+            on_file_done=on_file_done,
+            is_cancelled=self.cancelled,
+            range_count=options.range_count if options.split_large else 1,
+            delta_block_size=options.delta_block_size if options.delta else 0,
+            decompress=options.decompress,
+            write_behind=options.write_behind,
+            reflink=options.reflink,
+            **parts,
+        )
+        self.summary = scheduler.summary
+        self.estimator = scheduler.estimator
+        return scheduler
+
+    def close(self):
+        """Flush and close everything ``open()`` set up, once the copying has stopped"""
+        parts = self._parts
+        self.scanner.stop()
+        if parts["compressor"] is not None:
+            parts["compressor"].close()
+        if parts["packer"] is not None:
+            parts["packer"].close()
+        if parts["fsync_batcher"] is not None:
+            parts["fsync_batcher"].flush()
+        if parts["verifier"] is not None:
+            # Read-backs still in flight can turn into failures, wait for them
+            parts["verifier"].close()
+        if parts["sync"] is not None:
+            parts["sync"].close()
+        if parts["tuner"] is not None:
+            parts["tuner"].save()
+        self.summary.failures.extend(self.scanner.errors)
+        if parts["journal"] is not None:
+            # Keep the journal after a cancel or failure so the next run can resume
+            parts["journal"].close(finished=self.summary.ok)
+
+    def run(self, on_progress=None, on_file_start=None, on_file_done=None):
+        """Copy everything and return the TransferSummary.
+
+        ``on_progress(bytes_done)`` and ``on_file_start(job)`` are called from
+        worker threads, often; hand them to a ProgressChannel if a UI needs them.
+        """
+        scheduler = self.open(on_progress, on_file_start, on_file_done)
+        try:
+            scheduler.run(self.scanner)
+        finally:
+            self.close()
+        return self.summary
+
+
+def transfer(source, dest, options=None, on_progress=None, on_file_start=None, on_file_done=None):
+    """Shortcut for ``Transfer(source, dest, options).run(...)``"""
+    return Transfer(source, dest, options).run(on_progress, on_file_start, on_file_done)
@@ -0,0 +1,79 @@
+"""Measure a device pair and seed the chunk size cache.
+
+This grew out of OLD_VERS/usb_speed_test.py: the test file is streamed to
+disk instead of built in RAM, the page cache is flushed around each copy so
+we time the device rather than memory, and the copy runs through the real
+engine once per candidate chunk size.
+"""
+import os
+import tempfile
+import time
+
+from .engine import CHUNK_SIZE, FixedChunkSize, copy_file
+from .tuning import ChunkSizeCache
+
+CALIBRATION_SIZES = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+TEST_FILE_NAME = "temp_test_file.bin"
+SCRATCH_PREFIX = ".filetransfer-calibrate-"
+
+
+def _drop_cache(path):
+    """Flush ``path`` and ask the kernel to forget its pages"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _timed_copy(src, dst, chunk_size):
+    _drop_cache(src)
+    start = time.perf_counter()
+    copy_file(src, dst, chunk_controller=FixedChunkSize(chunk_size), reflink=False)
+    fd = os.open(dst, os.O_RDONLY)
+    try:
+        os.fsync(fd)  # the write isn't done until it's on the device
+    finally:
+        os.close(fd)
+    return time.perf_counter() - start
+
+
+def measure_speed(source_path, dest_path, file_size_mb=64, chunk_size=CHUNK_SIZE):
+    """Measure the write and read speed between two directories, in MB/s
+
+    The test file lives in a scratch directory of its own on each side, so
+    nothing of the user's is overwritten and an interrupted run leaves only
+    a hidden directory behind.
+    """
+    with tempfile.TemporaryDirectory(prefix=SCRATCH_PREFIX, dir=source_path) as source_scratch, \
+            tempfile.TemporaryDirectory(prefix=SCRATCH_PREFIX, dir=dest_path) as dest_scratch:
+        temp_file = os.path.join(source_scratch, TEST_FILE_NAME)
+        copied_file = os.path.join(dest_scratch, TEST_FILE_NAME)
+        block = os.urandom(1024 * 1024)
+        with open(temp_file, "wb") as f:
+            for _ in range(file_size_mb):
+                f.write(block)
+        write_speed = file_size_mb / _timed_copy(temp_file, copied_file, chunk_size)
+        os.remove(temp_file)
+        read_speed = file_size_mb / _timed_copy(copied_file, temp_file, chunk_size)
+    return write_speed, read_speed
+
+
+def calibrate(source_path, dest_path, sizes=CALIBRATION_SIZES, file_size_mb=64, cache=None, report=print):
+    """Time a copy at each chunk size, remember the fastest for this device pair and return it"""
+    if os.path.isfile(source_path):
+        source_path = os.path.dirname(source_path) or os.curdir
+    os.makedirs(dest_path, exist_ok=True)
+    cache = cache if cache is not None else ChunkSizeCache()
+    best_size, best_speed = None, 0
+    for size in sizes:
+        write_speed, read_speed = measure_speed(source_path, dest_path, file_size_mb, size)
+        if report is not None:
+            report(f"chunk {size // 1024:>6} KB: write {write_speed:8.2f} MB/s, read {read_speed:8.2f} MB/s")
+        if write_speed > best_speed:
+            best_size, best_speed = size, write_speed
+    cache.set(source_path, dest_path, best_size)
+    cache.save()
+    return best_size
@@ -0,0 +1,450 @@
+"""Command line front end: python -m filetransfer SOURCE... DEST [options]
+
+Several sources, or ``--from LIST`` (``-`` for stdin, e.g. the output of
+``find -print0``), are copied side by side into the directory DEST as one
+transfer.
+
+``python -m filetransfer --unpack DIR [DEST]`` restores the files a
+``--pack`` run bundled into DIR.
+
+``--profile FILE`` and ``--trace FILE`` time every phase of the copy and
+save the histograms and a timeline, see profiler.py.
+
+``python -m filetransfer serve DIR`` receives files over the network and
+``python -m filetransfer send SOURCE... HOST[:PORT]`` sends them, see net.py.
+
+``python -m filetransfer adb push SOURCE... REMOTE_DIR`` and ``adb pull
+REMOTE... LOCAL_DIR`` copy to and from an Android device, see adb.py.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tarfile
+import threading
+
+from . import adb
+from .aio import TransferCore
+from .api import Transfer, TransferOptions, destination_root
+from .cache import WRITEBACK_BYTES
+from .calibrate import calibrate
+from .compress import CODECS, DEFAULT_CODEC
+from .estimate import MB, TransferEstimator, format_duration
+from .jobqueue import (CANCELLED, CANCELLING, DONE, FAILED, MAX_PER_DEVICE, MAX_RUNNING, QUEUED, RUNNING,
+                       JobQueue, QueueRunner, default_queue_path)
+from .net import DEFAULT_PORT, DEFAULT_STREAMS, Receiver, parse_address, send
+from .pack import unpack
+from .ranges import DEFAULT_RANGES
+from .scanner import read_path_list
+from .verify import DEFAULT_ALGORITHM, HASH_ALGORITHMS
+
+EXIT_OK = 0
+EXIT_FAILED = 1      # some files could not be copied
+EXIT_USAGE = 2       # argparse uses this too
+EXIT_CANCELLED = 130  # interrupted with Ctrl-C, like a shell would report SIGINT
+
+REFRESH_SECONDS = 0.2
+
+
+def add_transfer_arguments(parser):
+    """The options of one transfer, shared by a plain run and ``queue add``"""
+    parser.add_argument("-j", "--workers", type=int, help="files copied at once (default: based on the destination)")
+    parser.add_argument("--split-large", action="store_true", help="copy large files as parallel byte ranges")
+    parser.add_argument("--ranges", type=int, default=DEFAULT_RANGES,
+                        help=f"byte ranges per large file with --split-large (default {DEFAULT_RANGES})")
+    parser.add_argument("--sync", action="store_true", help="only copy new or changed files")
+    parser.add_argument("--checksum", action="store_true", help="with --sync, also compare file contents")
+    parser.add_argument("--no-delta", action="store_true", help="with --sync, rewrite changed files completely")
+    parser.add_argument("--no-resume", action="store_true", help="don't keep a journal for resuming")
+    parser.add_argument("--fixed-chunks", action="store_true", help="don't adapt the chunk size during the copy")
+    parser.add_argument("--verify", action="store_true", help="hash while copying and read every copy back")
+    parser.add_argument("--hash", choices=sorted(HASH_ALGORITHMS), default=DEFAULT_ALGORITHM, metavar="ALGO",
+                        help=f"hash for --verify ({', '.join(sorted(HASH_ALGORITHMS))}; default {DEFAULT_ALGORITHM})")
+    parser.add_argument("--compress", action="store_true",
+                        help="store compressible files as .ftz containers, for slow links")
+    parser.add_argument("--codec", choices=sorted(CODECS), default=DEFAULT_CODEC,
+                        help=f"codec for --compress ({', '.join(sorted(CODECS))}; default {DEFAULT_CODEC})")
+    parser.add_argument("--level", type=int, help="compression level (default: the codec's own)")
+    parser.add_argument("--decompress", action="store_true", help="expand .ftz containers while copying")
+    parser.add_argument("--no-reflink", action="store_true",
+                        help="always copy the data, even where btrfs/XFS could share it with the source")
+    parser.add_argument("--no-write-behind", action="store_true",
+                        help="let the kernel decide when to write back (faster to 100%%, slower to finish)")
+    parser.add_argument("--fsync-every", type=int, metavar="FILES", help="fsync finished files in batches of FILES")
+    parser.add_argument("--fsync-every-mb", type=int, metavar="MB", help="fsync finished files every MB megabytes")
+    parser.add_argument("--limit", type=float, metavar="MB/S", help="cap the transfer's bandwidth")
+    parser.add_argument("--pack", action="store_true",
+                        help="bundle small files into tar packs, for FAT/exFAT sticks (restore with --unpack)")
+
+
+def add_source_arguments(parser):
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="SOURCE... DEST: the files and directories to copy, then the destination "
+                             "(a directory, or the file name when copying one file)")
+    parser.add_argument("--from", dest="from_list", metavar="LIST",
+                        help="also copy the paths listed in LIST, one per line or NUL separated ('-' for stdin)")
+
+
+def sources_from_args(parser, args):
+    """(source, dest) for Transfer: one path stays a path, anything more becomes a list"""
+    sources = args.paths[:-1]
+    if args.from_list:
+        try:
+            if args.from_list == "-":
+                sources += read_path_list(sys.stdin.buffer)
+            else:
+                with open(args.from_list, "rb") as f:
+                    sources += read_path_list(f)
+        except OSError as e:
+            parser.error(f"cannot read {args.from_list}: {e}")
+    if not sources:
+        parser.error("need at least one source and a destination")
+    if len(sources) == 1 and not args.from_list:
+        return sources[0], args.paths[-1]
+    return sources, args.paths[-1]
+
+
+def options_from_args(args):
+    return TransferOptions(
+        workers=args.workers,
+        split_large=args.split_large,
+        range_count=args.ranges,
+        sync=args.sync,
+        checksum=args.checksum,
+        delta=args.sync and not args.no_delta,
+        resume=not args.no_resume,
+        adaptive_chunks=not args.fixed_chunks,
+        verify=args.verify,
+        hash_algorithm=args.hash,
+        compress=args.codec if args.compress else None,
+        compress_level=args.level,
+        decompress=args.decompress,
+        pack=args.pack,
+        write_behind=0 if args.no_write_behind else WRITEBACK_BYTES,
+        fsync_files=args.fsync_every,
+        fsync_bytes=args.fsync_every_mb * 1024 * 1024 if args.fsync_every_mb else None,
+        bandwidth_limit=int(args.limit * 1024 * 1024) if args.limit else None,
+        reflink=not args.no_reflink,
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m filetransfer",
+                                     description="Copy files and folders quickly. "
+                                                 "See 'python -m filetransfer queue -h' for the job queue, "
+                                                 "'serve -h' and 'send -h' for network transfers.")
+    add_source_arguments(parser)
+    add_transfer_arguments(parser)
+    parser.add_argument("--calibrate", action="store_true",
+                        help="measure the device pair first and remember the best chunk size")
+    parser.add_argument("--unpack", action="store_true",
+                        help="PATH [DEST]: restore the packed files in PATH into DEST (default: PATH itself)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="time every phase of the copy (open, read, write, fsync, callbacks...) and save "
+                             "the latency histograms to FILE as JSON")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="save a timeline of the phases, one track per worker thread, to FILE "
+                             "(Chrome trace format, open in ui.perfetto.dev)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="no progress output")
+    return parser
+
+
+def build_queue_parser():
+    parser = argparse.ArgumentParser(prog="python -m filetransfer queue", description="Manage the job queue.")
+    parser.add_argument("--db", help=f"queue database (default: {default_queue_path()})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="queue a transfer")
+    add_source_arguments(add)
+    add.add_argument("-p", "--priority", type=int, default=0, help="higher runs first (default 0)")
+    add_transfer_arguments(add)
+    listing = commands.add_parser("list", help="show jobs")
+    listing.add_argument("--state", choices=(QUEUED, RUNNING, CANCELLING, DONE, FAILED, CANCELLED))
+    listing.add_argument("-n", type=int, default=50, help="how many (default 50)")
+    for name, text in (("cancel", "cancel a queued or running job"), ("remove", "delete a finished job"),
+                       ("top", "run a job before the others of its priority")):
+        commands.add_parser(name, help=text).add_argument("id", type=int)
+    priority = commands.add_parser("priority", help="change a job's priority")
+    priority.add_argument("id", type=int)
+    priority.add_argument("priority", type=int)
+    run = commands.add_parser("run", help="work through the queue")
+    run.add_argument("--until-empty", action="store_true", help="exit when nothing is left to run")
+    run.add_argument("--max-running", type=int, default=MAX_RUNNING, help=f"jobs at once (default {MAX_RUNNING})")
+    run.add_argument("--per-device", type=int, default=MAX_PER_DEVICE,
+                     help=f"jobs at once per destination device (default {MAX_PER_DEVICE})")
+    return parser
+
+
+def build_serve_parser():
+    parser = argparse.ArgumentParser(prog="python -m filetransfer serve",
+                                     description="Receive files sent with 'python -m filetransfer send'.")
+    parser.add_argument("dir", help="where received files go")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: 127.0.0.1; anything else needs --token, 0.0.0.0 for all)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"default {DEFAULT_PORT}")
+    parser.add_argument("--token", default=os.environ.get("FILETRANSFER_TOKEN"),
+                        help="shared secret senders must present (default: $FILETRANSFER_TOKEN)")
+    return parser
+
+
+def build_send_parser():
+    parser = argparse.ArgumentParser(prog="python -m filetransfer send",
+                                     description="Send files to a 'python -m filetransfer serve' receiver.")
+    add_source_arguments(parser)
+    parser.add_argument("-s", "--streams", type=int, default=DEFAULT_STREAMS,
+                        help=f"parallel TCP connections (default {DEFAULT_STREAMS})")
+    parser.add_argument("--token", default=os.environ.get("FILETRANSFER_TOKEN"),
+                        help="the receiver's shared secret (default: $FILETRANSFER_TOKEN)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="no progress output")
+    return parser
+
+
+def build_adb_parser():
+    parser = argparse.ArgumentParser(prog="python -m filetransfer adb",
+                                     description="Copy to (push) or from (pull) an Android device over adb.")
+    parser.add_argument("direction", choices=("push", "pull"))
+    add_source_arguments(parser)
+    parser.add_argument("--serial", help="device serial, when more than one is connected")
+    parser.add_argument("--sessions", type=int, default=adb.DEFAULT_SESSIONS,
+                        help=f"adb sessions running at once (default {adb.DEFAULT_SESSIONS})")
+    parser.add_argument("--mode", choices=adb.MODES, default=adb.AUTO,
+                        help="tar: stream tar archives through the device's tar, dir: many files per adb "
+                             "push/pull call, auto: tar when the device has it (default)")
+    parser.add_argument("--adb", default=adb.ADB, help="adb executable (default: $ADB or adb)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="no progress output")
+    return parser
+
+
+def format_progress(estimate):
+    return (f"{estimate.fraction * 100:5.1f}%  {estimate.bytes_done / MB:,.1f}/{estimate.total_bytes / MB:,.1f} MB  "
+            f"{estimate.files_done}/{estimate.total_files} files  {estimate.bytes_per_second / MB:.2f} MB/s  "
+            f"{estimate.files_per_second:.0f} files/s  ETA {format_duration(estimate.eta)}  ")
+
+
+async def _drive(job, show_progress):
+    """Run ``job`` on the asyncio core, redrawing the progress line while it goes"""
+    core = TransferCore()
+    task = asyncio.ensure_future(core.run(job))
+    try:
+        while not task.done():
+            await asyncio.wait([task], timeout=REFRESH_SECONDS)
+            estimate = job.estimate() if show_progress else None
+            if estimate is not None:
+                sys.stderr.write("\r" + format_progress(estimate))
+                sys.stderr.flush()
+        return task.result()
+    except asyncio.CancelledError:
+        # Ctrl-C: asyncio.run cancels us, pass it on and let the workers checkpoint
+        task.cancel()
+        await asyncio.wait([task])
+        raise
+    finally:
+        core.close()
+
+
+def queue_main(argv):
+    parser = build_queue_parser()
+    args = parser.parse_args(argv)
+    if args.command == "add":
+        source, dest = sources_from_args(parser, args)
+    job_queue = JobQueue(args.db)
+    try:
+        if args.command == "add":
+            print(job_queue.submit(source, dest, options_from_args(args), args.priority))
+        elif args.command == "list":
+            for job in job_queue.jobs(args.state, limit=args.n):
+                print(f"{job.id:>6}  {job.state:<10} p{job.priority:<3} {job.describe_source()} -> {job.dest}"
+                      + (f"  ({job.result})" if job.result else ""))
+        elif args.command == "cancel":
+            job_queue.cancel(args.id)
+        elif args.command == "remove":
+            job_queue.remove(args.id)
+        elif args.command == "top":
+            job_queue.move_to_front(args.id)
+        elif args.command == "priority":
+            job_queue.set_priority(args.id, args.priority)
+        elif args.command == "run":
+            return _run_queue(job_queue, args)
+    finally:
+        job_queue.close()
+    return EXIT_OK
+
+
+def _run_queue(job_queue, args):
+    def report(job, summary, error):
+        print(f"job {job.id}: {error if error is not None else summary.describe()}")
+
+    async def run():
+        core = TransferCore()
+        try:
+            await QueueRunner(job_queue, core, args.max_running, args.per_device, report).run(args.until_empty)
+        finally:
+            core.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        return EXIT_CANCELLED  # running jobs went back to the queue and resume next time
+    return EXIT_OK
+
+
+def serve_main(argv):
+    parser = build_serve_parser()
+    args = parser.parse_args(argv)
+    try:
+        receiver = Receiver(args.dir, args.host, args.port, args.token)
+    except ValueError as e:
+        parser.error(str(e))
+    host, port = receiver.address
+    print(f"Receiving into {args.dir} on {host}:{port}")
+    try:
+        receiver.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+    return EXIT_OK
+
+
+def send_main(argv):
+    parser = build_send_parser()
+    args = parser.parse_args(argv)
+    sources, target = sources_from_args(parser, args)
+    try:
+        address = parse_address(target)
+    except ValueError:
+        parser.error(f"not a HOST[:PORT] address: {target}")
+    estimator = TransferEstimator()
+    return _run_in_background(
+        "send", lambda cancel: send(sources, address, args.streams, args.token, is_cancelled=cancel.is_set,
+                                    estimator=estimator),
+        estimator, args.quiet)
+
+
+def adb_main(argv):
+    parser = build_adb_parser()
+    args = parser.parse_args(argv)
+    sources, target = sources_from_args(parser, args)
+    device = adb.AdbDevice(args.serial, args.adb)
+    copy = adb.push if args.direction == "push" else adb.pull
+    estimator = TransferEstimator()
+    return _run_in_background(
+        f"adb-{args.direction}",
+        lambda cancel: copy(sources, target, device, args.sessions, args.mode, is_cancelled=cancel.is_set,
+                            estimator=estimator),
+        estimator, args.quiet)
+
+
+def _run_in_background(name, run, estimator, quiet):
+    """Run ``run(cancel_event)`` on a thread with a progress line, report its TransferSummary, return the exit code"""
+    cancel = threading.Event()
+    outcome = {}
+
+    def target():
+        try:
+            outcome["summary"] = run(cancel)
+        except Exception as e:
+            outcome["error"] = e
+
+    show_progress = not quiet and sys.stderr.isatty()
+    worker = threading.Thread(target=target, name=name)
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(REFRESH_SECONDS)
+            if show_progress:
+                estimate = estimator.estimate(0, 0)
+                sys.stderr.write(f"\r{estimate.bytes_done / MB:,.1f} MB  {estimate.files_done} files  "
+                                 f"{estimate.bytes_per_second / MB:.2f} MB/s  {estimate.files_per_second:.0f} files/s  ")
+                sys.stderr.flush()
+    except KeyboardInterrupt:
+        cancel.set()
+        worker.join()
+    finally:
+        if show_progress:
+            sys.stderr.write("\n")
+    if "error" in outcome:
+        print(f"error: {outcome['error']}", file=sys.stderr)
+        return EXIT_FAILED
+    summary = outcome["summary"]
+    for path, message in summary.failures:
+        print(f"failed: {path}: {message}", file=sys.stderr)
+    if not quiet:
+        print(summary.describe())
+    if summary.cancelled:
+        return EXIT_CANCELLED
+    return EXIT_OK if summary.ok else EXIT_FAILED
+
+
+def _save_profile(profiler, args):
+    try:
+        if args.profile:
+            profiler.write_summary(args.profile)
+        if args.trace:
+            profiler.write_trace(args.trace)
+    except OSError as e:
+        print(f"error: could not save the profile: {e}", file=sys.stderr)
+    if not args.quiet:
+        print(profiler.describe())
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["queue"]:
+        return queue_main(argv[1:])
+    if argv[:1] == ["serve"]:
+        return serve_main(argv[1:])
+    if argv[:1] == ["send"]:
+        return send_main(argv[1:])
+    if argv[:1] == ["adb"]:
+        return adb_main(argv[1:])
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.unpack:
+        if len(args.paths) > 2:
+            parser.error("--unpack takes a packed directory and at most one destination")
+        try:
+            count = unpack(*args.paths)
+        except (OSError, tarfile.TarError) as e:
+            print(f"error: unpack failed: {e}", file=sys.stderr)
+            return EXIT_FAILED
+        if not args.quiet:
+            print(f"Unpacked {count} files")
+        return EXIT_OK
+    source, dest = sources_from_args(parser, args)
+    options = options_from_args(args)
+    options.profile = bool(args.profile)
+    options.trace = bool(args.trace)
+    if args.calibrate:
+        try:
+            first = source if isinstance(source, str) else source[0]
+            best = calibrate(first, destination_root(source, dest),
+                             report=None if args.quiet else print)
+        except OSError as e:
+            print(f"error: calibration failed: {e}", file=sys.stderr)
+            return EXIT_FAILED
+        if not args.quiet:
+            print(f"Best chunk size: {best // 1024} KB")
+    job = Transfer(source, dest, options)
+    show_progress = not args.quiet and sys.stderr.isatty()
+    try:
+        summary = asyncio.run(_drive(job, show_progress))
+    except KeyboardInterrupt:
+        # _drive has already cancelled the transfer and waited for the journal
+        summary = job.summary
+    except Exception as e:
+        print(f"error: {e}", file=sys.stderr)
+        return EXIT_FAILED
+    finally:
+        if show_progress:
+            sys.stderr.write("\n")
+    if summary is None:
+        return EXIT_CANCELLED  # interrupted before the transfer even started
+    for path, message in summary.failures:
+        print(f"failed: {path}: {message}", file=sys.stderr)
+    if not args.quiet:
+        print(summary.describe())
+    if job.profiler is not None:
+        _save_profile(job.profiler, args)
+    if summary.cancelled:
+        return EXIT_CANCELLED
+    return EXIT_OK if summary.ok else EXIT_FAILED
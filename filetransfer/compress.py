@@ -0,0 +1,298 @@
+"""Compressed transfer mode for slow links.
+
+A compressible file is written to the destination as ``<name>.ftz``, a
+streaming container of independently compressed chunks:
+
+    header   b"FTZ1", codec id (u8), level (u8)
+    frames   kind (u8), raw length (u32), payload length (u32), payload
+    trailer  an END frame, then the total raw size (u64)
+
+Chunks that don't shrink are stored as they are, so a file that turns out
+to be incompressible half way through costs almost nothing extra. Copying
+the tree back with ``decompress`` expands the containers again.
+"""
+import collections
+import lzma
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .engine import _O_BINARY, CopyResult, _flush
+
+try:
+    import zstandard
+except ImportError:  # optional, pip install zstandard
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # optional, pip install lz4
+    lz4_frame = None
+
+CONTAINER_SUFFIX = ".ftz"
+MAGIC = b"FTZ1"
+COMPRESS_CHUNK = 1024 * 1024
+MIN_COMPRESS_SIZE = 64 * 1024  # below this the container overhead isn't worth it
+SAMPLE_SIZE = 256 * 1024
+SAMPLE_RATIO = 0.9   # a sample that shrinks less than this is treated as already compressed
+STORE_RATIO = 0.97   # chunks that shrink less than this are stored raw
+SPARSE_BLOCK = 4096  # whole blocks of zeros are left as holes when expanding
+
+_HEADER = struct.Struct(">4sBB")
+_FRAME = struct.Struct(">BII")
+_TRAILER = struct.Struct(">Q")
+_STORED, _COMPRESSED, _END = 0, 1, 2
+
+# Formats that are compressed already; sampling would say so too, but
+# this way we don't even read them twice.
+PRECOMPRESSED_EXTENSIONS = {
+    ".7z", ".aac", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg",
+    ".jpg", ".lz4", ".lzma", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".opus", ".png", ".pptx", ".rar",
+    ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst", CONTAINER_SUFFIX,
+}
+
+
+class Codec:
+    """One compression library behind a common one-shot interface"""
+
+    def __init__(self, name, codec_id, default_level, max_level, compress, decompress):
+        self.name = name
+        self.id = codec_id
+        self.default_level = default_level
+        self.max_level = max_level
+        self.compress = compress      # compress(data, level) -> bytes
+        self.decompress = decompress  # decompress(data, raw_length) -> bytes
+
+    def __repr__(self):
+        return f"Codec({self.name!r})"
+
+
+# Ordered fastest first. zlib and lzma always exist, the others are optional.
+CODECS = {}
+if lz4_frame is not None:
+    CODECS["lz4"] = Codec("lz4", 4, 0, 16, lambda data, level: lz4_frame.compress(data, compression_level=level),
+                          lambda data, n: lz4_frame.decompress(data))
+if zstandard is not None:
+    CODECS["zstd"] = Codec("zstd", 3, 3, 19, lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                           lambda data, n: zstandard.ZstdDecompressor().decompress(data, max_output_size=n))
+# zlib defaults to level 1: anything higher is slower than a USB 2.0 stick
+CODECS["zlib"] = Codec("zlib", 1, 1, 9, zlib.compress, lambda data, n: zlib.decompress(data))
+CODECS["lzma"] = Codec("lzma", 2, 6, 9, lambda data, level: lzma.compress(data, preset=level),
+                       lambda data, n: lzma.decompress(data))
+
+DEFAULT_CODEC = "zstd" if "zstd" in CODECS else "zlib"
+_BY_ID = {codec.id: codec for codec in CODECS.values()}
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec {name!r}, expected one of {sorted(CODECS)}") from None
+
+
+def is_container(path):
+    return path.endswith(CONTAINER_SUFFIX)
+
+
+def looks_compressible(path, sample_size=SAMPLE_SIZE):
+    """Quick guess from the first ``sample_size`` bytes, with the cheapest zlib level"""
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+    return bool(sample) and len(zlib.compress(sample, 1)) < len(sample) * SAMPLE_RATIO
+
+
+class CompressResult(CopyResult):
+    """CopyResult that also says how many bytes reached the destination"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.bytes_written = 0
+
+    def __repr__(self):
+        return (f"CompressResult(method={self.method!r}, bytes_copied={self.bytes_copied}, "
+                f"bytes_written={self.bytes_written}, completed={self.completed}, cancelled={self.cancelled})")
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+_ZERO_BLOCK = bytes(SPARSE_BLOCK)
+
+
+def _write_sparse(fd, data, offset):
+    """Write ``data``, which belongs at ``offset``, seeking over aligned all-zero blocks.
+
+    The blocks seeked over stay holes, as they were in a sparse source
+    (the container stores them as highly compressible zeros). A hole at
+    the end of the file is left for the caller to extend with ftruncate.
+    """
+    view = memoryview(data)
+    done = 0  # data[:done] is written or seeked over
+    found = data.find(_ZERO_BLOCK)
+    while found >= 0:
+        # The first block boundary of the file inside the zeros
+        start = found + -(offset + found) % SPARSE_BLOCK
+        end = start
+        while end + SPARSE_BLOCK <= len(data) and data.startswith(_ZERO_BLOCK, end):
+            end += SPARSE_BLOCK
+        if end > start:
+            _write_all(fd, view[done:start])
+            os.lseek(fd, end - start, os.SEEK_CUR)
+            done = end
+        found = data.find(_ZERO_BLOCK, max(end, found + 1))
+    _write_all(fd, view[done:])
+
+
+class Compressor:
+    """Compresses files into containers on a shared pool of threads.
+
+    zlib, lzma and zstandard release the GIL while they work, so chunks of
+    one file are compressed in parallel while the caller's thread keeps
+    reading ahead and writes the results out in order. A few chunks per
+    thread are kept in flight, no more, so memory stays bounded.
+    """
+
+    def __init__(self, codec=DEFAULT_CODEC, level=None, workers=None, chunk_size=COMPRESS_CHUNK):
+        self.codec = get_codec(codec)
+        level = self.codec.default_level if level is None else level
+        self.level = max(0, min(level, self.codec.max_level))
+        self.workers = workers or os.cpu_count() or 2
+        self.chunk_size = chunk_size
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="compress")
+
+    def wants(self, job):
+        """True when ``job`` is worth sending through the compressor"""
+        if job.size < MIN_COMPRESS_SIZE:
+            return False
+        if os.path.splitext(job.src)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+            return False
+        try:
+            return looks_compressible(job.src)
+        except OSError:
+            return False
+
+    def _compress_chunk(self, data):
+        packed = self.codec.compress(data, self.level)
+        if len(packed) >= len(data) * STORE_RATIO:
+            return _STORED, data
+        return _COMPRESSED, packed
+
+    def compress_file(self, src, dst, on_progress=None, is_cancelled=None, hasher=None):
+        """Write ``src`` to ``dst`` as a container and return a CompressResult"""
+        result = CompressResult(method=f"{self.codec.name} compressed")
+        in_flight = collections.deque()
+        src_fd = os.open(src, os.O_RDONLY | _O_BINARY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o666)
+            try:
+                _write_all(dst_fd, _HEADER.pack(MAGIC, self.codec.id, self.level))
+                result.bytes_written += _HEADER.size
+
+                def write_oldest():
+                    raw_length, future = in_flight.popleft()
+                    kind, payload = future.result()
+                    _write_all(dst_fd, _FRAME.pack(kind, raw_length, len(payload)))
+                    _write_all(dst_fd, payload)
+                    result.bytes_written += _FRAME.size + len(payload)
+                    result.bytes_copied += raw_length
+                    if on_progress is not None:
+                        on_progress(raw_length)
+
+                while data := os.read(src_fd, self.chunk_size):
+                    if is_cancelled is not None and is_cancelled():
+                        result.cancelled = True
+                        break
+                    if hasher is not None:
+                        hasher.update(data)
+                    in_flight.append((len(data), self._pool.submit(self._compress_chunk, data)))
+                    if len(in_flight) >= self.workers * 2:
+                        write_oldest()
+                while in_flight:
+                    write_oldest()
+                if not result.cancelled:
+                    _write_all(dst_fd, _FRAME.pack(_END, 0, 0) + _TRAILER.pack(result.bytes_copied))
+                    result.bytes_written += _FRAME.size + _TRAILER.size
+                    _flush(dst_fd)
+                    result.completed = True
+            finally:
+                for _, future in in_flight:
+                    future.cancel()
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        return result
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ValueError(f"Truncated container: {f.name}")
+    return data
+
+
+def iter_container(path, on_read=None):
+    """Yield the raw chunks stored in the container at ``path``, in order.
+
+    ``on_read(n)`` is told how many container bytes each chunk took.
+    """
+    with open(path, "rb") as f:
+        magic, codec_id, _ = _HEADER.unpack(_read_exact(f, _HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"Not a compressed transfer container: {path}")
+        codec = _BY_ID.get(codec_id)
+        if codec is None:
+            raise ValueError(f"{path} needs a codec that isn't installed (id {codec_id})")
+        total = 0
+        while True:
+            kind, raw_length, payload_length = _FRAME.unpack(_read_exact(f, _FRAME.size))
+            if kind == _END:
+                break
+            payload = _read_exact(f, payload_length)
+            data = payload if kind == _STORED else codec.decompress(payload, raw_length)
+            if len(data) != raw_length:
+                raise ValueError(f"Corrupt chunk in {path}")
+            total += raw_length
+            if on_read is not None:
+                on_read(_FRAME.size + payload_length)
+            yield data
+        if _TRAILER.unpack(_read_exact(f, _TRAILER.size))[0] != total:
+            raise ValueError(f"Size mismatch in {path}")
+
+
+def decompress_file(src, dst, on_progress=None, is_cancelled=None, hasher=None):
+    """Expand the container ``src`` into ``dst``.
+
+    Progress is reported in container bytes, since that is what the source
+    scan counted. Blocks of zeros are left as holes, so a sparse file comes
+    back sparse.
+    """
+    result = CompressResult(method="decompress")
+    dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o666)
+    try:
+        chunks = iter_container(src, on_progress)
+        try:
+            for data in chunks:
+                _write_sparse(dst_fd, data, result.bytes_copied)
+                if hasher is not None:
+                    hasher.update(data)
+                result.bytes_copied += len(data)
+                result.bytes_written += len(data)
+                if is_cancelled is not None and is_cancelled():
+                    result.cancelled = True
+                    return result
+        finally:
+            chunks.close()
+        # A hole at the end has been seeked over but not written
+        os.ftruncate(dst_fd, result.bytes_copied)
+        _flush(dst_fd)
+        result.completed = True
+    finally:
+        os.close(dst_fd)
+    return result
@@ -0,0 +1,74 @@
+import os
+
+# Default number of files copied at once for each kind of destination.
+# Flash handles deep queues well; spinning disks and USB sticks thrash when
+# several streams compete for the head or the controller cache.
+DEFAULT_WORKERS = {
+    "ssd": 8,
+    "hdd": 2,
+    "usb": 2,
+    "unknown": 4,
+}
+
+
+def _sysfs_block_dir(path):
+    """Find the /sys/block entry backing ``path`` (Linux only)"""
+    # The destination may not exist yet, look at the closest existing parent
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    dev_dir = f"/sys/dev/block/{os.major(st.st_dev)}:{os.minor(st.st_dev)}"
+    if not os.path.exists(dev_dir):
+        return None
+    dev_dir = os.path.realpath(dev_dir)
+    # Partitions have no queue/ of their own, the whole disk is one level up
+    if not os.path.exists(os.path.join(dev_dir, "queue")):
+        dev_dir = os.path.dirname(dev_dir)
+    return dev_dir
+
+
+def _read_flag(path):
+    try:
+        with open(path) as f:
+            return f.read().strip() == "1"
+    except OSError:
+        return False
+
+
+def device_kind(path):
+    """Classify the device holding ``path`` as "ssd", "hdd", "usb" or "unknown" """
+    dev_dir = _sysfs_block_dir(path)
+    if dev_dir is None:
+        return "unknown"
+    if "/usb" in dev_dir or _read_flag(os.path.join(dev_dir, "removable")):
+        return "usb"
+    if _read_flag(os.path.join(dev_dir, "queue", "rotational")):
+        return "hdd"
+    return "ssd"
+
+
+def device_id(path):
+    """Stable name for the device holding ``path``, e.g. "nvme0n1" or "sdb"
+
+    Falls back to the st_dev number where sysfs isn't available, which is
+    stable enough for fixed disks but not for sticks that get replugged.
+    """
+    dev_dir = _sysfs_block_dir(path)
+    if dev_dir is not None:
+        return os.path.basename(dev_dir)
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    try:
+        return f"dev{os.stat(path).st_dev}"
+    except OSError:
+        return "unknown"
+
+
+def default_workers(path):
+    """Pick a sensible worker count for copies landing on ``path``"""
+    return DEFAULT_WORKERS[device_kind(path)]
@@ -0,0 +1,554 @@
+import errno
+import mmap
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .cache import WriteBehind
+from .profiler import NULL_PROFILER
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB chunks
+MMAP_WINDOW = 64 * 1024 * 1024    # how much of the source is mapped at a time
+MMAP_MIN_SIZE = 1024 * 1024       # smaller files aren't worth setting up a mapping for
+
+# Errors that mean "this syscall can't handle these two files", not "the copy failed".
+# Seeing one of these makes the selector move on to the next engine.
+_UNSUPPORTED_ERRNOS = {
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+}
+
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+# Reflink ioctls from linux/fs.h; the fcntl module only names them from Python 3.12 on
+FICLONE = 0x40049409
+FICLONERANGE = 0x4020940D
+# Errors that mean the filesystem (pair) can't share extents at all, as opposed
+# to "not this file" (EINVAL for an unaligned resume offset, for instance)
+_NO_REFLINK_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOTTY,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+}
+_no_reflink = set()  # (source st_dev, destination st_dev) pairs that can't clone
+
+
+class CopyCancelled(Exception):
+    """Raised from the progress step when the caller asked to stop"""
+
+
+class EngineUnsupported(Exception):
+    """Raised by an engine that can't copy this pair of files"""
+
+    def __init__(self, offset, reason=""):
+        super().__init__(reason)
+        self.offset = offset
+
+
+class CopyResult:
+    """Outcome of one copy_file call"""
+
+    def __init__(self, method=None, bytes_copied=0, completed=False, cancelled=False, resumed_from=0,
+                 bytes_cloned=0, bytes_sparse=0):
+        self.method = method
+        self.bytes_copied = bytes_copied
+        self.bytes_cloned = bytes_cloned  # shared with the source by a reflink, not copied
+        self.bytes_sparse = bytes_sparse  # holes in the source, left as holes instead of written
+        self.resumed_from = resumed_from
+        self.completed = completed
+        self.cancelled = cancelled
+
+    def __bool__(self):
+        return self.completed
+
+    @property
+    def offset(self):
+        """How far into the file the copy has got, holes passed over included"""
+        return self.resumed_from + self.bytes_copied + self.bytes_sparse
+
+    def __repr__(self):
+        return (f"CopyResult(method={self.method!r}, bytes_copied={self.bytes_copied}, "
+                f"bytes_cloned={self.bytes_cloned}, bytes_sparse={self.bytes_sparse}, resumed_from={self.resumed_from}, completed={self.completed}, cancelled={self.cancelled})")
+
+
+class FixedChunkSize:
+    """Chunk size that never changes, the default when no controller is given"""
+
+    def __init__(self, size=CHUNK_SIZE):
+        self.size = size
+
+    def record(self, nbytes):
+        pass
+
+
+class CopyEngine:
+    """Base class for copy strategies.
+
+    An engine copies ``src_fd`` to ``dst_fd`` starting at ``offset`` and
+    calls ``step(n)`` after every chunk. It returns the offset it reached,
+    or raises EngineUnsupported with that offset so the next engine can
+    carry on from there. ``chunks.size`` is re-read before every chunk, an
+    adaptive controller may change it as the copy runs. Engines may read on
+    past ``size`` if the file turns out longer, unless ``exact`` is set
+    (when copying one data extent of a sparse file).
+
+    Engines whose data passes through Python set ``sees_data`` and hand each
+    chunk to ``step(n, data)`` so it can be hashed on the way through.
+
+    The ``profiler`` (see profiler.PhaseProfiler) times the system calls of
+    every chunk, apart from the ``step`` that follows them.
+    """
+
+    name = "base"
+    sees_data = False
+
+    def available(self):
+        return True
+
+    def copy(self, src_fd, dst_fd, offset, size, chunks, step, exact=False, profiler=NULL_PROFILER):
+        raise NotImplementedError
+
+
+class CopyFileRangeEngine(CopyEngine):
+    """Kernel-side copy with copy_file_range (Linux 4.5+)"""
+
+    name = "copy_file_range"
+
+    def available(self):
+        return hasattr(os, "copy_file_range")
+
+    def copy(self, src_fd, dst_fd, offset, size, chunks, step, exact=False, profiler=NULL_PROFILER):
+        if size == 0:
+            # Pseudo files (procfs, sysfs) report st_size 0 but still have data
+            raise EngineUnsupported(offset, "unknown size")
+        while offset < size:
+            try:
+                with profiler.phase("copy_file_range"):
+                    n = os.copy_file_range(src_fd, dst_fd, min(chunks.size, size - offset), offset, offset)
+            except OSError as e:
+                if e.errno in _UNSUPPORTED_ERRNOS:
+                    raise EngineUnsupported(offset, str(e))
+                raise
+            if n == 0:
+                # Some filesystems (procfs, sysfs, old FUSE) report 0 instead of failing
+                raise EngineUnsupported(offset, "copy_file_range returned 0")
+            offset += n
+            step(n)
+        return offset
+
+
+class SendfileEngine(CopyEngine):
+    """Kernel-side copy with sendfile into a regular file (Linux 2.6.33+)"""
+
+    name = "sendfile"
+
+    def available(self):
+        return hasattr(os, "sendfile") and os.name == "posix"
+
+    def copy(self, src_fd, dst_fd, offset, size, chunks, step, exact=False, profiler=NULL_PROFILER):
+        if size == 0:
+            raise EngineUnsupported(offset, "unknown size")
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        while offset < size:
+            try:
+                with profiler.phase("sendfile"):
+                    n = os.sendfile(dst_fd, src_fd, offset, min(chunks.size, size - offset))
+            except OSError as e:
+                if e.errno in _UNSUPPORTED_ERRNOS:
+                    raise EngineUnsupported(offset, str(e))
+                raise
+            if n == 0:
+                raise EngineUnsupported(offset, "sendfile returned 0")
+            offset += n
+            step(n)
+        return offset
+
+
+def _madvise(mm, option, start=0, length=0):
+    # mmap.madvise and its constants are missing on some platforms
+    if option is not None and hasattr(mm, "madvise"):
+        mm.madvise(option, start, length)
+
+
+_MADV_SEQUENTIAL = getattr(mmap, "MADV_SEQUENTIAL", None)
+_MADV_DONTNEED = getattr(mmap, "MADV_DONTNEED", None)
+
+
+class MmapEngine(CopyEngine):
+    """Write straight out of a memory map of the source.
+
+    Chunks are memoryview slices of the mapping, so the data is never copied
+    into Python objects. The source is mapped one MMAP_WINDOW at a time and
+    pages are dropped behind the copy (from our RSS with madvise, from the
+    page cache with fadvise), so many huge files copied at once still use
+    bounded memory. A source truncated by another process while mapped would
+    raise SIGBUS, which is why the kernel engines are preferred.
+    """
+
+    name = "mmap"
+    sees_data = True
+
+    def copy(self, src_fd, dst_fd, offset, size, chunks, step, exact=False, profiler=NULL_PROFILER):
+        if size < MMAP_MIN_SIZE:
+            raise EngineUnsupported(offset, "too small to map")
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        while offset < size:
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            length = min(MMAP_WINDOW, size - start)
+            try:
+                mm = mmap.mmap(src_fd, length, access=mmap.ACCESS_READ, offset=start)
+            except (OSError, ValueError) as e:
+                raise EngineUnsupported(offset, str(e))
+            try:
+                _madvise(mm, _MADV_SEQUENTIAL)
+                with memoryview(mm) as view:
+                    pos = offset - start
+                    dropped = 0
+                    while pos < length:
+                        n = min(chunks.size, length - pos)
+                        with view[pos:pos + n] as chunk:
+                            # Includes faulting the source pages in, the read of this engine
+                            with profiler.phase("write"):
+                                written = 0
+                                while written < n:
+                                    written += os.write(dst_fd, chunk[written:])
+                            pos += n
+                            offset += n
+                            step(n, chunk)
+                        done = pos - pos % mmap.PAGESIZE
+                        if done > dropped:
+                            _madvise(mm, _MADV_DONTNEED, dropped, done - dropped)
+                            dropped = done
+            finally:
+                mm.close()
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(src_fd, start, length, os.POSIX_FADV_DONTNEED)
+        return offset
+
+
+class ReadintoEngine(CopyEngine):
+    """Portable copy through one reused buffer, no per-chunk bytes objects"""
+
+    name = "readinto"
+    sees_data = True
+
+    def copy(self, src_fd, dst_fd, offset, size, chunks, step, exact=False, profiler=NULL_PROFILER):
+        buf = bytearray(chunks.size)
+        view = memoryview(buf)
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        with open(src_fd, "rb", buffering=0, closefd=False) as source_file:
+            # Read until EOF rather than to ``size`` so files that grow while
+            # being copied (or report a bogus st_size) still come out whole.
+            while True:
+                want = chunks.size
+                if exact:
+                    want = min(want, size - offset)
+                    if want <= 0:
+                        break
+                if want > len(buf):
+                    buf = bytearray(want)
+                    view = memoryview(buf)
+                with profiler.phase("read"):
+                    n = source_file.readinto(view[:want])
+                if not n:
+                    break
+                with profiler.phase("write"):
+                    written = 0
+                    while written < n:
+                        written += os.write(dst_fd, view[written:n])
+                offset += n
+                step(n, view[:n])
+        return offset
+
+
+ENGINES = [CopyFileRangeEngine, SendfileEngine, MmapEngine, ReadintoEngine]
+
+
+def select_engines(preferred=None):
+    """Return the engines to try, fastest first.
+
+    ``preferred`` is an engine name; when given, only that engine and the
+    portable readinto fallback are used.
+    """
+    engines = [cls() for cls in ENGINES]
+    if preferred:
+        names = [e.name for e in engines]
+        if preferred not in names:
+            raise ValueError(f"Unknown copy engine {preferred!r}, expected one of {names}")
+        engines = [e for e in engines if e.name in (preferred, ReadintoEngine.name)]
+    return [e for e in engines if e.available()]
+
+
+def reflink_fd(src_fd, dst_fd, offset=0):
+    """Make ``dst_fd`` share the source's extents from ``offset`` to the end.
+
+    Copy-on-write filesystems (btrfs, XFS with reflink, bcachefs, OCFS2)
+    clone the data in one metadata operation, whatever its size. Returns
+    the number of bytes cloned, or 0 when this pair of files can't be
+    cloned, in which case nothing was changed and the caller copies as
+    usual. A filesystem pair that refuses is remembered and not asked again.
+    """
+    if fcntl is None:
+        return 0
+    src_st = os.fstat(src_fd)
+    key = (src_st.st_dev, os.fstat(dst_fd).st_dev)
+    if key in _no_reflink or src_st.st_size <= offset:
+        return 0
+    try:
+        if offset:
+            # struct file_clone_range; a length of 0 means "to the end of the source"
+            fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack("qQQQ", src_fd, offset, 0, offset))
+        else:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as e:
+        if e.errno in _NO_REFLINK_ERRNOS:
+            _no_reflink.add(key)
+        return 0
+    return src_st.st_size - offset
+
+
+def clone_file(src, dst, resume_offset=0, hasher=None):
+    """Reflink ``src`` to ``dst`` (kept up to ``resume_offset``); a CopyResult, or None if it can't be cloned"""
+    src_fd = os.open(src, os.O_RDONLY | _O_BINARY)
+    try:
+        flags = os.O_WRONLY | os.O_CREAT | _O_BINARY
+        dst_fd = os.open(dst, flags if resume_offset else flags | os.O_TRUNC, 0o666)
+        try:
+            if resume_offset:
+                if resume_offset > min(os.fstat(src_fd).st_size, os.fstat(dst_fd).st_size):
+                    resume_offset = 0
+                os.ftruncate(dst_fd, resume_offset)
+            return _clone(src_fd, dst_fd, resume_offset, hasher)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _clone(src_fd, dst_fd, offset, hasher):
+    cloned = reflink_fd(src_fd, dst_fd, offset)
+    if not cloned:
+        return None
+    if hasher is not None:
+        # Nothing streamed through us; hashing the source still beats copying it
+        _hash_prefix(src_fd, offset + cloned, hasher)
+    return CopyResult(method="reflink", bytes_cloned=cloned, completed=True, resumed_from=offset)
+
+
+def is_sparse(st):
+    """Whether a stat result has fewer blocks allocated than its size needs, i.e. has holes"""
+    blocks = getattr(st, "st_blocks", None)
+    return hasattr(os, "SEEK_DATA") and blocks is not None and blocks * 512 < st.st_size
+
+
+def data_extents(fd, start, end):
+    """Yield the (start, end) spans of ``fd`` between ``start`` and ``end`` that hold data.
+
+    Holes are found with SEEK_DATA/SEEK_HOLE. Filesystems without them get
+    one span covering everything, which is what a plain copy does anyway.
+    """
+    pos = start
+    while pos < end:
+        try:
+            data = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return  # only a hole left up to the end of the file
+            if e.errno in _UNSUPPORTED_ERRNOS:
+                yield pos, end
+                return
+            raise
+        if data >= end:
+            return
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        yield data, hole
+        pos = hole
+
+
+_ZEROS = bytes(CHUNK_SIZE)
+
+
+def _hash_zeros(hasher, length):
+    while length > 0:
+        n = min(length, len(_ZEROS))
+        hasher.update(_ZEROS[:n] if n < len(_ZEROS) else _ZEROS)
+        length -= n
+
+
+def _copy_span(engines, src_fd, dst_fd, offset, end, chunks, step, result, exact=False, profiler=NULL_PROFILER):
+    """Copy from ``offset`` to ``end`` with the first engine that manages; ones that give up are dropped"""
+    while engines:
+        result.method = engines[0].name
+        try:
+            return engines[0].copy(src_fd, dst_fd, offset, end, chunks, step, exact, profiler)
+        except EngineUnsupported as e:
+            offset = e.offset
+            del engines[0]
+    raise OSError(errno.ENOTSUP, "No copy engine could copy the file")
+
+
+def _flush(fd):
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _hash_prefix(fd, length, hasher, chunk_size=CHUNK_SIZE):
+    """Feed the first ``length`` bytes of ``fd`` to ``hasher``"""
+    offset = 0
+    while offset < length:
+        data = os.pread(fd, min(chunk_size, length - offset), offset)
+        if not data:
+            break
+        hasher.update(data)
+        offset += len(data)
+
+
+def copy_file(src, dst, on_progress=None, is_cancelled=None, chunk_size=CHUNK_SIZE, engines=None,
+              resume_offset=0, on_checkpoint=None, checkpoint_bytes=None, chunk_controller=None,
+              hasher=None, write_behind=0, reflink=True, on_hole=None, profiler=None):
+    """Copy ``src`` to ``dst`` using the fastest engine that works.
+
+    ``on_progress(n)`` is called with the byte count of every chunk and
+    ``is_cancelled()`` is polled before each one. Returns a CopyResult whose
+    ``method`` names the engine that finished the copy.
+
+    With ``resume_offset`` the existing ``dst`` is kept up to that offset
+    and only the rest is copied. With ``on_checkpoint`` the destination is
+    flushed every ``checkpoint_bytes`` and ``on_checkpoint(offset)`` is told
+    how far the data on disk reaches.
+
+    ``chunk_controller`` (see tuning.AdaptiveChunkSize) replaces the fixed
+    ``chunk_size`` and is told about every chunk so it can resize them.
+
+    ``hasher`` (a hashlib-style object) sees every byte of the source as it
+    is copied. Only engines that see the data can do that, so the kernel
+    fast paths are skipped.
+
+    With ``write_behind`` (bytes, see cache.WriteBehind) the destination is
+    written back to the device every that many bytes and both files are
+    dropped from the page cache behind the copy.
+
+    With ``reflink`` the destination first tries to share the source's
+    extents on a copy-on-write filesystem (``method`` "reflink", counted in
+    ``bytes_cloned``); anywhere else the copy goes ahead as usual.
+
+    Sparse sources (VM images, databases) only have their data extents
+    copied; holes stay holes at the destination and are counted in
+    ``bytes_sparse``, with ``on_hole(n)`` called as each is passed over.
+
+    A ``profiler`` (profiler.PhaseProfiler) times the system calls and the
+    per-chunk work under phase names; the caller picks the size class.
+    """
+    if engines is None:
+        engines = select_engines()
+    if profiler is None:
+        profiler = NULL_PROFILER
+    if hasher is not None:
+        engines = [e for e in engines if e.sees_data] or [ReadintoEngine()]
+    engines = list(engines)  # _copy_span drops the ones that give up
+    chunks = chunk_controller or FixedChunkSize(chunk_size)
+    result = CopyResult()
+    next_checkpoint = None
+    behind = None
+
+    def step(n, data=None):
+        nonlocal next_checkpoint
+        if hasher is not None:
+            with profiler.phase("hash"):
+                hasher.update(data)
+        chunks.record(n)
+        result.bytes_copied += n
+        if behind is not None:
+            with profiler.phase("writeback"):
+                behind.advance(result.offset)
+        if on_progress is not None:
+            on_progress(n)
+        if next_checkpoint is not None:
+            offset = result.offset
+            if offset >= next_checkpoint:
+                with profiler.phase("fsync"):
+                    _flush(dst_fd)
+                on_checkpoint(offset)
+                next_checkpoint = offset + checkpoint_bytes
+        if is_cancelled is not None and is_cancelled():
+            raise CopyCancelled()
+
+    def hole(n):
+        result.bytes_sparse += n
+        # Extending the file leaves the new part unallocated
+        os.ftruncate(dst_fd, result.offset)
+        if hasher is not None:
+            _hash_zeros(hasher, n)
+        if on_hole is not None:
+            on_hole(n)
+        if is_cancelled is not None and is_cancelled():
+            raise CopyCancelled()
+
+    with profiler.phase("open"):
+        src_fd = os.open(src, os.O_RDONLY | _O_BINARY)
+    try:
+        with profiler.phase("stat"):
+            src_st = os.fstat(src_fd)
+        size = src_st.st_size
+        flags = os.O_WRONLY | os.O_CREAT | _O_BINARY
+        if not resume_offset:
+            flags |= os.O_TRUNC
+        with profiler.phase("open"):
+            dst_fd = os.open(dst, flags, 0o666)
+        try:
+            if resume_offset:
+                if resume_offset > min(size, os.fstat(dst_fd).st_size):
+                    resume_offset = 0
+                os.ftruncate(dst_fd, resume_offset)
+            result.resumed_from = resume_offset
+            if reflink:
+                with profiler.phase("clone"):
+                    cloned = _clone(src_fd, dst_fd, resume_offset, hasher)
+                if cloned is not None:
+                    return cloned
+            if hasher is not None and resume_offset:
+                # The digest must cover the part an earlier run already copied
+                _hash_prefix(src_fd, resume_offset, hasher)
+            if on_checkpoint is not None and checkpoint_bytes:
+                next_checkpoint = resume_offset + checkpoint_bytes
+            if write_behind and size > write_behind:
+                behind = WriteBehind(src_fd, dst_fd, resume_offset, write_behind)
+            if is_cancelled is not None and is_cancelled():
+                raise CopyCancelled()
+            if is_sparse(src_st):
+                for start, end in data_extents(src_fd, resume_offset, size):
+                    if start > result.offset:
+                        hole(start - result.offset)
+                    _copy_span(engines, src_fd, dst_fd, start, end, chunks, step, result, exact=True, profiler=profiler)
+                if size > result.offset:
+                    hole(size - result.offset)
+            else:
+                _copy_span(engines, src_fd, dst_fd, resume_offset, size, chunks, step, result, profiler=profiler)
+            if behind is not None:
+                with profiler.phase("writeback"):
+                    behind.finish()
+            result.completed = True
+        except CopyCancelled:
+            result.cancelled = True
+            if on_checkpoint is not None:
+                # Everything written so far is good, save it for the next run
+                _flush(dst_fd)
+                on_checkpoint(result.offset)
+        finally:
+            with profiler.phase("close"):
+                os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return result
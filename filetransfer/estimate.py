@@ -0,0 +1,183 @@
+"""Transfer-wide throughput and ETA estimate.
+
+Dividing bytes left by average MB/s is badly wrong for trees of small
+files: each file costs an open, a create, a few metadata writes and a
+rename whatever its size, so the rate swings with the file mix. The
+estimator models the wall time of every sampling interval as
+
+    seconds = mb * seconds_per_mb + files * seconds_per_file
+
+and fits both costs by exponentially weighted least squares, so recent
+intervals count most. The ETA then prices the bytes and the files still
+to go separately. Recording work is O(1) and cheap enough for the copy
+loop; the fit (a 2x2 solve) only runs when a UI asks for an estimate.
+"""
+import math
+import threading
+import time
+
+MB = 1024 * 1024
+SAMPLE_SECONDS = 0.25  # fold the work recorded so far into the model this often
+WINDOW_SECONDS = 10.0  # weights halve roughly every 7 seconds (window * ln 2)
+SPEED_WINDOW_SECONDS = 2.0  # smoothing of the "instantaneous" rates
+DEGENERATE = 1e-6      # how close to collinear mb and files may be before they can't be told apart
+
+
+class Estimate:
+    """One snapshot of the estimator, safe to hand to a UI thread"""
+
+    __slots__ = ("bytes_done", "files_done", "total_bytes", "total_files", "elapsed", "bytes_per_second",
+                 "files_per_second", "average_bytes_per_second", "average_files_per_second", "eta")
+
+    def __init__(self, bytes_done, files_done, total_bytes, total_files, elapsed, bytes_per_second,
+                 files_per_second, average_bytes_per_second, average_files_per_second, eta):
+        self.bytes_done = bytes_done
+        self.files_done = files_done
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.elapsed = elapsed
+        self.bytes_per_second = bytes_per_second    # smoothed over the last couple of seconds
+        self.files_per_second = files_per_second
+        self.average_bytes_per_second = average_bytes_per_second  # since the start
+        self.average_files_per_second = average_files_per_second
+        self.eta = eta  # seconds left, None until there is something to go on
+
+    @property
+    def fraction(self):
+        return min(self.bytes_done / self.total_bytes, 1.0) if self.total_bytes else 1.0
+
+    def __repr__(self):
+        return (f"Estimate({self.bytes_done}/{self.total_bytes} bytes, {self.files_done}/{self.total_files} files, "
+                f"{self.bytes_per_second / MB:.1f} MB/s, {self.files_per_second:.1f} files/s, eta={self.eta})")
+
+
+class TransferEstimator:
+    """Throughput model for one transfer, fed by every worker.
+
+    ``record(nbytes, nfiles)`` is work actually done (copied bytes, finished
+    files); ``skip(nbytes, nfiles)`` is work accounted for without doing it
+    (unchanged or resumed files), which shortens what's left but must not
+    make the link look faster than it is. ``hole(nbytes)`` is a hole in a
+    sparse file passed over, which the ETA doesn't price as data.
+    """
+
+    def __init__(self, window=WINDOW_SECONDS, clock=time.monotonic):
+        self.window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._start = self._last = clock()
+        self.bytes_done = 0
+        self.files_done = 0
+        self.holes_done = 0
+        self._work_bytes = 0   # recorded work, for the averages
+        self._work_files = 0
+        self._pending_bytes = 0  # recorded since the last sample
+        self._pending_files = 0
+        # Weighted sums for the least squares fit, in MB and seconds
+        self._s_mm = self._s_ff = self._s_mf = self._s_mt = self._s_ft = 0.0
+        self._byte_rate = None
+        self._file_rate = None
+
+    def record(self, nbytes=0, nfiles=0):
+        with self._lock:
+            self.bytes_done += nbytes
+            self.files_done += nfiles
+            self._pending_bytes += nbytes
+            self._pending_files += nfiles
+            now = self._clock()
+            if now - self._last >= SAMPLE_SECONDS:
+                self._sample(now)
+
+    def skip(self, nbytes=0, nfiles=0, holes=0):
+        """``holes``: how much of ``nbytes`` was holes, a skipped sparse file has them too"""
+        with self._lock:
+            self.bytes_done += nbytes
+            self.files_done += nfiles
+            self.holes_done += holes
+
+    def hole(self, nbytes):
+        with self._lock:
+            self.bytes_done += nbytes
+            self.holes_done += nbytes
+
+    def _sample(self, now):
+        dt = now - self._last
+        mb = self._pending_bytes / MB
+        files = self._pending_files
+        self._last = now
+        self._work_bytes += self._pending_bytes
+        self._work_files += files
+        self._pending_bytes = self._pending_files = 0
+
+        decay = math.exp(-dt / self.window)
+        self._s_mm = self._s_mm * decay + mb * mb
+        self._s_ff = self._s_ff * decay + files * files
+        self._s_mf = self._s_mf * decay + mb * files
+        self._s_mt = self._s_mt * decay + mb * dt
+        self._s_ft = self._s_ft * decay + files * dt
+
+        # Time-based EWMA, so irregular sample spacing doesn't skew the rates
+        keep = math.exp(-dt / SPEED_WINDOW_SECONDS)
+        byte_rate = mb * MB / dt
+        file_rate = files / dt
+        if self._byte_rate is None:
+            self._byte_rate, self._file_rate = byte_rate, file_rate
+        else:
+            self._byte_rate = self._byte_rate * keep + byte_rate * (1 - keep)
+            self._file_rate = self._file_rate * keep + file_rate * (1 - keep)
+
+    def _costs(self):
+        """(seconds per MB, seconds per file) from the weighted fit"""
+        s_mm, s_ff, s_mf, s_mt, s_ft = self._s_mm, self._s_ff, self._s_mf, self._s_mt, self._s_ft
+        det = s_mm * s_ff - s_mf * s_mf
+        if det > DEGENERATE * s_mm * s_ff:
+            per_mb = (s_mt * s_ff - s_ft * s_mf) / det
+            per_file = (s_ft * s_mm - s_mt * s_mf) / det
+            if per_mb >= 0 and per_file >= 0:
+                return per_mb, per_file
+        # Files and bytes moved in lockstep (or one cost came out negative):
+        # charge everything to whichever there is, the mix ahead is likely the same
+        if s_mm > 0:
+            return s_mt / s_mm, 0.0
+        if s_ff > 0:
+            return 0.0, s_ft / s_ff
+        return None
+
+    def estimate(self, total_bytes, total_files, total_holes=0):
+        """An Estimate against the planned totals (which may still grow while the scan runs).
+
+        ``total_holes`` is how much of ``total_bytes`` is expected to be
+        holes; only the data still to come counts towards the ETA.
+        """
+        with self._lock:
+            now = self._clock()
+            if now - self._last >= SAMPLE_SECONDS:
+                self._sample(now)  # the workers may be stuck on one slow file
+            elapsed = now - self._start
+            total_bytes = max(total_bytes, self.bytes_done)
+            total_files = max(total_files, self.files_done)
+            costs = self._costs()
+            eta = None
+            if costs is not None:
+                per_mb, per_file = costs
+                holes_left = max(total_holes - self.holes_done, 0)
+                bytes_left = max(total_bytes - self.bytes_done - holes_left, 0)
+                eta = bytes_left / MB * per_mb + (total_files - self.files_done) * per_file
+            worked = self._last - self._start
+            return Estimate(
+                self.bytes_done, self.files_done, total_bytes, total_files, elapsed,
+                self._byte_rate or 0.0, self._file_rate or 0.0,
+                self._work_bytes / worked if worked > 0 else 0.0,
+                self._work_files / worked if worked > 0 else 0.0,
+                eta,
+            )
+
+
+def format_duration(seconds):
+    """``1:02:03``, ``2:03`` or ``--:--`` when unknown"""
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds + 0.5)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
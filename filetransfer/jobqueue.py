@@ -0,0 +1,300 @@
+"""Persistent queue of transfers, run a few at a time.
+
+Jobs live in SQLite, so the queue survives restarts: a job that was
+running when the process died goes back to the queue and its journal lets
+it resume. The runner picks the queued job with the highest priority
+(then the earliest position) whose destination device still has room,
+within a global cap on running jobs. Every job can carry its own bandwidth
+limit, so a background backup can be kept from starving an interactive
+copy to the same stick.
+
+All lookups go through indexes and listings are paged, so thousands of
+queued jobs cost a UI no more than a handful.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .api import Transfer, TransferOptions, destination_root
+from .devices import device_id
+
+MAX_RUNNING = 2       # jobs running at once
+MAX_PER_DEVICE = 1    # of those, jobs writing to the same device
+POLL_SECONDS = 1.0    # how often the runner looks for new jobs and cancel requests
+
+QUEUED = "queued"
+RUNNING = "running"
+CANCELLING = "cancelling"  # cancel requested, the runner hasn't stopped it yet
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def default_queue_path():
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "filetransfer", "jobs.sqlite")
+
+
+class QueuedJob:
+    """One row of the queue"""
+
+    __slots__ = ("id", "source", "sources", "dest", "options", "priority", "position", "state", "device", "result")
+
+    def __init__(self, id, source, sources, dest, options, priority, position, state, device, result):
+        self.id = id
+        self.source = source    # the path, or the first of a list
+        self.sources = sources  # JSON list of every source, None for a single path
+        self.dest = dest
+        self.options = options
+        self.priority = priority
+        self.position = position
+        self.state = state
+        self.device = device
+        self.result = result
+
+    def transfer_options(self):
+        return TransferOptions(**json.loads(self.options))
+
+    def transfer_source(self):
+        """What to hand Transfer(): the path, or the list of paths"""
+        return self.source if self.sources is None else json.loads(self.sources)
+
+    def describe_source(self):
+        if self.sources is None:
+            return self.source
+        return f"{self.source} (+{len(json.loads(self.sources)) - 1} more)"
+
+    def __repr__(self):
+        return f"QueuedJob(id={self.id}, {self.describe_source()!r} -> {self.dest!r}, priority={self.priority}, state={self.state})"
+
+
+_COLUMNS = "id, source, sources, dest, options, priority, position, state, device, result"
+
+
+class JobQueue:
+    """The queue itself; safe to share between threads"""
+
+    def __init__(self, path=None):
+        self.path = path or default_queue_path()
+        os.makedirs(os.path.dirname(self.path) or os.curdir, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY, source TEXT NOT NULL, sources TEXT, dest TEXT NOT NULL, options TEXT NOT NULL,"
+            " priority INTEGER NOT NULL, position REAL NOT NULL, state TEXT NOT NULL, device TEXT NOT NULL,"
+            " result TEXT, updated REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_order ON jobs (state, priority DESC, position)")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def _rows(self, sql, args=()):
+        with self._lock:
+            return [QueuedJob(*row) for row in self._db.execute(sql, args)]
+
+    def _write(self, sql, args=()):
+        with self._lock:
+            cursor = self._db.execute(sql, args)
+            self._db.commit()
+            return cursor
+
+    def submit(self, source, dest, options=None, priority=0):
+        """Queue a transfer and return its id; higher priorities run first.
+
+        ``source`` is a path or a list of paths, as for Transfer.
+        """
+        options = options or TransferOptions()
+        device = device_id(destination_root(source, dest))
+        sources = None
+        if not isinstance(source, str):
+            paths = list(source)
+            if not paths:
+                raise ValueError("No sources to copy")
+            sources, source = json.dumps(paths), paths[0]
+        with self._lock:
+            last = self._db.execute("SELECT MAX(position) FROM jobs").fetchone()[0] or 0
+            cursor = self._db.execute(
+                "INSERT INTO jobs (source, sources, dest, options, priority, position, state, device, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (source, sources, dest, json.dumps(vars(options)), priority, last + 1, QUEUED, device, time.time()),
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def get(self, job_id):
+        rows = self._rows(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def jobs(self, state=None, limit=100, offset=0):
+        """A page of jobs in the order they will run (finished ones most recent first)"""
+        if state is None:
+            return self._rows(f"SELECT {_COLUMNS} FROM jobs ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset))
+        return self._rows(f"SELECT {_COLUMNS} FROM jobs WHERE state = ? ORDER BY priority DESC, position"
+                          f" LIMIT ? OFFSET ?", (state, limit, offset))
+
+    def counts(self):
+        """{state: number of jobs}"""
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def set_priority(self, job_id, priority):
+        self._write("UPDATE jobs SET priority = ?, updated = ? WHERE id = ?", (priority, time.time(), job_id))
+
+    def move_to_front(self, job_id):
+        """Run ``job_id`` before every other queued job of the same priority"""
+        with self._lock:
+            first = self._db.execute("SELECT MIN(position) FROM jobs").fetchone()[0] or 0
+            self._db.execute("UPDATE jobs SET position = ? WHERE id = ?", (first - 1, job_id))
+            self._db.commit()
+
+    def move_to_back(self, job_id):
+        with self._lock:
+            last = self._db.execute("SELECT MAX(position) FROM jobs").fetchone()[0] or 0
+            self._db.execute("UPDATE jobs SET position = ? WHERE id = ?", (last + 1, job_id))
+            self._db.commit()
+
+    def move_before(self, job_id, other_id):
+        """Put ``job_id`` just ahead of ``other_id`` (it also takes the other job's priority)"""
+        with self._lock:
+            row = self._db.execute("SELECT priority, position FROM jobs WHERE id = ?", (other_id,)).fetchone()
+            if row is None:
+                raise KeyError(other_id)
+            priority, position = row
+            before = self._db.execute(
+                "SELECT MAX(position) FROM jobs WHERE position < ? AND priority = ?", (position, priority)
+            ).fetchone()[0]
+            new = (before + position) / 2 if before is not None else position - 1
+            self._db.execute("UPDATE jobs SET priority = ?, position = ? WHERE id = ?", (priority, new, job_id))
+            self._db.commit()
+
+    def cancel(self, job_id):
+        """Drop a queued job, or ask the runner to stop a running one"""
+        self._write("UPDATE jobs SET state = CASE state WHEN ? THEN ? ELSE ? END, updated = ?"
+                    " WHERE id = ? AND state IN (?, ?)",
+                    (RUNNING, CANCELLING, CANCELLED, time.time(), job_id, QUEUED, RUNNING))
+
+    def remove(self, job_id):
+        """Forget a job that isn't running"""
+        self._write("DELETE FROM jobs WHERE id = ? AND state NOT IN (?, ?)", (job_id, RUNNING, CANCELLING))
+
+    def claim(self, busy_devices=()):
+        """Mark the next runnable job as running and return it, or None"""
+        skip = list(busy_devices)
+        marks = ", ".join("?" * len(skip))
+        where = f"state = ? AND device NOT IN ({marks})" if skip else "state = ?"
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {_COLUMNS} FROM jobs WHERE {where} ORDER BY priority DESC, position LIMIT 1",
+                [QUEUED] + skip,
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE jobs SET state = ?, updated = ? WHERE id = ?", (RUNNING, time.time(), row[0]))
+            self._db.commit()
+        job = QueuedJob(*row)
+        job.state = RUNNING
+        return job
+
+    def finish(self, job_id, state, result=None):
+        self._write("UPDATE jobs SET state = ?, result = ?, updated = ? WHERE id = ?",
+                    (state, result, time.time(), job_id))
+
+    def requeue_interrupted(self):
+        """Put jobs a previous process left running back in the queue; returns how many"""
+        return self._write("UPDATE jobs SET state = ? WHERE state IN (?, ?)", (QUEUED, RUNNING, CANCELLING)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class QueueRunner:
+    """Works through a JobQueue on a TransferCore.
+
+    Run it as a task on the core's loop (``BackgroundCore.loop`` for the
+    GUI). ``max_running`` caps jobs overall, ``max_per_device`` caps jobs
+    writing to one destination device.
+    """
+
+    def __init__(self, job_queue, core, max_running=MAX_RUNNING, max_per_device=MAX_PER_DEVICE,
+                 on_job_done=None):
+        self.queue = job_queue
+        self.core = core
+        self.max_running = max_running
+        self.max_per_device = max_per_device
+        self.on_job_done = on_job_done  # on_job_done(job, summary, error), on the loop's thread
+        self._running = {}  # job id -> (job, Transfer, task)
+        self._wake = None
+
+    def wake(self):
+        """Look at the queue now instead of at the next poll (call on the loop's thread)"""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self, until_empty=False):
+        """Start jobs as slots free up; with ``until_empty``, return once nothing is left"""
+        self._wake = asyncio.Event()
+        self.queue.requeue_interrupted()
+        try:
+            while True:
+                self._check_cancels()
+                self._start_jobs()
+                if until_empty and not self._running:
+                    return
+                try:
+                    await asyncio.wait_for(self._wake.wait(), POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+        finally:
+            # Shutting down: stop what's running, it goes back to the queue
+            tasks = [task for _, _, task in self._running.values()]
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _busy_devices(self):
+        per_device = {}
+        for job, _, _ in self._running.values():
+            per_device[job.device] = per_device.get(job.device, 0) + 1
+        return [device for device, count in per_device.items() if count >= self.max_per_device]
+
+    def _start_jobs(self):
+        while len(self._running) < self.max_running:
+            job = self.queue.claim(self._busy_devices())
+            if job is None:
+                return
+            transfer = Transfer(job.transfer_source(), job.dest, job.transfer_options())
+            task = asyncio.ensure_future(self._run_job(job, transfer))
+            self._running[job.id] = (job, transfer, task)
+
+    def _check_cancels(self):
+        for job_id, (_, transfer, _) in list(self._running.items()):
+            current = self.queue.get(job_id)
+            if current is None or current.state == CANCELLING:
+                transfer.cancel()
+
+    async def _run_job(self, job, transfer):
+        summary = error = None
+        try:
+            summary = await self.core.run(transfer)
+        except asyncio.CancelledError:
+            # The runner is shutting down; the job runs again (and resumes) next time
+            self.queue.finish(job.id, QUEUED)
+            raise
+        except Exception as e:
+            error = e
+            self.queue.finish(job.id, FAILED, str(e))
+        else:
+            state = CANCELLED if summary.cancelled else DONE if summary.ok else FAILED
+            self.queue.finish(job.id, state, summary.describe())
+        finally:
+            self._running.pop(job.id, None)
+            self.wake()
+        if self.on_job_done is not None:
+            self.on_job_done(job, summary, error)
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+
+JOURNAL_NAME = ".filetransfer_journal.sqlite"
+CHECKPOINT_BYTES = 64 * 1024 * 1024  # flush and record progress inside a file this often
+COMMIT_EVERY = 200  # finished-file rows per transaction
+
+
+def partial_path(dst):
+    """Where ``dst`` is written until it is complete"""
+    head, tail = os.path.split(dst)
+    return os.path.join(head, f".{tail}.part")
+
+
+class TransferJournal:
+    """Checkpoint log that lets a cancelled or crashed transfer pick up where it stopped.
+
+    Finished files are recorded as they complete. For the file in flight
+    the journal keeps the last offset that was flushed to disk, so a rerun
+    continues the ``.part`` file from there. Rows carry the source size and
+    mtime, and are ignored if the source has changed since.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        self.path = os.path.join(self.root, JOURNAL_NAME)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS done ("
+            " path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS partial ("
+            " path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, offset INTEGER NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _key(self, dst):
+        return os.path.relpath(dst, self.root).replace(os.sep, "/")
+
+    def is_done(self, job):
+        """True when an earlier run finished ``job`` and the source is unchanged"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns FROM done WHERE path = ?", (self._key(job.dst),)
+            ).fetchone()
+        return row == (job.size, job.mtime_ns) and os.path.exists(job.dst)
+
+    def resume_offset(self, job):
+        """Offset to continue ``job`` from, 0 when there is nothing usable to resume"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, offset FROM partial WHERE path = ?", (self._key(job.dst),)
+            ).fetchone()
+        if row is None or row[:2] != (job.size, job.mtime_ns):
+            return 0
+        try:
+            part_size = os.path.getsize(partial_path(job.dst))
+        except OSError:
+            return 0
+        # Anything past the checkpoint was never flushed, so it can't be trusted
+        return row[2] if part_size >= row[2] else 0
+
+    def checkpoint(self, job, offset):
+        """Record that ``offset`` bytes of ``job`` are safely on disk"""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO partial (path, size, mtime_ns, offset) VALUES (?, ?, ?, ?)",
+                (self._key(job.dst), job.size, job.mtime_ns, offset),
+            )
+            self._db.commit()
+
+    def mark_done(self, job):
+        key = self._key(job.dst)
+        with self._lock:
+            self._db.execute("DELETE FROM partial WHERE path = ?", (key,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO done (path, size, mtime_ns) VALUES (?, ?, ?)",
+                (key, job.size, job.mtime_ns),
+            )
+            self._pending += 1
+            if self._pending >= COMMIT_EVERY:
+                self._db.commit()
+                self._pending = 0
+
+    def forget(self, job):
+        """Drop everything known about ``job`` so the next run copies it again"""
+        key = self._key(job.dst)
+        with self._lock:
+            self._db.execute("DELETE FROM done WHERE path = ?", (key,))
+            self._db.execute("DELETE FROM partial WHERE path = ?", (key,))
+
+    def close(self, finished=False):
+        """Flush the journal; a finished transfer has nothing to resume, so it is deleted"""
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+        if finished:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,551 @@
+"""Send files to another machine over several parallel TCP streams.
+
+The receiver (``python -m filetransfer serve DIR``) accepts any number of
+connections and writes what arrives under DIR. The sender
+(``python -m filetransfer send SOURCE... HOST[:PORT]``) scans its sources
+and deals batches of files out to ``streams`` connections.
+
+Wire format, all integers big-endian:
+
+    hello      client: MAGIC, version (B), token length (H), token
+               server: MAGIC, status (B)
+    record     kind (B), path length (H), size (Q), mtime_ns (q), path (UTF-8, "/" separated)
+    FILE       record, then ``size`` bytes of data, then a status byte (OK or BAD)
+    DIR        record only
+    END        record with an empty path; the server answers with
+               files (Q), bytes (Q), failure report length (I), report (JSON)
+
+File headers are pipelined: the sender never waits for the receiver
+between files, so a stream of small files costs one round trip in total
+rather than one each. Small files are coalesced into large socket writes;
+large ones go out with sendfile. The status byte after the data lets the
+sender take back a file that changed size while it was being read, without
+losing its place in the stream.
+
+There is no encryption; a shared ``token`` keeps strangers out, use it on
+trusted networks (or through an SSH tunnel). The receiver listens on
+loopback only unless it has a token.
+"""
+import hmac
+import ipaddress
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+
+from .journal import partial_path
+from .scanner import TransferJob, plan_tree, source_names
+from .scheduler import TransferSummary, batch_jobs
+
+DEFAULT_PORT = 9587
+DEFAULT_STREAMS = 4
+MAGIC = b"FTN1"
+VERSION = 1
+
+_HELLO = struct.Struct(">4sBH")
+_WELCOME = struct.Struct(">4sB")
+_RECORD = struct.Struct(">BHQq")
+_REPORT = struct.Struct(">QQI")
+
+END = 0
+FILE = 1
+DIR = 2
+
+OK = 0
+BAD = 1     # the file changed while it was sent, drop it
+DENIED = 2  # wrong version or token
+
+SENDFILE_MIN_SIZE = 1024 * 1024   # smaller files are read and coalesced into big writes
+SEND_BUFFER = 256 * 1024          # flush coalesced records once this much is waiting
+CHUNK_SIZE = 4 * 1024 * 1024
+SOCKET_BUFFER = 4 * 1024 * 1024   # SO_SNDBUF / SO_RCVBUF, so one stream can fill a fast link
+POLL_SECONDS = 0.25               # how often blocked threads look for a cancel
+
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+class ProtocolError(Exception):
+    """The other end sent something that doesn't follow the format"""
+
+
+class _Unreadable(Exception):
+    """A source file failed while being sent; the stream itself is still fine"""
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def parse_address(text, default_port=DEFAULT_PORT):
+    """``host``, ``host:port`` or ``[v6 address]:port`` -> (host, port)"""
+    if text.startswith("["):
+        host, _, rest = text[1:].partition("]")
+        return host, int(rest[1:]) if rest.startswith(":") else default_port
+    host, sep, port = text.rpartition(":")
+    if not sep or ":" in host:
+        return text, default_port  # no port, or a bare IPv6 address
+    return host, int(port)
+
+
+def _tune(sock):
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        except OSError:
+            pass
+
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        r = sock.recv_into(view[got:])
+        if r == 0:
+            raise ProtocolError("connection closed mid-record")
+        got += r
+    return bytes(buf)
+
+
+def _safe_path(root, wire_path):
+    """Map a "/" separated relative path under ``root``, refusing anything that would escape it"""
+    parts = wire_path.split("/")
+    if not wire_path or any(part in ("", ".", "..") or os.sep in part or (os.altsep and os.altsep in part)
+                            for part in parts):
+        raise ProtocolError(f"unsafe path {wire_path!r}")
+    return os.path.join(root, *parts)
+
+
+def is_loopback(host):
+    """Whether ``host`` only accepts connections from this machine"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class Receiver:
+    """Accepts sender connections and writes the files they carry under ``root``.
+
+    ``port=0`` picks a free port, see ``address``. ``serve_forever()``
+    blocks; ``close()`` (from another thread) stops it. Anyone who can
+    connect can write under ``root``, so listening beyond the loopback
+    interface takes a ``token``.
+    """
+
+    def __init__(self, root, host="127.0.0.1", port=DEFAULT_PORT, token=None, report=print):
+        if not token and not is_loopback(host):
+            raise ValueError(f"refusing to listen on {host or 'all addresses'} without a token, "
+                             f"anyone on the network could write into {root}")
+        self.root = root
+        self.token = token.encode() if token else b""
+        self.report = report  # report(text) for one line per finished stream, or None
+        os.makedirs(root, exist_ok=True)
+        self._sock = socket.create_server((host, port), reuse_port=False)
+        self._closed = threading.Event()
+        self._made_dirs = set()
+        self._lock = threading.Lock()
+
+    @property
+    def address(self):
+        return self._sock.getsockname()[:2]
+
+    def serve_forever(self):
+        while not self._closed.is_set():
+            try:
+                conn, peer = self._sock.accept()
+            except OSError:
+                if self._closed.is_set():
+                    return
+                raise
+            threading.Thread(target=self._serve, args=(conn, peer), name="receiver", daemon=True).start()
+
+    def start(self):
+        """serve_forever() on a daemon thread; returns self"""
+        threading.Thread(target=self.serve_forever, name="receiver-accept", daemon=True).start()
+        return self
+
+    def close(self):
+        self._closed.set()
+        try:
+            # accept() doesn't notice close() on every platform, shutdown wakes it
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    def _serve(self, conn, peer):
+        with conn:
+            _tune(conn)
+            try:
+                if not self._welcome(conn):
+                    return
+                files, nbytes, failures = self._receive(conn)
+                report = json.dumps(failures).encode()
+                conn.sendall(_REPORT.pack(files, nbytes, len(report)) + report)
+            except (OSError, ProtocolError) as e:
+                if self.report is not None:
+                    self.report(f"{peer[0]}: stream aborted: {e}")
+                return
+        if self.report is not None:
+            self.report(f"{peer[0]}: received {files} files ({nbytes / (1024 * 1024):.1f} MB)"
+                        + (f", {len(failures)} failed" if failures else ""))
+
+    def _welcome(self, conn):
+        magic, version, token_length = _HELLO.unpack(_recv_exact(conn, _HELLO.size))
+        token = _recv_exact(conn, token_length) if token_length else b""
+        if magic != MAGIC:
+            raise ProtocolError("not a filetransfer sender")
+        ok = version == VERSION and hmac.compare_digest(token, self.token)
+        conn.sendall(_WELCOME.pack(MAGIC, OK if ok else DENIED))
+        return ok
+
+    def _ensure_parent(self, path):
+        parent = os.path.dirname(path)
+        if parent in self._made_dirs:
+            return
+        os.makedirs(parent, exist_ok=True)
+        with self._lock:
+            self._made_dirs.add(parent)
+
+    def _receive(self, conn):
+        files = nbytes = 0
+        failures = []  # [path, message]
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        reader = conn.makefile("rb", buffering=SEND_BUFFER)
+        with reader:
+            while True:
+                header = reader.read(_RECORD.size)
+                if len(header) < _RECORD.size:
+                    raise ProtocolError("connection closed mid-stream")
+                kind, path_length, size, mtime_ns = _RECORD.unpack(header)
+                wire_path = reader.read(path_length)
+                if len(wire_path) < path_length:
+                    raise ProtocolError("connection closed mid-record")
+                wire_path = wire_path.decode("utf-8", "surrogateescape")
+                if kind == END:
+                    return files, nbytes, failures
+                path = _safe_path(self.root, wire_path)
+                if kind == DIR:
+                    try:
+                        os.makedirs(path, exist_ok=True)
+                    except OSError as e:
+                        failures.append([wire_path, str(e)])
+                elif kind == FILE:
+                    error = self._receive_file(reader, view, path, size, mtime_ns)
+                    if error is None:
+                        files += 1
+                        nbytes += size
+                    elif error:
+                        failures.append([wire_path, error])
+                else:
+                    raise ProtocolError(f"unknown record kind {kind}")
+
+    def _receive_file(self, reader, view, path, size, mtime_ns):
+        """Write one file; None when it's in place, "" when the sender took it back, else the error"""
+        part = partial_path(path)
+        fd = None
+        error = None
+        try:
+            self._ensure_parent(path)
+            fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o666)
+        except OSError as e:
+            error = str(e)
+        left = size
+        try:
+            while left:
+                n = reader.readinto(view[:min(left, len(view))])
+                if not n:
+                    raise ProtocolError("connection closed mid-file")
+                left -= n
+                if fd is not None:
+                    try:
+                        written = 0
+                        while written < n:
+                            written += os.write(fd, view[written:n])
+                    except OSError as e:
+                        # Keep reading to stay in step with the stream, but stop writing
+                        error = str(e)
+                        os.close(fd)
+                        fd = None
+            status = reader.read(1)
+            if not status:
+                raise ProtocolError("connection closed mid-file")
+        except BaseException:
+            _remove(part)
+            raise
+        finally:
+            if fd is not None:
+                os.close(fd)
+        if status[0] != OK or error is not None:
+            _remove(part)
+            return "" if status[0] == BAD else error
+        try:
+            os.replace(part, path)
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        except OSError as e:
+            return str(e)
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def plan_network(sources, errors=None):
+    """TransferJobs whose ``dst`` is the "/" separated path the receiver should use.
+
+    Sources land under their own names, so ones sharing a name are refused
+    as plan_sources() does.
+    """
+    for src, name in source_names(sources, errors):
+        try:
+            if os.path.isdir(src):
+                for job in plan_tree(src, name, errors):
+                    job.dst = job.dst.replace(os.sep, "/")
+                    yield job
+            else:
+                st = os.stat(src)
+                yield TransferJob(src, name, st.st_size, st.st_mtime_ns)
+        except OSError as e:
+            if errors is not None:
+                errors.append((src, str(e)))
+
+
+class _Stream:
+    """One sender connection"""
+
+    def __init__(self, address, token, on_progress, is_cancelled):
+        self.sock = socket.create_connection(address)
+        _tune(self.sock)
+        self.on_progress = on_progress
+        self.is_cancelled = is_cancelled
+        self.pending = bytearray()
+        token = token.encode() if token else b""
+        self.sock.sendall(_HELLO.pack(MAGIC, VERSION, len(token)) + token)
+        magic, status = _WELCOME.unpack(_recv_exact(self.sock, _WELCOME.size))
+        if magic != MAGIC:
+            raise ProtocolError("not a filetransfer receiver")
+        if status != OK:
+            raise ProtocolError("receiver refused the connection (version or token mismatch)")
+
+    def _record(self, kind, path, size=0, mtime_ns=0):
+        encoded = path.encode("utf-8", "surrogateescape")
+        self.pending += _RECORD.pack(kind, len(encoded), size, mtime_ns)
+        self.pending += encoded
+
+    def flush(self):
+        if self.pending:
+            self.sock.sendall(self.pending)
+            self.pending.clear()
+
+    def send_dir(self, job):
+        self._record(DIR, job.dst, 0, job.mtime_ns)
+
+    def send_file(self, job):
+        """Send one file and return the method used; _Unreadable if the source let us down"""
+        try:
+            fd = os.open(job.src, os.O_RDONLY | _O_BINARY)
+        except OSError as e:
+            raise _Unreadable(str(e))
+        try:
+            size = os.fstat(fd).st_size
+            self._record(FILE, job.dst, size, job.mtime_ns)
+            if size < SENDFILE_MIN_SIZE or not hasattr(os, "sendfile"):
+                return self._send_buffered(fd, size)
+            self.flush()
+            return self._send_sendfile(fd, size)
+        finally:
+            os.close(fd)
+
+    def _send_buffered(self, fd, size):
+        sent = 0
+        status = OK
+        error = None
+        while sent < size:
+            try:
+                data = os.read(fd, min(CHUNK_SIZE, size - sent))
+            except OSError as e:
+                data, error = b"", str(e)
+            if not data:
+                # Shrunk (or broke) while we read it: pad to the announced size and take it back
+                self._pad(size - sent)
+                status = BAD
+                break
+            self.pending += data
+            sent += len(data)
+            if len(self.pending) >= SEND_BUFFER:
+                self.flush()
+            self._progress(len(data))
+        self.pending.append(status)
+        if len(self.pending) >= SEND_BUFFER:
+            self.flush()
+        if status == BAD:
+            raise _Unreadable(error or "file changed while it was sent")
+        return "stream"
+
+    def _send_sendfile(self, fd, size):
+        out = self.sock.fileno()
+        offset = 0
+        while offset < size:
+            try:
+                n = os.sendfile(out, fd, offset, min(CHUNK_SIZE, size - offset))
+            except BlockingIOError:
+                continue
+            if n == 0:
+                self._pad(size - offset)
+                self.pending.append(BAD)
+                self.flush()
+                raise _Unreadable("file changed while it was sent")
+            offset += n
+            self._progress(n)
+        self.pending.append(OK)
+        return "sendfile"
+
+    def _pad(self, length):
+        """Fill the rest of an announced file with zeros, a chunk at a time"""
+        zeros = bytes(min(length, CHUNK_SIZE))
+        while length > 0:
+            self.pending += zeros[:length]
+            length -= len(zeros)
+            if len(self.pending) >= SEND_BUFFER:
+                self.flush()
+
+    def _progress(self, n):
+        if self.on_progress is not None:
+            self.on_progress(n)
+        if self.is_cancelled is not None and self.is_cancelled():
+            raise _Cancelled()
+
+    def finish(self):
+        """Send END and return the receiver's (files, bytes, failures)"""
+        self._record(END, "")
+        self.flush()
+        files, nbytes, length = _REPORT.unpack(_recv_exact(self.sock, _REPORT.size))
+        failures = json.loads(_recv_exact(self.sock, length)) if length else []
+        return files, nbytes, failures
+
+    def close(self):
+        self.sock.close()
+
+
+def send(sources, address, streams=DEFAULT_STREAMS, token=None, on_progress=None, is_cancelled=None,
+         estimator=None):
+    """Send files and directories to a Receiver and return a TransferSummary.
+
+    ``address`` is (host, port). Each of the ``streams`` connections has a
+    thread that takes batches of files from the shared scan, so small files
+    spread over every stream and large ones go out side by side.
+    ``on_progress(bytes_done)`` is called from those threads, and an
+    estimate.TransferEstimator, if given, is fed as the data goes out.
+    """
+    if isinstance(sources, str):
+        sources = [sources]
+    summary = TransferSummary()
+    lock = threading.Lock()
+    cancel = threading.Event()
+    batches = queue.Queue(maxsize=streams * 2)
+    scanned = threading.Event()
+    scan_errors = []
+
+    def cancelled():
+        if is_cancelled is not None and is_cancelled():
+            cancel.set()
+        return cancel.is_set()
+
+    def progress(n):
+        if estimator is not None:
+            estimator.record(n)
+        with lock:
+            summary.bytes_copied += n
+            done = summary.bytes_done
+        if on_progress is not None:
+            on_progress(done)
+
+    def scan():
+        try:
+            for batch in batch_jobs(plan_network(sources, scan_errors)):
+                while not cancel.is_set():
+                    try:
+                        batches.put(batch, timeout=POLL_SECONDS)
+                        break
+                    except queue.Full:
+                        pass
+                if cancel.is_set():
+                    return
+        finally:
+            scanned.set()
+
+    def next_batch():
+        while True:
+            try:
+                return batches.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if cancelled():
+                    raise _Cancelled()
+                if scanned.is_set() and batches.empty():
+                    return None
+
+    def worker(stream):
+        sent = 0
+        try:
+            while (batch := next_batch()) is not None:
+                for job in batch:
+                    if cancelled():
+                        raise _Cancelled()
+                    if job.is_dir:
+                        stream.send_dir(job)
+                        continue
+                    try:
+                        method = stream.send_file(job)
+                    except _Unreadable as e:
+                        with lock:
+                            summary.failures.append((job.src, str(e)))
+                        continue
+                    sent += 1
+                    if estimator is not None:
+                        estimator.record(nfiles=1)
+                    with lock:
+                        summary.files_copied += 1
+                        summary.methods[method] = summary.methods.get(method, 0) + 1
+            received, _, failures = stream.finish()
+            with lock:
+                # The receiver has the last word on what arrived
+                summary.files_copied += received - sent
+                summary.failures.extend((path, message) for path, message in failures)
+        except _Cancelled:
+            with lock:
+                summary.cancelled = True
+        except (OSError, ProtocolError) as e:
+            cancel.set()  # the other streams would only fail the same way
+            with lock:
+                summary.failures.append((f"stream to {address[0]}:{address[1]}", str(e)))
+        finally:
+            stream.close()
+
+    # Connect every stream up front so a refused token fails before anything is read
+    opened = [_Stream(address, token, progress, cancelled)]
+    try:
+        opened += [_Stream(address, token, progress, cancelled) for _ in range(streams - 1)]
+    except (OSError, ProtocolError):
+        for stream in opened:
+            stream.close()
+        raise
+    threads = [threading.Thread(target=scan, name="net-scan", daemon=True)]
+    threads += [threading.Thread(target=worker, args=(stream,), name="net-send", daemon=True) for stream in opened]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary.failures.extend(scan_errors)
+    if is_cancelled is not None and is_cancelled():
+        summary.cancelled = True
+    return summary
@@ -0,0 +1,199 @@
+"""Small-file packing for destinations where every file create is expensive.
+
+On FAT/exFAT sticks a tree of many tiny files is bound by directory updates,
+not bandwidth. In pack mode files below PACK_FILE_SIZE are appended to one
+sequential tar archive in the destination root instead of being created one
+by one; larger files are still copied directly.
+
+Packs are plain PAX tars (``tar xf`` reads them) named ``.filetransfer_pack_NNNN.tar``
+and roll over at PACK_MAX_BYTES, under FAT32's 4 GB file limit. Next to
+each one an ``.idx`` file lists where every member's data starts, so a
+single file can be pulled out without reading the archive from the top,
+and which directories it holds. Directories only go into a pack along
+with a file, or at the end of a run if no pack has them yet, so a rerun
+with nothing new to pack doesn't start a pack.
+``unpack`` restores the tree, newer packs winning over older ones.
+"""
+import glob
+import io
+import json
+import os
+import tarfile
+import threading
+
+PACK_FILE_SIZE = 64 * 1024               # files below this go into the pack
+PACK_MAX_BYTES = 1024 * 1024 * 1024      # start a new pack after this much
+PACK_PREFIX = ".filetransfer_pack_"
+INDEX_SUFFIX = ".idx"
+
+
+def pack_paths(root):
+    """Packs in ``root``, oldest first"""
+    return sorted(glob.glob(os.path.join(glob.escape(root), f"{PACK_PREFIX}*.tar")))
+
+
+def _padded(size):
+    return (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+
+class Packer:
+    """Appends small files to the current pack, one writer at a time.
+
+    Workers read their files in parallel and only take the lock to append
+    the bytes they already hold, so the destination sees one long
+    sequential write.
+    """
+
+    def __init__(self, root, max_bytes=PACK_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.files_packed = 0
+        self._lock = threading.Lock()
+        self._tar = None
+        self._path = None
+        self._index = []
+        self._dirs = []  # TarInfos of directories waiting for a pack to go into
+        existing = pack_paths(root)
+        self._number = int(os.path.basename(existing[-1])[len(PACK_PREFIX):-4]) if existing else 0
+
+    def _rel(self, job):
+        return os.path.relpath(job.dst, self.root).replace(os.sep, "/")
+
+    def _open(self):
+        if self._tar is not None and self._tar.offset < self.max_bytes:
+            return self._tar
+        self._close_pack()
+        self._number += 1
+        os.makedirs(self.root, exist_ok=True)
+        self._path = os.path.join(self.root, f"{PACK_PREFIX}{self._number:04d}.tar")
+        self._tar = tarfile.open(self._path, "w", format=tarfile.PAX_FORMAT)
+        return self._tar
+
+    def _info(self, job, type_):
+        info = tarfile.TarInfo(self._rel(job))
+        info.type = type_
+        info.mtime = job.mtime_ns / 1e9  # fractional, kept exactly in a PAX header
+        try:
+            info.mode = os.stat(job.src).st_mode & 0o7777
+        except OSError:
+            pass
+        return info
+
+    def add(self, job, data):
+        """Append the contents ``data`` of ``job`` to the pack; returns the pack's file name"""
+        info = self._info(job, tarfile.REGTYPE)
+        info.size = len(data)
+        with self._lock:
+            tar = self._open()
+            self._add_dirs(tar)
+            tar.addfile(info, io.BytesIO(data))
+            self._index.append({"path": info.name, "offset": tar.offset - _padded(info.size),
+                                "size": info.size, "mtime_ns": job.mtime_ns})
+            self.files_packed += 1
+            return os.path.basename(self._path)
+
+    def add_dir(self, job):
+        """Record a directory, so empty ones come back on unpack too"""
+        info = self._info(job, tarfile.DIRTYPE)
+        if info.name == ".":
+            return
+        with self._lock:
+            self._dirs.append(info)
+
+    def _add_dirs(self, tar):
+        for info in self._dirs:
+            tar.addfile(info)
+            self._index.append({"path": info.name, "dir": True})
+        self._dirs = []
+
+    def _close_pack(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        with open(self._path + INDEX_SUFFIX, "w", encoding="utf-8") as f:
+            for entry in self._index:
+                f.write(json.dumps(entry) + "\n")
+        self._tar = None
+        self._index = []
+
+    def close(self):
+        with self._lock:
+            if self._dirs and self._tar is None:
+                # Nothing was packed this run, only directories new since the last one need a pack
+                known = packed_dirs(self.root)
+                self._dirs = [info for info in self._dirs if info.name not in known]
+            if self._dirs:
+                self._add_dirs(self._open())
+            self._close_pack()
+
+
+def _index_entries(pack):
+    with open(pack + INDEX_SUFFIX, encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def packed_dirs(root):
+    """Paths of the directories the packs in ``root`` hold, going by their indexes"""
+    dirs = set()
+    for pack in pack_paths(root):
+        try:
+            dirs.update(entry["path"] for entry in _index_entries(pack) if entry.get("dir"))
+        except FileNotFoundError:
+            pass
+    return dirs
+
+
+def read_index(pack):
+    """{path: entry} for the files in ``pack``, rebuilt from the archive if the index is missing"""
+    index = {}
+    try:
+        for entry in _index_entries(pack):
+            if not entry.get("dir"):
+                index[entry["path"]] = entry
+        return index
+    except FileNotFoundError:
+        pass
+    # A run that crashed before closing the pack never wrote the index
+    with tarfile.open(pack, "r") as tar:
+        for info in tar:
+            if info.isfile():
+                index[info.name] = {"path": info.name, "offset": info.offset_data, "size": info.size,
+                                    "mtime_ns": int(info.mtime * 1e9)}
+    return index
+
+
+def extract_file(pack, path, index=None):
+    """Bytes of the member ``path`` of ``pack``, read straight from its offset"""
+    entry = (index if index is not None else read_index(pack))[path]
+    with open(pack, "rb") as f:
+        f.seek(entry["offset"])
+        return f.read(entry["size"])
+
+
+def unpack(root, dest=None, remove=True):
+    """Restore the files packed in ``root`` into ``dest`` (default: ``root`` itself).
+
+    Returns the number of files written. With ``remove`` the packs and
+    their indexes are deleted once they have been extracted, but only when
+    unpacking in place: extracted elsewhere, the packs are still the only
+    copy of those files in ``root``.
+    """
+    dest = root if dest is None else dest
+    remove = remove and os.path.realpath(dest) == os.path.realpath(root)
+    count = 0
+    for pack in pack_paths(root):
+        with tarfile.open(pack, "r") as tar:
+            members = tar.getmembers()
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(dest, members, filter="data")
+            else:
+                tar.extractall(dest, members)
+        count += sum(1 for member in members if member.isfile())
+        if remove:
+            for path in (pack, pack + INDEX_SUFFIX):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+    return count
@@ -0,0 +1,310 @@
+"""Where a transfer's time goes: per-phase latency histograms and a timeline.
+
+A PhaseProfiler is handed to the scanner, the scheduler and copy_file for
+one run (TransferOptions(profile=True), ``--profile``/``--trace`` on the
+command line). Each phase of the work is timed with perf_counter_ns:
+
+- data:     read, write, copy_file_range, sendfile, writeback, fsync
+- metadata: scan, stat, open, close, mkdir, rename, check, clone
+- python:   hash, progress (bookkeeping and the on_progress/on_file_*
+            callbacks, i.e. the GUI), throttle, bookkeeping (journal,
+            manifest, verifier)
+
+plus "file", the whole of each file, so what no phase covers shows up as
+"untracked": interpreter overhead and waiting for the GIL, and the delta,
+byte-range and (de)compressing copy paths, which aren't broken down. A
+large untracked share with several workers means Python is the bottleneck.
+Every sample lands in a log-linear histogram (four buckets per
+power of two, so percentiles are good to 25%) keyed by phase and by the
+size class of the file being copied. Each thread keeps its own histograms
+and appends to its own timeline, so recording takes no lock: a sample is a
+clock read, a dict lookup and a few additions.
+
+Code under measurement wraps a phase in ``with profiler.phase("open"):``;
+when profiling is off it is handed NULL_PROFILER, whose phases do nothing.
+
+``summary()`` is a plain dict (``write_summary()`` saves it as JSON);
+``write_trace()`` saves the timeline in Chrome trace format, one track per
+thread, for chrome://tracing or https://ui.perfetto.dev. Read them once the
+transfer is over; the workers don't stop for the exporter.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the file size classes, the last class is everything above
+SIZE_CLASSES = (4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024)
+SIZE_LABELS = ("<4K", "4K-64K", "64K-1M", "1M-16M", "16M-256M", ">=256M")
+SLOTS = 256          # histogram buckets, enough for anything under 2**64 ns
+MAX_TRACE_EVENTS = 1000000  # per thread; about 100 MB of timeline at most, later events are dropped
+
+PHASE_GROUPS = {
+    "data": ("read", "write", "copy_file_range", "sendfile", "writeback", "fsync"),
+    "metadata": ("scan", "stat", "open", "close", "mkdir", "rename", "check", "clone"),
+    "python": ("hash", "progress", "throttle", "bookkeeping"),
+}
+
+
+def size_class(size):
+    return bisect.bisect_left(SIZE_CLASSES, size + 1)
+
+
+def _slot_bounds(slot):
+    """[low, high) in ns of one histogram bucket"""
+    if slot < 4:
+        return slot, slot + 1
+    shift = slot // 4 - 1
+    sub = slot % 4
+    return (4 + sub) << shift, (5 + sub) << shift
+
+
+class _Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * SLOTS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def merge(self, other):
+        for slot, n in enumerate(other.counts):
+            if n:
+                self.counts[slot] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """ns, the middle of the bucket the ``fraction`` quantile falls in"""
+        rank = fraction * self.count
+        seen = 0
+        for slot, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                low, high = _slot_bounds(slot)
+                return min((low + high) / 2, self.max)
+        return self.max
+
+    def describe(self):
+        us = 1000.0
+        return {
+            "count": self.count,
+            "total_ms": round(self.total / 1e6, 3),
+            "mean_us": round(self.total / self.count / us, 2) if self.count else 0.0,
+            "p50_us": round(self.percentile(0.5) / us, 2),
+            "p90_us": round(self.percentile(0.9) / us, 2),
+            "p99_us": round(self.percentile(0.99) / us, 2),
+            "max_us": round(self.max / us, 2),
+        }
+
+
+class _ThreadStats:
+    """One thread's samples, only ever written by that thread"""
+
+    __slots__ = ("name", "histograms", "current", "events", "dropped", "max_events")
+
+    def __init__(self, trace, max_events):
+        self.name = threading.current_thread().name
+        self.histograms = [{} for _ in SIZE_LABELS]  # per size class: phase -> _Histogram
+        self.current = self.histograms[0]  # the size class of the file being worked on
+        self.events = [] if trace else None  # (phase, start ns, duration ns, detail)
+        self.dropped = 0
+        self.max_events = max_events
+
+
+class _Phase:
+    """``with profiler.phase(name):`` times the block as ``name``"""
+
+    __slots__ = ("profiler", "name", "detail", "start")
+
+    def __init__(self, profiler, name, detail):
+        self.profiler = profiler
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = self.profiler.clock()
+
+    def __exit__(self, *exc):
+        self.profiler.lap(self.name, self.start, self.detail)
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class NullProfiler:
+    """Stands in for a PhaseProfiler when profiling is off, recording nothing"""
+
+    enabled = False
+
+    def begin_file(self, size):
+        return 0
+
+    def phase(self, name, detail=None):
+        return _NULL_PHASE
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class PhaseProfiler:
+    """Collects phase timings from every thread of one transfer.
+
+    ``begin_file(size)`` sets the size class for what the calling thread
+    records next and returns a start time; ``phase(name)`` is a context
+    manager timing its block. Underneath it, ``lap(phase, start)`` records
+    the time since ``start`` and returns the new time, so consecutive phases
+    chain: ``t = profiler.lap("open", t)``. With ``trace`` every sample is
+    also kept for the timeline.
+    """
+
+    enabled = True
+
+    def __init__(self, trace=False, max_events=MAX_TRACE_EVENTS):
+        self.trace = trace
+        self.max_events = max_events
+        self.clock = time.perf_counter_ns
+        self.started = self.clock()
+        self.started_at = time.time()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _stats(self):
+        try:
+            return self._local.stats
+        except AttributeError:
+            stats = self._local.stats = _ThreadStats(self.trace, self.max_events)
+            with self._lock:
+                self._threads.append(stats)
+            return stats
+
+    def begin_file(self, size):
+        stats = self._stats()
+        stats.current = stats.histograms[size_class(size)]
+        return self.clock()
+
+    def phase(self, name, detail=None):
+        return _Phase(self, name, detail)
+
+    def lap(self, phase, start, detail=None):
+        now = self.clock()
+        ns = now - start
+        try:
+            stats = self._local.stats
+        except AttributeError:
+            stats = self._stats()
+        histogram = stats.current.get(phase)
+        if histogram is None:
+            histogram = stats.current[phase] = _Histogram()
+        # Log-linear bucket: the power of two, then the two bits below the top one
+        bits = ns.bit_length()
+        histogram.counts[ns if bits < 3 else ((bits - 2) << 2) | ((ns >> (bits - 3)) & 3)] += 1
+        histogram.count += 1
+        histogram.total += ns
+        if ns > histogram.max:
+            histogram.max = ns
+        if stats.events is not None:
+            if len(stats.events) < stats.max_events:
+                stats.events.append((phase, start, ns, detail))
+            else:
+                stats.dropped += 1
+        return now
+
+    def summary(self):
+        """Per-phase statistics, overall and by file size class, plus per-thread totals"""
+        with self._lock:
+            threads = list(self._threads)
+        phases = {}
+        per_thread = []
+        for stats in threads:
+            totals = {}
+            samples = [(phase, size, histogram) for size, table in enumerate(stats.histograms)
+                       for phase, histogram in list(table.items())]
+            for phase, size, histogram in samples:
+                entry = phases.setdefault(phase, {"all": _Histogram(), "by_size": {}})
+                entry["all"].merge(histogram)
+                entry["by_size"].setdefault(size, _Histogram()).merge(histogram)
+                totals[phase] = totals.get(phase, 0) + histogram.total
+            per_thread.append({"name": stats.name,
+                               "phases_ms": {phase: round(ns / 1e6, 3) for phase, ns in sorted(totals.items())}})
+
+        file_ns = phases["file"]["all"].total if "file" in phases else 0
+        groups = {}
+        tracked = 0
+        for group, names in PHASE_GROUPS.items():
+            ns = sum(phases[name]["all"].total for name in names if name in phases and name != "scan")
+            groups[group] = {"total_ms": round(ns / 1e6, 3), "share": round(ns / file_ns, 4) if file_ns else None}
+            tracked += ns
+        # Time inside files that no phase accounts for: interpreter and scheduling overhead
+        untracked = max(file_ns - tracked, 0)
+        groups["untracked"] = {"total_ms": round(untracked / 1e6, 3),
+                               "share": round(untracked / file_ns, 4) if file_ns else None}
+
+        return {
+            "started_at": self.started_at,
+            "elapsed_s": round((self.clock() - self.started) / 1e9, 3),
+            "size_classes": list(SIZE_LABELS),
+            "phases": {
+                phase: dict(entry["all"].describe(),
+                            by_size={SIZE_LABELS[size]: histogram.describe()
+                                     for size, histogram in sorted(entry["by_size"].items())})
+                for phase, entry in sorted(phases.items(), key=lambda item: -item[1]["all"].total)
+            },
+            # Shares are of the time spent inside files, "scan" runs beside them
+            "groups": groups,
+            "threads": per_thread,
+            "trace_events_dropped": sum(stats.dropped for stats in threads),
+        }
+
+    def describe(self):
+        """A few lines for a terminal: the phases by total time"""
+        summary = self.summary()
+        lines = [f"{'phase':<16} {'count':>9} {'total ms':>11} {'mean us':>9} {'p99 us':>9}"]
+        for phase, stats in summary["phases"].items():
+            lines.append(f"{phase:<16} {stats['count']:>9} {stats['total_ms']:>11.1f} "
+                         f"{stats['mean_us']:>9.1f} {stats['p99_us']:>9.1f}")
+        shares = ", ".join(f"{group} {stats['share']:.0%}" for group, stats in summary["groups"].items()
+                           if stats["share"] is not None)
+        if shares:
+            lines.append(f"Time in files: {shares}")
+        return "\n".join(lines)
+
+    def write_summary(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def chrome_trace(self):
+        """The timeline as a Chrome trace dict, one track (tid) per thread"""
+        pid = os.getpid()
+        with self._lock:
+            threads = list(self._threads)
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "filetransfer"}}]
+        for tid, stats in enumerate(threads, 1):
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": stats.name}})
+            events.append({"name": "thread_sort_index", "ph": "M", "pid": pid, "tid": tid,
+                           "args": {"sort_index": tid}})
+            for phase, start, ns, detail in stats.events or ():
+                event = {"name": phase, "ph": "X", "pid": pid, "tid": tid,
+                         "ts": (start - self.started) / 1000, "dur": ns / 1000}
+                if detail is not None:
+                    event["args"] = {"path": detail}
+                events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
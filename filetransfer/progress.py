@@ -0,0 +1,64 @@
+import queue
+
+FRAME_RATE = 30  # UI refreshes per second
+FRAME_MS = 1000 // FRAME_RATE
+
+# Event kinds, kept as small tuples so a put costs next to nothing
+BYTES = 0      # (BYTES, bytes_done)
+FILE = 1       # (FILE, path)
+FINISHED = 2   # (FINISHED, summary)
+
+
+class ProgressUpdate:
+    """Everything that happened since the last drain, merged into one frame"""
+
+    __slots__ = ("bytes_done", "current_file", "summary", "events")
+
+    def __init__(self):
+        self.bytes_done = None
+        self.current_file = None
+        self.summary = None
+        self.events = 0
+
+    @property
+    def finished(self):
+        return self.summary is not None
+
+
+class ProgressChannel:
+    """Thread-safe mailbox between copy workers and a UI thread.
+
+    Workers push events from the hot loop without ever touching widgets.
+    The UI calls ``drain()`` once per frame and redraws once with the
+    merged result, so redraw cost doesn't depend on how fast the copy runs.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+
+    def progress(self, bytes_done):
+        self._queue.put((BYTES, bytes_done))
+
+    def file_started(self, job):
+        self._queue.put((FILE, job.src))
+
+    def finish(self, summary):
+        self._queue.put((FINISHED, summary))
+
+    def drain(self):
+        update = ProgressUpdate()
+        get = self._queue.get_nowait
+        while True:
+            try:
+                kind, value = get()
+            except queue.Empty:
+                return update
+            update.events += 1
+            if kind == BYTES:
+                # Workers report totals, not deltas, and may report out of order
+                if update.bytes_done is None or value > update.bytes_done:
+                    update.bytes_done = value
+            elif kind == FILE:
+                update.current_file = value
+            else:
+                update.summary = value
@@ -0,0 +1,197 @@
+import os
+import queue
+import stat
+import threading
+
+_DONE = object()
+
+
+class TransferJob:
+    """One file (or directory) to copy, with the stat fields the scan already paid for"""
+
+    __slots__ = ("src", "dst", "size", "mtime_ns", "is_dir", "allocated")
+
+    def __init__(self, src, dst, size, mtime_ns=0, is_dir=False, allocated=None):
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.is_dir = is_dir
+        self.allocated = allocated  # bytes the source takes on disk, less than ``size`` if sparse
+
+    @property
+    def holes(self):
+        """Bytes of the file that are holes, going by its allocated blocks"""
+        if self.allocated is None or self.allocated >= self.size:
+            return 0
+        return self.size - self.allocated
+
+    def __repr__(self):
+        return f"TransferJob({self.src!r}, {self.dst!r}, {self.size})"
+
+
+def _allocated(st):
+    blocks = getattr(st, "st_blocks", None)  # not on Windows
+    return blocks * 512 if blocks is not None else None
+
+
+def plan_tree(src, dest, errors=None):
+    """Walk ``src`` once with os.scandir and yield a TransferJob per entry.
+
+    Every file costs a single stat call (none at all on Windows, where
+    scandir already carries it). Directories are yielded before their
+    contents so the copier can create them, symlinked directories are not
+    descended into. Entries that can't be read are appended to ``errors``
+    as (path, message) instead of stopping the walk.
+    """
+    st = os.stat(src)
+    if not stat.S_ISDIR(st.st_mode):
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        yield TransferJob(src, dest, st.st_size, st.st_mtime_ns, allocated=_allocated(st))
+        return
+
+    yield TransferJob(src, dest, 0, st.st_mtime_ns, True)
+    stack = [(src, dest)]
+    while stack:
+        src_dir, dest_dir = stack.pop()
+        try:
+            it = os.scandir(src_dir)
+        except OSError as e:
+            if errors is not None:
+                errors.append((src_dir, str(e)))
+            continue
+        with it:
+            for entry in it:
+                dst = os.path.join(dest_dir, entry.name)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        yield TransferJob(entry.path, dst, 0, st.st_mtime_ns, True)
+                        stack.append((entry.path, dst))
+                    else:
+                        # Follow file symlinks, like the old getsize()/open() did
+                        st = entry.stat()
+                        if stat.S_ISDIR(st.st_mode):
+                            continue  # symlink to a directory, not followed
+                        yield TransferJob(entry.path, dst, st.st_size, st.st_mtime_ns, allocated=_allocated(st))
+                except OSError as e:
+                    if errors is not None:
+                        errors.append((entry.path, str(e)))
+
+
+def source_names(sources, errors=None):
+    """(source, the name it gets in the destination) for each source whose name is still free.
+
+    A source named like an earlier one would overwrite it, so it becomes an
+    entry in ``errors`` instead.
+    """
+    names = set()
+    for src in sources:
+        name = os.path.basename(os.path.normpath(src))
+        if name in names:
+            if errors is not None:
+                errors.append((src, f"another source is also named {name!r}"))
+            continue
+        names.add(name)
+        yield src, name
+
+
+def plan_sources(sources, dest, errors=None):
+    """plan_tree for a list of files and directories copied side by side into ``dest``.
+
+    Each source lands in ``dest`` under its own name, like ``cp a b c DEST``.
+    A source that is missing, or whose name another source already took,
+    becomes an entry in ``errors`` and the rest still go ahead.
+    """
+    for src, name in source_names(sources, errors):
+        try:
+            yield from plan_tree(src, os.path.join(dest, name), errors)
+        except OSError as e:
+            if errors is not None:
+                errors.append((src, str(e)))
+
+
+def read_path_list(stream):
+    """Paths from a list file or stdin, one per line or NUL separated (``find -print0``)"""
+    data = stream.read()
+    if isinstance(data, bytes):
+        data = os.fsdecode(data)
+    if "\0" in data:
+        paths = data.split("\0")
+    else:
+        paths = [line.rstrip("\r") for line in data.split("\n")]
+    return [path for path in paths if path]
+
+
+def _timed_scan(jobs, profiler):
+    """``jobs``, with the scandir and stat behind each one timed as "scan" in its size class"""
+    start = profiler.clock()
+    for job in jobs:
+        profiler.begin_file(job.size)
+        profiler.lap("scan", start)
+        yield job
+        # The time spent on this side of the queue isn't counted
+        start = profiler.clock()
+
+
+class TreeScanner:
+    """Run plan_tree on a background thread and stream its jobs.
+
+    Iterating the scanner yields jobs as soon as they are found, so copying
+    starts while the walk is still going. ``total_bytes`` and ``total_files``
+    grow as the scan runs and are final once ``finished`` is set. A
+    ``profiler`` times the walk per entry as the "scan" phase.
+    """
+
+    def __init__(self, src, dest, profiler=None):
+        self.src = src  # a path, or a list of them (see plan_sources)
+        self.dest = dest
+        self.profiler = profiler
+        self.total_bytes = 0
+        self.total_files = 0
+        self.total_holes = 0  # of total_bytes, how much is holes in sparse files
+        self.errors = []
+        self.finished = threading.Event()
+        self._stop = threading.Event()
+        # Records are small and slotted; let the scan run ahead of the copy so
+        # the totals (and the progress bar) settle early.
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._scan, name="scanner", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Abandon the walk, e.g. after the transfer was cancelled"""
+        self._stop.set()
+
+    def _scan(self):
+        try:
+            if isinstance(self.src, str):
+                jobs = plan_tree(self.src, self.dest, self.errors)
+            else:
+                jobs = plan_sources(self.src, self.dest, self.errors)
+            if self.profiler is not None:
+                jobs = _timed_scan(jobs, self.profiler)
+            for job in jobs:
+                if self._stop.is_set():
+                    break
+                if not job.is_dir:
+                    self.total_bytes += job.size
+                    self.total_files += 1
+                    self.total_holes += job.holes
+                self._queue.put(job)
+        except OSError as e:
+            self.errors.append((self.src, str(e)))
+        finally:
+            self.finished.set()
+            self._queue.put(_DONE)
+
+    def __iter__(self):
+        if self._thread is None:
+            self.start()
+        while (job := self._queue.get()) is not _DONE:
+            yield job
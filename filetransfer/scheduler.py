@@ -0,0 +1,513 @@
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import compress, delta, ranges
+from .devices import default_workers
+from .engine import CopyResult, FixedChunkSize, clone_file, copy_file
+from .estimate import TransferEstimator
+from .journal import CHECKPOINT_BYTES, partial_path
+from .pack import PACK_FILE_SIZE
+from .profiler import NULL_PROFILER
+from .scanner import TransferJob
+from .sync import data_digest, file_digest
+from .sync import new_hasher as new_sync_hasher
+
+SMALL_FILE_SIZE = 1024 * 1024          # files below this are batched together
+LARGE_FILE_SIZE = 256 * 1024 * 1024    # files above this are streamed one at a time
+BATCH_MAX_FILES = 64
+BATCH_MAX_BYTES = 8 * 1024 * 1024
+TUNE_MIN_SIZE = 32 * 1024 * 1024       # files big enough for the chunk controller to learn from
+
+
+class _Tee:
+    """One hasher that feeds every chunk to several"""
+
+    __slots__ = ("hashers",)
+
+    def __init__(self, *hashers):
+        self.hashers = hashers
+
+    def update(self, data):
+        for hasher in self.hashers:
+            hasher.update(data)
+
+
+class TransferSummary:
+    """Totals for a whole transfer, filled in by the scheduler"""
+
+    def __init__(self):
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.files_skipped = 0   # unchanged files left alone in sync mode
+        self.bytes_skipped = 0
+        self.files_resumed = 0   # files an interrupted run had finished or started
+        self.bytes_resumed = 0   # bytes of those that didn't need copying again
+        self.bytes_delta_saved = 0  # bytes of existing files the delta engine didn't rewrite
+        self.files_verified = 0  # copies whose read-back digest matched the source
+        self.files_packed = 0    # small files appended to a pack instead of created
+        self.bytes_compress_saved = 0  # bytes compression kept off the destination
+        self.bytes_cloned = 0    # bytes shared with the source by reflinks instead of copied
+        self.bytes_sparse = 0    # holes in sparse files, recreated instead of written
+        self.failures = []  # (src, error message)
+        self.cancelled = False
+        self.methods = {}   # engine name -> file count
+
+    @property
+    def bytes_done(self):
+        """Bytes accounted for so far, whether copied, skipped or resumed"""
+        return self.bytes_copied + self.bytes_cloned + self.bytes_sparse + self.bytes_skipped + self.bytes_resumed
+
+    @property
+    def files_failed(self):
+        return len(self.failures)
+
+    @property
+    def ok(self):
+        return not self.failures and not self.cancelled
+
+    def describe(self):
+        """One-line human readable report"""
+        mb = 1024 * 1024
+        text = f"Copied {self.files_copied} files ({self.bytes_copied / mb:.1f} MB)"
+        if self.bytes_cloned:
+            text += f", cloned {self.bytes_cloned / mb:.1f} MB"
+        if self.bytes_sparse:
+            text += f", kept {self.bytes_sparse / mb:.1f} MB of holes sparse"
+        if self.files_skipped:
+            text += f", skipped {self.files_skipped} unchanged ({self.bytes_skipped / mb:.1f} MB)"
+        if self.files_resumed:
+            text += f", resumed {self.files_resumed} ({self.bytes_resumed / mb:.1f} MB)"
+        if self.bytes_delta_saved:
+            text += f", delta saved {self.bytes_delta_saved / mb:.1f} MB"
+        if self.bytes_compress_saved:
+            text += f", compression saved {self.bytes_compress_saved / mb:.1f} MB"
+        if self.files_packed:
+            text += f", packed {self.files_packed}"
+        if self.files_verified:
+            text += f", verified {self.files_verified}"
+        if self.failures:
+            text += f", {self.files_failed} failed"
+        if self.cancelled:
+            text += ", cancelled"
+        if self.methods:
+            text += f", engines used: {self.methods}"
+        return text
+
+    def __repr__(self):
+        return (f"TransferSummary(files_copied={self.files_copied}, bytes_copied={self.bytes_copied}, "
+                f"files_skipped={self.files_skipped}, bytes_skipped={self.bytes_skipped}, "
+                f"files_resumed={self.files_resumed}, bytes_resumed={self.bytes_resumed}, "
+                f"files_failed={self.files_failed}, cancelled={self.cancelled})")
+
+
+def batch_jobs(jobs, small_file_size=SMALL_FILE_SIZE, max_files=BATCH_MAX_FILES, max_bytes=BATCH_MAX_BYTES):
+    """Group small jobs into batches, every other job becomes a batch of one"""
+    batch = []
+    batch_bytes = 0
+    for job in jobs:
+        if job.size >= small_file_size:
+            yield [job]
+            continue
+        batch.append(job)
+        batch_bytes += job.size
+        if len(batch) >= max_files or batch_bytes >= max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
+class TransferScheduler:
+    """Copy many files at once on a bounded worker pool.
+
+    Small files are batched so one task covers many of them, large files
+    are streamed one at a time (optionally split into ``range_count``
+    parallel byte ranges) so they don't fight each other for the disk, and
+    everything in between gets a task of its own.
+    """
+
+    def __init__(self, dest=None, workers=None, on_progress=None, on_file_start=None, on_file_done=None,
+                 is_cancelled=None, large_file_size=LARGE_FILE_SIZE, small_file_size=SMALL_FILE_SIZE,
+                 range_count=1, sync=None, journal=None, delta_block_size=0, tuner=None, verifier=None,
+                 compressor=None, decompress=False, packer=None, write_behind=0, fsync_batcher=None,
+                 throttle=None, estimator=None, reflink=True, profiler=None):
+        if workers is None:
+            workers = default_workers(dest) if dest else 4
+        self.workers = max(1, workers)
+        self.on_progress = on_progress
+        self.on_file_start = on_file_start
+        self.on_file_done = on_file_done
+        self.is_cancelled = is_cancelled
+        self.large_file_size = large_file_size
+        self.small_file_size = small_file_size
+        # Large files are split into this many byte ranges copied in parallel (1 = sequential)
+        self.range_count = range_count if ranges.available() else 1
+        # A SyncManifest turns on sync mode: unchanged files are skipped
+        self.sync = sync
+        # A TransferJournal makes the run resumable after a cancel or crash
+        self.journal = journal
+        # Large files that already exist at the destination are patched block
+        # by block instead of rewritten (0 = off)
+        self.delta_block_size = delta_block_size
+        # A ChunkTuner adapts the chunk size to the device pair as files are copied
+        self.tuner = tuner
+        # A Verifier hashes files as they stream through and reads them back;
+        # the owner closes it once run() returns
+        self.verifier = verifier
+        if verifier is not None:
+            verifier.on_result = self._verified
+        # A Compressor stores compressible files as containers; with
+        # ``decompress`` containers in the source are expanded instead
+        self.compressor = compressor
+        self.decompress = decompress
+        # A Packer takes files below PACK_FILE_SIZE (and the directories)
+        # instead of creating them at the destination
+        self.packer = packer
+        # Bytes between write-backs of the destination (0 = leave it to the kernel)
+        self.write_behind = write_behind
+        # An FsyncBatcher makes finished files durable every so many files or bytes
+        self.fsync_batcher = fsync_batcher
+        # A TokenBucket caps the bandwidth of the whole transfer
+        self.throttle = throttle
+        # Try sharing extents on copy-on-write filesystems before copying
+        self.reflink = reflink
+        # Every byte and finished file goes to the transfer-wide ETA model
+        self.estimator = estimator if estimator is not None else TransferEstimator()
+        # A PhaseProfiler times every phase of every file
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        self.summary = TransferSummary()
+        self._lock = threading.Lock()
+        self._large_lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._made_dirs = set()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def cancelled(self):
+        if self._cancel_event.is_set():
+            return True
+        if self.is_cancelled is not None and self.is_cancelled():
+            self._cancel_event.set()
+            return True
+        return False
+
+    def _progress(self, n):
+        if self.throttle is not None:
+            with self.profiler.phase("throttle"):
+                self.throttle.consume(n, self.cancelled)
+        with self.profiler.phase("progress"):
+            self.estimator.record(n)
+            with self._lock:
+                self.summary.bytes_copied += n
+                done = self.summary.bytes_done
+            if self.on_progress is not None:
+                self.on_progress(done)
+
+    def _skip(self, job):
+        self.estimator.skip(job.size, 1, job.holes)
+        with self._lock:
+            self.summary.files_skipped += 1
+            self.summary.bytes_skipped += job.size
+            done = self.summary.bytes_done
+        if self.on_progress is not None:
+            self.on_progress(done)
+
+    def _resumed(self, nbytes):
+        self.estimator.skip(nbytes)
+        with self._lock:
+            self.summary.files_resumed += 1
+            self.summary.bytes_resumed += nbytes
+            done = self.summary.bytes_done
+        if self.on_progress is not None:
+            self.on_progress(done)
+
+    def _cloned(self, nbytes):
+        # Near enough free, so it shortens the ETA without counting as throughput
+        self.estimator.skip(nbytes)
+        with self._lock:
+            self.summary.bytes_cloned += nbytes
+            done = self.summary.bytes_done
+        if self.on_progress is not None:
+            self.on_progress(done)
+
+    def _hole(self, nbytes):
+        self.estimator.hole(nbytes)
+        with self._lock:
+            self.summary.bytes_sparse += nbytes
+            done = self.summary.bytes_done
+        if self.on_progress is not None:
+            self.on_progress(done)
+
+    def _ensure_parent(self, path):
+        parent = os.path.dirname(path)
+        if not parent or parent in self._made_dirs:
+            return
+        os.makedirs(parent, exist_ok=True)
+        with self._lock:
+            self._made_dirs.add(parent)
+
+    def _make_dir(self, job):
+        try:
+            os.makedirs(job.dst, exist_ok=True)
+        except OSError as e:
+            with self._lock:
+                self.summary.failures.append((job.src, str(e)))
+            return
+        with self._lock:
+            self._made_dirs.add(job.dst)
+
+    def _verified(self, job, ok, message):
+        if ok:
+            with self._lock:
+                self.summary.files_verified += 1
+            return
+        with self._lock:
+            self.summary.failures.append((job.src, message))
+        print(f"Verification failed for {job.dst}: {message}")
+        # Make sure the next run copies it again
+        if self.sync is not None:
+            self.sync.forget(job)
+        if self.journal is not None:
+            self.journal.forget(job)
+
+    def _pack(self, job):
+        """Append a small file to the pack; resume and verify only cover direct copies"""
+        try:
+            if self.sync is not None and self.sync.is_unchanged(job):
+                self._skip(job)
+                return
+        except Exception as e:
+            print(f"Could not check {job.dst} against the manifest, packing it: {e}")
+        if self.on_file_start is not None:
+            self.on_file_start(job)
+        try:
+            with open(job.src, "rb") as f:
+                data = f.read()
+            pack = self.packer.add(job, data)
+            if self.sync is not None:
+                # Otherwise every rerun would append the whole tree to the pack again
+                self.sync.record(job, data_digest(data) if self.sync.checksum else None, pack)
+        except Exception as e:
+            with self._lock:
+                self.summary.failures.append((job.src, str(e)))
+            print(f"Error packing {job.src}: {e}")
+            return
+        self._progress(len(data))
+        self.estimator.record(nfiles=1)
+        result = CopyResult(method="packed", bytes_copied=len(data), completed=True)
+        with self._lock:
+            self.summary.files_packed += 1
+            self.summary.methods[result.method] = self.summary.methods.get(result.method, 0) + 1
+        if self.on_file_done is not None:
+            self.on_file_done(job, result)
+
+    def _source_digest(self, job, source_hasher):
+        """The digest the manifest keeps for ``job``, None to have it read back from ``job.dst``"""
+        if source_hasher is not None:
+            return source_hasher.hexdigest()
+        if self.sync.checksum and compress.is_container(job.src) and not compress.is_container(job.dst):
+            # Expanded from a container: the copy isn't what the source holds
+            return file_digest(job.src)
+        return None
+
+    def _container_job(self, job):
+        """The job with ``dst`` renamed to what the (de)compressed copy is called"""
+        suffix = compress.CONTAINER_SUFFIX
+        if self.decompress and compress.is_container(job.src):
+            return TransferJob(job.src, job.dst[:-len(suffix)], job.size, job.mtime_ns)
+        if self.compressor is not None and self.compressor.wants(job):
+            return TransferJob(job.src, job.dst + suffix, job.size, job.mtime_ns)
+        return job
+
+    def _copy(self, job, dst, hasher=None):
+        """Copy one file to ``dst`` with whichever path suits its size"""
+        # Containers are written in one go, there is nothing to resume or patch
+        if self.decompress and compress.is_container(job.src):
+            return compress.decompress_file(job.src, dst, self._progress, self.cancelled, hasher)
+        if (self.compressor is not None and compress.is_container(job.dst)
+                and not compress.is_container(job.src)):
+            return self.compressor.compress_file(job.src, dst, self._progress, self.cancelled, hasher)
+        resume_offset = 0
+        on_checkpoint = None
+        if self.journal is not None:
+            resume_offset = self.journal.resume_offset(job)
+            on_checkpoint = functools.partial(self.journal.checkpoint, job)
+            if resume_offset:
+                self._resumed(resume_offset)
+        # delta_copy writes every block it passes, holes included, so sparse
+        # files go through copy_file, which keeps them sparse
+        patch = (self.delta_block_size and not resume_offset and job.size >= delta.DELTA_MIN_SIZE
+                 and not job.holes and os.path.isfile(job.dst))
+        if self.reflink and (patch or job.size >= self.large_file_size):
+            # The delta and range paths don't clone by themselves (copy_file
+            # does), and a clone beats both of them
+            result = clone_file(job.src, dst, resume_offset, hasher)
+            if result is not None:
+                return result
+        if patch and clone_file(job.dst, dst) is not None:
+            # The old copy keeps its name until the new one replaces it, its
+            # clone under the temporary name is what gets patched. Where it
+            # can't be cloned (ext4, FAT), rebuilding it from the old copy
+            # would write the whole file anyway, so it is copied as usual.
+            return delta.delta_copy(job.src, dst, self.delta_block_size, self._progress, self.cancelled,
+                                    on_checkpoint, CHECKPOINT_BYTES, hasher)
+        if job.size >= self.large_file_size:
+            with self._large_lock:
+                # Range copies have no single offset to resume from, so a
+                # half-done file goes back through the sequential path. They
+                # can't feed a hasher in order either, and preallocating
+                # would fill in the holes of a sparse file.
+                if self.range_count > 1 and not resume_offset and hasher is None and not job.holes:
+                    return ranges.copy_file_ranges(job.src, dst, self.range_count,
+                                                   self._progress, self.cancelled)
+                return self._copy_sequential(job, dst, resume_offset, on_checkpoint, hasher)
+        return self._copy_sequential(job, dst, resume_offset, on_checkpoint, hasher)
+
+    def _copy_sequential(self, job, dst, resume_offset, on_checkpoint, hasher):
+        controller = None
+        if self.tuner is not None:
+            if job.size >= TUNE_MIN_SIZE:
+                controller = self.tuner.controller()
+            else:
+                controller = FixedChunkSize(self.tuner.best)
+        result = copy_file(job.src, dst, self._progress, self.cancelled, resume_offset=resume_offset,
+                           on_checkpoint=on_checkpoint, checkpoint_bytes=CHECKPOINT_BYTES,
+                           chunk_controller=controller, hasher=hasher, write_behind=self.write_behind,
+                           reflink=self.reflink, on_hole=self._hole, profiler=self.profiler)
+        if job.size >= TUNE_MIN_SIZE and self.tuner is not None:
+            self.tuner.report(controller)
+        return result
+
+    def _discard(self, part):
+        """Drop an unfinished copy, unless the journal can resume it later"""
+        if self.journal is not None:
+            return
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+
+    def _copy_one(self, job):
+        if job.is_dir:
+            return self._copy_job(job)
+        self.profiler.begin_file(job.size)
+        with self.profiler.phase("file", job.src):
+            self._copy_job(job)
+
+    def _copy_job(self, job):
+        if self.packer is not None and (job.is_dir or job.size < PACK_FILE_SIZE):
+            if job.is_dir:
+                self.packer.add_dir(job)
+            else:
+                self._pack(job)
+            return
+        if job.is_dir:
+            self._make_dir(job)
+            return
+        if self.compressor is not None or self.decompress:
+            job = self._container_job(job)
+        unchanged = resumed = False
+        try:
+            if self.sync is not None:
+                with self.profiler.phase("check"):
+                    unchanged = self.sync.is_unchanged(job)
+        except Exception as e:
+            print(f"Could not check {job.dst} against the manifest, copying it: {e}")
+        if unchanged:
+            self._skip(job)
+            return
+        if self.journal is not None:
+            with self.profiler.phase("check"):
+                resumed = self.journal.is_done(job)
+        if resumed:
+            self.estimator.skip(nfiles=1, holes=job.holes)
+            self._resumed(job.size)
+            return
+        if self.on_file_start is not None:
+            with self.profiler.phase("progress"):
+                self.on_file_start(job)
+        # Write under a temporary name so a half-copied file never looks finished
+        part = partial_path(job.dst)
+        hasher = self.verifier.new_hasher() if self.verifier is not None else None
+        copy_hasher = hasher
+        source_hasher = None
+        compressing = compress.is_container(job.dst) and not compress.is_container(job.src)
+        if self.sync is not None and self.sync.checksum and compressing:
+            # The manifest digest is of the source, which a container doesn't
+            # hold as such; take it from the raw chunks on their way through
+            source_hasher = new_sync_hasher()
+            copy_hasher = source_hasher if hasher is None else _Tee(hasher, source_hasher)
+        try:
+            with self.profiler.phase("mkdir"):
+                self._ensure_parent(job.dst)
+            result = self._copy(job, part, copy_hasher)
+            if result.completed:
+                with self.profiler.phase("rename"):
+                    os.replace(part, job.dst)
+                if self.fsync_batcher is not None:
+                    with self.profiler.phase("fsync"):
+                        self.fsync_batcher.add(job.dst, job.size)
+                with self.profiler.phase("bookkeeping"):
+                    if self.journal is not None:
+                        self.journal.mark_done(job)
+                    if self.sync is not None:
+                        self.sync.record(job, self._source_digest(job, source_hasher))
+                    if hasher is not None:
+                        self.verifier.submit(job, hasher.hexdigest())
+            else:
+                self._discard(part)
+        except Exception as e:
+            self._discard(part)
+            with self._lock:
+                self.summary.failures.append((job.src, str(e)))
+            print(f"Error copying {job.src} to {job.dst}: {e}")
+            return
+        if result.completed:
+            if result.bytes_cloned:
+                self._cloned(result.bytes_cloned)
+            self.estimator.record(nfiles=1)
+            with self._lock:
+                self.summary.files_copied += 1
+                self.summary.methods[result.method] = self.summary.methods.get(result.method, 0) + 1
+                if isinstance(result, delta.DeltaResult):
+                    self.summary.bytes_delta_saved += result.bytes_copied - result.bytes_written
+                elif isinstance(result, compress.CompressResult):
+                    self.summary.bytes_compress_saved += result.bytes_copied - result.bytes_written
+            if self.on_file_done is not None:
+                with self.profiler.phase("progress"):
+                    self.on_file_done(job, result)
+
+    def run_batch(self, batch):
+        """Copy one batch on the calling thread, stopping early on cancel"""
+        for job in batch:
+            if self.cancelled():
+                return
+            self._copy_one(job)
+
+    def _run_batch(self, batch, slots):
+        try:
+            self.run_batch(batch)
+        finally:
+            slots.release()
+
+    def run(self, jobs):
+        """Copy every job from the ``jobs`` iterable and return the summary.
+
+        Jobs are pulled lazily, so ``jobs`` can be a generator that is still
+        walking the source tree.
+        """
+        # Keep a couple of batches queued per worker, no more, so a huge job
+        # list never sits in memory as pending futures.
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="transfer") as pool:
+            for batch in batch_jobs(jobs, self.small_file_size):
+                if self.cancelled():
+                    break
+                slots.acquire()
+                pool.submit(self._run_batch, batch, slots)
+        self.summary.cancelled = self.cancelled()
+        return self.summary
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+from .pack import pack_paths
+
+MANIFEST_NAME = ".filetransfer_manifest.sqlite"
+COMMIT_EVERY = 1000  # manifest rows per transaction
+HASH_CHUNK = 1024 * 1024
+
+
+def new_hasher():
+    """The hash file_digest takes, to digest a file as it streams past"""
+    return hashlib.blake2b(digest_size=32)
+
+
+def file_digest(path):
+    """BLAKE2b of the whole file, read through one reused buffer"""
+    h = new_hasher()
+    buf = bytearray(HASH_CHUNK)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def data_digest(data):
+    """file_digest of contents already read into memory"""
+    h = new_hasher()
+    h.update(data)
+    return h.hexdigest()
+
+
+class SyncManifest:
+    """Persistent record of what earlier runs copied into ``root``.
+
+    Each row holds the source size and mtime the destination file was copied
+    from (plus a digest when checksums are on). A rerun compares the fresh
+    scan against these rows and skips anything that hasn't changed, without
+    touching the destination at all.
+    """
+
+    def __init__(self, root, checksum=False):
+        self.root = root
+        self.checksum = checksum
+        os.makedirs(self.root, exist_ok=True)
+        self.path = os.path.join(self.root, MANIFEST_NAME)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, digest TEXT, pack TEXT)"
+        )
+        # Manifests written before --pack was recorded have no pack column
+        if "pack" not in [row[1] for row in self._db.execute("PRAGMA table_info(files)")]:
+            self._db.execute("ALTER TABLE files ADD COLUMN pack TEXT")
+        # Packs present before this run; pack names get reused once they are
+        # deleted, so one created by this run doesn't vouch for older rows
+        self._packs = {os.path.basename(path) for path in pack_paths(self.root)}
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _key(self, dst):
+        return os.path.relpath(dst, self.root).replace(os.sep, "/")
+
+    def lookup(self, dst):
+        with self._lock:
+            return self._db.execute(
+                "SELECT size, mtime_ns, digest, pack FROM files WHERE path = ?", (self._key(dst),)
+            ).fetchone()
+
+    def is_unchanged(self, job):
+        """True when ``job.dst`` already holds the current contents of ``job.src``"""
+        row = self.lookup(job.dst)
+        if row is None:
+            # Not in the manifest: fall back to rsync's quick check against the
+            # destination itself (sync mode copies mtimes, so this holds for
+            # files an older run copied before the manifest existed).
+            try:
+                st = os.stat(job.dst)
+            except OSError:
+                return False
+            if st.st_size != job.size or st.st_mtime_ns != job.mtime_ns:
+                return False
+            if self.checksum and file_digest(job.src) != file_digest(job.dst):
+                return False
+            self.record(job)
+            return True
+
+        size, mtime_ns, digest, pack = row
+        if size != job.size or mtime_ns != job.mtime_ns:
+            return False
+        if pack is not None and pack not in self._packs and not os.path.exists(job.dst):
+            # Packed, and the pack has since been deleted without unpacking it here
+            return False
+        if self.checksum:
+            return digest is not None and digest == file_digest(job.src)
+        return True
+
+    def record(self, job, digest=None, pack=None):
+        """Remember that ``job`` was copied, and give the copy the source's mtime.
+
+        A file that went into the pack named ``pack`` (see pack.py) instead
+        has no ``job.dst`` to touch; with checksums on, pass its ``digest``.
+        """
+        if pack is None:
+            try:
+                os.utime(job.dst, ns=(job.mtime_ns, job.mtime_ns))
+            except OSError:
+                pass
+        if digest is None and self.checksum:
+            digest = file_digest(job.dst)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, digest, pack) VALUES (?, ?, ?, ?, ?)",
+                (self._key(job.dst), job.size, job.mtime_ns, digest, pack),
+            )
+            self._pending += 1
+            if self._pending >= COMMIT_EVERY:
+                self._db.commit()
+                self._pending = 0
+
+    def forget(self, job):
+        """Drop ``job`` from the manifest so the next run copies it again"""
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE path = ?", (self._key(job.dst),))
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
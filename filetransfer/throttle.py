@@ -0,0 +1,37 @@
+import threading
+import time
+
+SLEEP_SLICE = 0.25  # longest sleep between cancel checks
+
+
+class TokenBucket:
+    """Bandwidth limit shared by all workers of one transfer.
+
+    Tokens are bytes, refilled at ``rate`` per second up to ``burst``. A
+    worker takes tokens for every chunk it has copied; when the bucket runs
+    into debt the worker sleeps it off, so the transfer as a whole averages
+    ``rate`` however many workers it has and however big their chunks are.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst or rate  # one second's worth by default
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes, is_cancelled=None):
+        """Take ``nbytes`` tokens, sleeping until the bucket is out of debt"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        deadline = time.monotonic() + wait
+        while (remaining := deadline - time.monotonic()) > 0:
+            if is_cancelled is not None and is_cancelled():
+                return
+            time.sleep(min(remaining, SLEEP_SLICE))
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+
+from .devices import device_id
+from .engine import CHUNK_SIZE
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+WINDOW_SECONDS = 0.05   # measure each size for at least this long...
+WINDOW_CHUNKS = 4       # ...and over at least this many chunks
+IMPROVEMENT = 1.05      # a step has to beat the best rate by 5% to count
+MAX_REVERSALS = 2       # settle after turning around this many times
+
+
+def default_cache_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "filetransfer", "chunk_sizes.json")
+
+
+class AdaptiveChunkSize:
+    """Hill-climbing chunk size controller.
+
+    Copy engines read ``size`` before each chunk and call ``record(n)`` after
+    it. Once a window of chunks has been measured, the controller compares
+    its throughput with the best seen so far: it keeps doubling (or halving)
+    while that helps, turns around when it stops helping, and settles on
+    the best size after a couple of turns.
+    """
+
+    def __init__(self, initial=CHUNK_SIZE, minimum=MIN_CHUNK_SIZE, maximum=MAX_CHUNK_SIZE):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = min(max(initial, minimum), maximum)
+        self.settled = False
+        self.best_size = self.size
+        self.best_rate = None
+        self._direction = 2   # grow first, small chunks are the common mistake
+        self._reversals = 0
+        self._window_bytes = 0
+        self._window_chunks = 0
+        self._window_start = time.perf_counter()
+
+    def record(self, nbytes):
+        if self.settled:
+            return
+        self._window_bytes += nbytes
+        self._window_chunks += 1
+        now = time.perf_counter()
+        elapsed = now - self._window_start
+        if elapsed < WINDOW_SECONDS or self._window_chunks < WINDOW_CHUNKS:
+            return
+        self._evaluate(self._window_bytes / elapsed)
+        self._window_bytes = 0
+        self._window_chunks = 0
+        self._window_start = time.perf_counter()
+
+    def _evaluate(self, rate):
+        if self.best_rate is None or rate > self.best_rate * IMPROVEMENT:
+            self.best_rate = rate
+            self.best_size = self.size
+        elif self.size != self.best_size:
+            self._reversals += 1
+            self._direction = 1 / self._direction if self._direction > 1 else 2
+            self.size = self.best_size
+            if self._reversals >= MAX_REVERSALS:
+                self.settled = True
+                return
+        self._step()
+
+    def _step(self):
+        next_size = int(self.size * self._direction)
+        next_size = min(max(next_size, self.minimum), self.maximum)
+        if next_size == self.size:
+            # Hit a limit: turn around once, then stop
+            self._reversals += 1
+            self._direction = 1 / self._direction if self._direction > 1 else 2
+            next_size = min(max(int(self.size * self._direction), self.minimum), self.maximum)
+            if self._reversals >= MAX_REVERSALS or next_size == self.size:
+                self.settled = True
+                return
+        self.size = next_size
+
+
+class ChunkSizeCache:
+    """Best chunk size per (source device, destination device), kept between runs"""
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self._sizes = json.load(f)
+        except (OSError, ValueError):
+            self._sizes = {}
+
+    @staticmethod
+    def key(src, dst):
+        return f"{device_id(src)}->{device_id(dst)}"
+
+    def get(self, src, dst):
+        return self._sizes.get(self.key(src, dst))
+
+    def set(self, src, dst, size):
+        with self._lock:
+            self._sizes[self.key(src, dst)] = int(size)
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self._sizes, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+class ChunkTuner:
+    """Hands out chunk controllers for one source/destination pair and learns from them.
+
+    Every large file starts from the best size known for the pair, either
+    from an earlier run, a calibration, or a file earlier in this transfer.
+    """
+
+    def __init__(self, src, dst, cache=None):
+        self.src = src
+        self.dst = dst
+        self.cache = cache if cache is not None else ChunkSizeCache()
+        self.best = self.cache.get(src, dst) or CHUNK_SIZE
+        self._lock = threading.Lock()
+
+    def controller(self):
+        return AdaptiveChunkSize(self.best)
+
+    def report(self, controller):
+        """Adopt what a finished copy settled on"""
+        if controller.settled or controller.best_rate is not None:
+            with self._lock:
+                self.best = controller.best_size
+            self.cache.set(self.src, self.dst, self.best)
+
+    def save(self):
+        try:
+            self.cache.save()
+        except OSError as e:
+            print(f"Could not save chunk sizes to {self.cache.path}: {e}")
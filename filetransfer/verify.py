@@ -0,0 +1,122 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .compress import is_container, iter_container
+
+try:
+    import xxhash
+except ImportError:  # optional, pip install xxhash
+    xxhash = None
+
+READ_CHUNK = 1024 * 1024
+
+# Digest names, written into the manifest file name like coreutils does
+# (BLAKE2BSUMS works with ``b2sum -c``, SHA256SUMS with ``sha256sum -c``).
+HASH_ALGORITHMS = {
+    "blake2b": hashlib.blake2b,
+    "sha256": hashlib.sha256,
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh64"] = xxhash.xxh64
+    HASH_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+
+DEFAULT_ALGORITHM = "blake2b"
+
+
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    try:
+        return HASH_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ValueError(f"Unknown hash {algorithm!r}, expected one of {sorted(HASH_ALGORITHMS)}") from None
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, from_device=False, contents=True):
+    """Digest of the file at ``path``.
+
+    With ``from_device`` the file is flushed and dropped from the page cache
+    first, so the read-back checks what the disk holds rather than what we
+    just wrote into memory.
+
+    Compressed containers are hashed by their contents, so the digest
+    matches the file they were made from; with ``contents=False`` they are
+    hashed as stored, like any other file.
+    """
+    h = new_hasher(algorithm)
+    buf = bytearray(READ_CHUNK)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        if from_device:
+            os.fsync(f.fileno())
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        if contents and is_container(path):
+            for data in iter_container(path):
+                h.update(data)
+            return h.hexdigest()
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+class Verifier:
+    """Read-back checks that run alongside the copy.
+
+    The scheduler hashes each file while copying it, then hands the digest
+    here. A small pool re-reads the destination and compares, while the
+    workers move on to the next files. Good digests are appended to a
+    ``<ALGO>SUMS`` manifest in the destination root so the copy can be
+    audited later without the source (later lines win for repeated paths).
+    Compressed containers are listed with the digest of the container as
+    stored, which is what ``b2sum -c`` and friends will read.
+    """
+
+    def __init__(self, root, algorithm=DEFAULT_ALGORITHM, workers=2, on_result=None):
+        new_hasher(algorithm)  # fail early on a bad name
+        self.root = root
+        self.algorithm = algorithm
+        self.on_result = on_result
+        self.manifest_path = os.path.join(root, f"{algorithm.upper()}SUMS")
+        self._manifest = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify")
+
+    def new_hasher(self):
+        return new_hasher(self.algorithm)
+
+    def submit(self, job, digest):
+        """Queue a read-back of ``job.dst`` against the digest taken while copying"""
+        self._pool.submit(self._check, job, digest)
+
+    def _check(self, job, digest):
+        try:
+            actual = hash_file(job.dst, self.algorithm, from_device=True)
+            listed = actual
+            if is_container(job.dst):
+                listed = hash_file(job.dst, self.algorithm, contents=False)
+        except (OSError, ValueError) as e:
+            ok, message = False, f"could not read back for verification: {e}"
+        else:
+            ok = actual == digest
+            message = None if ok else f"{self.algorithm} mismatch after copy ({actual} != {digest})"
+        if ok:
+            self._record(job, listed)
+        if self.on_result is not None:
+            self.on_result(job, ok, message)
+
+    def _record(self, job, digest):
+        rel = os.path.relpath(job.dst, self.root).replace(os.sep, "/")
+        with self._lock:
+            if self._manifest is None:
+                os.makedirs(self.root, exist_ok=True)
+                self._manifest = open(self.manifest_path, "a", encoding="utf-8")
+            self._manifest.write(f"{digest}  {rel}\n")
+
+    def close(self):
+        """Wait for every queued check and close the manifest"""
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            if self._manifest is not None:
+                self._manifest.close()
+                self._manifest = None